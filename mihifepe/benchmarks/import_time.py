@@ -0,0 +1,73 @@
+"""
+Measures import time of the worker and master modules, failing if it exceeds its budget or if heavy dependencies
+meant to be imported lazily are imported. Workers run as short-lived processes, one per task,
+so their startup time is a measurable share of wall time.
+"""
+
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+# Import time budgets in seconds
+BUDGETS = {"mihifepe.worker": 0.4, "mihifepe.master": 0.4}
+# Heavy dependencies, only to be imported by code paths using them
+LAZY_MODULES = ["scipy.stats", "scipy.cluster", "sympy", "sklearn", "anytree.exporter", "unittest.mock", "mihifepe.interactions"]
+
+
+def main():
+    """Main"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-repeats", type=int, default=5, help="number of times to measure each import (the median is reported)")
+    parser.add_argument("-budget_scale", type=float, default=1., help="scale factor for import time budgets (e.g. for slow machines)")
+    args = parser.parse_args()
+    failures = []
+    for module, budget in sorted(BUDGETS.items()):
+        import_time, startup_time, lazy_modules = measure(module, args.repeats)
+        budget *= args.budget_scale
+        print("%s: import time %.3f seconds (budget %.3f seconds), 'python -m %s -h' wall time %.3f seconds"
+              % (module, import_time, budget, module, startup_time))
+        if import_time > budget:
+            failures.append("%s import time %.3f seconds exceeds budget of %.3f seconds" % (module, import_time, budget))
+        if lazy_modules:
+            failures.append("%s imports modules meant to be imported lazily: %s" % (module, ", ".join(lazy_modules)))
+    if failures:
+        sys.exit("\n".join(failures))
+
+
+def measure(module, repeats):
+    """
+    Measure import of module in fresh interpreters
+
+    Returns:
+        median import time in seconds (as reported by -X importtime),
+        median wall time in seconds of running 'python -m <module> -h',
+        list of modules in LAZY_MODULES imported by module
+    """
+    import_times = []
+    startup_times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module], stderr=subprocess.PIPE,
+                                universal_newlines=True, check=True).stderr
+        imported = {}
+        for line in output.splitlines():
+            match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)", line)
+            if match:
+                imported[match.group(2)] = int(match.group(1)) / 1e6
+        import_times.append(imported[module])
+        startup_times.append(time_startup(module))
+    lazy_modules = [name for name in LAZY_MODULES if name in imported]
+    return statistics.median(import_times), statistics.median(startup_times), lazy_modules
+
+
+def time_startup(module):
+    """Wall time in seconds of running 'python -m <module> -h'"""
+    start_time = time.time()
+    subprocess.run([sys.executable, "-m", module, "-h"], stdout=subprocess.DEVNULL, check=True)
+    return time.time() - start_time
+
+
+if __name__ == "__main__":
+    main()
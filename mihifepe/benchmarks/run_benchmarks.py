@@ -0,0 +1,234 @@
+"""
+Benchmark suite timing the main stages of mihifepe separately over synthetic inputs of several scales:
+perturbation (worker.Perturber), p-value computation (master.compute_p_values), hierarchical FDR control
+(both procedures), hierarchy loading (master.load_hierarchy) and compilation of worker results (compile_results).
+Inputs are generated using the simulation's data and hierarchy generators. Results are written as JSON,
+so that runs may be compared over time.
+"""
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from unittest.mock import patch
+
+import anytree
+import h5py
+import numpy as np
+
+import mihifepe
+from mihifepe import constants, master, utils, worker
+from mihifepe.fdr import hierarchical_fdr_control
+from mihifepe.feature import Feature
+from mihifepe.pipelines import CondorPipeline, Results
+from mihifepe.simulation import simulation
+
+
+def main():
+    """Main"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-output_dir", help="output directory", required=True)
+    parser.add_argument("-num_records", type=int, nargs="+", default=[10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6],
+                        help="numbers of records to benchmark")
+    parser.add_argument("-num_features", type=int, nargs="+", default=[10, 10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5],
+                        help="numbers of features to benchmark")
+    parser.add_argument("-perturbations", nargs="+", default=[constants.ZEROING, constants.SHUFFLING],
+                        choices=[constants.ZEROING, constants.SHUFFLING], help="perturbations to benchmark")
+    parser.add_argument("-max_cells", type=int, default=10 ** 7, help="skip scales where the number of records times the"
+                        " number of features exceeds this value, to bound memory and time")
+    parser.add_argument("-num_shuffling_trials", type=int, default=10, help="number of shuffling trials")
+    parser.add_argument("-perturber_records", type=int, default=10, help="number of records perturbed when benchmarking"
+                        " worker.Perturber (throughput is reported per record)")
+    parser.add_argument("-perturber_nodes", type=int, default=1000, help="maximum number of hierarchy nodes perturbed when"
+                        " benchmarking worker.Perturber")
+    parser.add_argument("-features_per_worker", type=int, default=10, help="number of features per worker results file"
+                        " when benchmarking compile_results")
+    parser.add_argument("-repeats", type=int, default=3, help="number of times to repeat each measurement")
+    parser.add_argument("-seed", type=int, default=constants.SEED)
+    args = parser.parse_args()
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    args.logger = utils.get_logger(__name__, "%s/benchmarks.log" % args.output_dir)
+    pipeline(args)
+
+
+def pipeline(args):
+    """Benchmark pipeline"""
+    args.logger.info("Begin mihifepe benchmarks with args: %s" % args)
+    benchmarks = []
+    for num_records in args.num_records:
+        for num_features in args.num_features:
+            if num_records * num_features > args.max_cells:
+                args.logger.info("Skipping %d records X %d features, exceeding -max_cells" % (num_records, num_features))
+                continue
+            benchmarks.extend(run_benchmarks(args, num_records, num_features))
+    outputs = {"metadata": get_metadata(), "benchmarks": benchmarks}
+    output_filename = "%s/%s" % (args.output_dir, constants.BENCHMARKS_FILENAME)
+    with open(output_filename, "w") as output_file:
+        json.dump(outputs, output_file, indent=2)
+    args.logger.info("End mihifepe benchmarks, results written to %s" % output_filename)
+    return outputs
+
+
+def get_metadata():
+    """Describe environment, to allow comparison of runs over time"""
+    return {"timestamp": datetime.now().isoformat(), "mihifepe_version": mihifepe.__version__,
+            "python_version": platform.python_version(), "numpy_version": np.__version__,
+            "platform": platform.platform(), "processor": platform.processor()}
+
+
+def run_benchmarks(args, num_records, num_features):
+    """Generate inputs of given scale and benchmark each stage over them"""
+    args.logger.info("Begin benchmarks over %d records X %d features" % (num_records, num_features))
+    scale_dir = "%s/records_%d_features_%d" % (args.output_dir, num_records, num_features)
+    if not os.path.exists(scale_dir):
+        os.makedirs(scale_dir)
+    data_filename, hierarchy_filename, model = gen_inputs(args, scale_dir, num_records, num_features)
+    benchmarks = []
+
+    def record(name, times, **kwargs):
+        """Record timing of benchmark"""
+        benchmark = dict(benchmark=name, num_records=num_records, num_features=num_features,
+                         seconds=min(times), median_seconds=statistics.median(times), **kwargs)
+        args.logger.info("Benchmark: %s" % benchmark)
+        benchmarks.append(benchmark)
+
+    # Hierarchy loading
+    record("load_hierarchy", repeat(args, lambda: master.load_hierarchy(hierarchy_filename)))
+    hierarchy_root = master.load_hierarchy(hierarchy_filename)
+    nodes = list(anytree.PreOrderIter(hierarchy_root))
+    # Perturbation
+    for perturbation in args.perturbations:
+        margs = get_master_args(args, scale_dir, data_filename, hierarchy_filename, perturbation)
+        times, num_nodes, num_perturber_records = benchmark_perturber(args, margs, nodes, model)
+        record("perturber", times, perturbation=perturbation, num_nodes=num_nodes, num_perturbed_records=num_perturber_records,
+               seconds_per_record=min(times) / num_perturber_records)
+    # P-values, over synthetic losses
+    margs = get_master_args(args, scale_dir, data_filename, hierarchy_filename, constants.ZEROING)
+    results = gen_results(args, nodes, num_records)
+    record("compute_p_values", repeat(args, lambda: master.compute_p_values(margs, args.logger, hierarchy_root, results)),
+           num_nodes=len(nodes))
+    # Hierarchical FDR control
+    pvalues_filename = "%s/%s" % (scale_dir, constants.PVALUES_FILENAME)
+    for procedure in [constants.YEKUTIELI, constants.LYNCH_GUO]:
+        record("hierarchical_fdr_control", repeat(args, lambda: run_hierarchical_fdr(scale_dir, pvalues_filename, procedure)),
+               procedure=procedure, num_nodes=len(nodes))
+    # Compiling worker results
+    feature_nodes = master.flatten_hierarchy(margs, hierarchy_root)
+    condor_pipeline = write_worker_results(args, margs, feature_nodes, results)
+    record("compile_results", repeat(args, condor_pipeline.compile_results), num_nodes=len(nodes),
+           num_results_files=condor_pipeline.task_count)
+    condor_pipeline.cleanup()
+    args.logger.info("End benchmarks over %d records X %d features" % (num_records, num_features))
+    return benchmarks
+
+
+def repeat(args, func):
+    """Time function over -repeats calls, returning times in seconds"""
+    times = []
+    for _ in range(args.repeats):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return times
+
+
+class LinearModel():
+    """Linear regression model with squared loss, cheap to evaluate so that benchmarks measure mihifepe's own costs"""
+    # pylint: disable = unused-argument
+
+    def __init__(self, coefficients):
+        self.coefficients = coefficients
+
+    def predict(self, target, static_data, temporal_data):
+        """Predict (loss, prediction) for instance"""
+        prediction = np.dot(static_data, self.coefficients)
+        return (prediction - target) ** 2, prediction
+
+    def predict_batch(self, target, static_data, temporal_data):
+        """Predict losses and predictions for multiple versions of instance"""
+        predictions = static_data.dot(self.coefficients)
+        return (predictions - target) ** 2, predictions
+
+
+def gen_inputs(args, scale_dir, num_records, num_features):
+    """Generate data, hierarchy and model using the simulation's generators"""
+    sargs = argparse.Namespace(rng=np.random.RandomState(args.seed), num_instances=num_records, num_features=num_features,
+                               clustering_instance_count=0, hierarchy_type=constants.RANDOM, contiguous_node_names=False,
+                               output_dir=scale_dir, logger=args.logger)
+    _, data, clustering_data = simulation.synthesize_data(sargs)
+    hierarchy_root, _ = simulation.gen_hierarchy(sargs, clustering_data)
+    for node in anytree.PreOrderIter(hierarchy_root):
+        node.description = ""
+    model = LinearModel(sargs.rng.uniform(-1, 1, num_features))
+    targets = data.dot(model.coefficients) + sargs.rng.normal(0, 0.1, num_records)
+    data_filename = simulation.write_data(sargs, data, targets)
+    hierarchy_filename = simulation.write_hierarchy(sargs, hierarchy_root)
+    return data_filename, hierarchy_filename, model
+
+
+def get_master_args(args, output_dir, data_filename, hierarchy_filename, perturbation):
+    """Arguments for master and worker functions, with default values for options not under benchmark"""
+    # The model is constructed in-process (see gen_inputs), so no model generator file is used
+    margs = master.get_parser().parse_args(["-model_generator_filename", "", "-hierarchy_filename", hierarchy_filename,
+                                            "-data_filename", data_filename, "-output_dir", output_dir,
+                                            "-perturbation", perturbation, "-num_shuffling_trials", str(args.num_shuffling_trials),
+                                            "-features_per_worker", str(args.features_per_worker), "-compile_results_only"])
+    margs.rng = np.random.RandomState(constants.SEED)
+    margs.record_indices = None
+    return margs
+
+
+def benchmark_perturber(args, margs, nodes, model):
+    """Time worker.Perturber over -perturber_records records, perturbing up to -perturber_nodes hierarchy nodes"""
+    if len(nodes) > args.perturber_nodes:
+        rng = np.random.RandomState(args.seed)
+        nodes = [nodes[idx] for idx in sorted(rng.choice(len(nodes), args.perturber_nodes, replace=False))]
+    features = [Feature(node.name, static_indices=node.static_indices, temporal_indices=node.temporal_indices) for node in nodes]
+    features.append(Feature(constants.BASELINE))
+    with h5py.File(margs.data_filename, "r") as hdf5_root:
+        perturber = worker.Perturber(margs, features, hdf5_root, model)
+        num_perturber_records = min(args.perturber_records, perturber.num_records)
+
+        def perturb():
+            """Perturb features over records"""
+            for record_idx in range(num_perturber_records):
+                perturber.perturb_features_for_record(record_idx)
+
+        times = repeat(args, perturb)
+    return times, len(nodes), num_perturber_records
+
+
+def gen_results(args, nodes, num_records):
+    """Generate synthetic results (losses) for all hierarchy nodes"""
+    rng = np.random.RandomState(args.seed)
+    baseline = rng.uniform(size=num_records)
+    losses = {node.name: baseline + rng.normal(0, 0.1, num_records) for node in nodes}
+    losses[constants.BASELINE] = baseline
+    return Results(np.zeros(num_records), losses, losses, {})
+
+
+def run_hierarchical_fdr(output_dir, pvalues_filename, procedure):
+    """Run hierarchical FDR control on p-values"""
+    cmd = ("python -m mihifepe.fdr.hierarchical_fdr_control -output_dir %s/%s_%s -procedure %s -render %s %s"
+           % (output_dir, constants.HIERARCHICAL_FDR_DIR, procedure, procedure, constants.RENDER_DEFERRED, pvalues_filename))
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        hierarchical_fdr_control.main()
+
+
+def write_worker_results(args, margs, feature_nodes, results):
+    """Write results files for features as written by workers, returning pipeline to compile them"""
+    condor_pipeline = CondorPipeline(margs, args.logger, feature_nodes)
+    for task_idx, (task_features, _, _) in enumerate(condor_pipeline.tiles):
+        wargs = argparse.Namespace(output_dir=margs.output_dir, task_idx=task_idx, losses=None)
+        outputs = {feature.name: results.losses[feature.name] for feature in task_features}
+        worker.write_outputs(wargs, args.logger, results.targets, outputs, outputs, {})
+    return condor_pipeline
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Content-addressed cache of perturbation results across runs (-cache_dir)
+
+Each entry holds the loss and prediction vectors (and numbers of shuffling trials) of a node over all records,
+keyed on hashes of the data file, the model generator (and any files it loads, -cache_extra_files),
+the perturbation settings, and the node's index sets (and RNG seed, for shuffling perturbations).
+Entries are evicted least recently used first once the cache exceeds -cache_size_limit.
+
+The cache may be inspected or pruned using:
+
+    python -m mihifepe.cache -cache_dir <cache_dir> [-prune_to <size in GB>] [-clear]
+"""
+
+import argparse
+import functools
+import glob
+import hashlib
+import json
+import os
+
+import h5py
+
+import mihifepe
+from mihifepe import constants
+from mihifepe.pipelines import Results
+
+# Settings affecting results of shuffling perturbations, included in cache keys
+SHUFFLING_SETTINGS = ["num_shuffling_trials", "shuffling_trials_tolerance", "min_shuffling_trials", "shuffling_trials_batch_size"]
+
+
+def main():
+    """Inspect or prune cache"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-cache_dir", help="cache directory", required=True)
+    parser.add_argument("-prune_to", type=float, help="evict least recently used entries until the cache is at most this size in GB")
+    parser.add_argument("-clear", action="store_true", help="remove all entries")
+    args = parser.parse_args()
+    if args.clear:
+        args.prune_to = 0
+    if args.prune_to is not None:
+        evicted = evict(args.cache_dir, args.prune_to * 2 ** 30)
+        print("Evicted %d entries" % evicted)
+    entries = get_entries(args.cache_dir)
+    print("%d entries, %.3f GB" % (len(entries), sum(size for _, size, _ in entries) / 2 ** 30))
+
+
+def hash_file(filename):
+    """SHA-256 digest of file contents, computed once per version of the file (e.g. across levels of -progressive)"""
+    stat = os.stat(filename)
+    return hash_file_version(os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=None)
+def hash_file_version(filename, mtime, size):
+    """SHA-256 digest of contents of given version (modification time and size) of file"""
+    # pylint: disable = unused-argument
+    digest = hashlib.sha256()
+    with open(filename, "rb") as hashed_file:
+        for block in iter(lambda: hashed_file.read(2 ** 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_entries(cache_dir):
+    """List (filename, size, last access time) of cache entries, least recently used first"""
+    entries = []
+    for filename in glob.glob("%s/*.hdf5" % cache_dir):
+        stat = os.stat(filename)
+        entries.append((filename, stat.st_size, stat.st_mtime))
+    return sorted(entries, key=lambda entry: entry[2])
+
+
+def evict(cache_dir, size_limit):
+    """Evict least recently used entries until cache is at most size_limit bytes, returning number of entries evicted"""
+    entries = get_entries(cache_dir)
+    total_size = sum(size for _, size, _ in entries)
+    evicted = 0
+    for filename, size, _ in entries:
+        if total_size <= size_limit:
+            break
+        os.remove(filename)
+        total_size -= size
+        evicted += 1
+    return evicted
+
+
+def get_run_key(args):
+    """Key identifying the data, model generator and perturbation settings of a run"""
+    settings = {"perturbation": args.perturbation}
+    if args.losses:
+        settings["loss"] = args.losses[0]  # Losses are computed from predictions by the master
+    if args.num_outputs > 1:
+        settings["num_outputs"] = args.num_outputs
+    if args.perturbation == constants.SHUFFLING:
+        settings.update({setting: getattr(args, setting) for setting in SHUFFLING_SETTINGS})
+    run_key = {"version": mihifepe.__version__, "data": hash_file(args.data_filename),
+               "model": [hash_file(filename) for filename in [args.model_generator_filename] + args.cache_extra_files],
+               "settings": settings}
+    return json.dumps(run_key, sort_keys=True)
+
+
+def get_index_key(node):
+    """Key identifying node by its index sets"""
+    return [sorted(int(idx) for idx in node.static_indices), sorted(int(idx) for idx in node.temporal_indices)]
+
+
+def get_node_key(args, node):
+    """Key identifying node's results: its index sets, and RNG seed for shuffling perturbations"""
+    node_key = get_index_key(node)
+    if args.perturbation == constants.SHUFFLING and (node.static_indices or node.temporal_indices):
+        node_key.append(int(node.rng_seed))  # Shuffling draws replacement values using the node's RNG
+    return node_key
+
+
+class Cache():
+    """Cache of perturbation results for the data, model and perturbation settings of a run"""
+
+    def __init__(self, args, logger):
+        self.args = args
+        self.logger = logger
+        if not os.path.exists(args.cache_dir):
+            os.makedirs(args.cache_dir)
+        logger.info("Cache: hashing data, model generator and settings")
+        self.run_key = get_run_key(args)
+
+    def get_filename(self, node):
+        """Cache entry filename for node"""
+        node_key = get_node_key(self.args, node)
+        digest = hashlib.sha256(("%s%s" % (self.run_key, json.dumps(node_key))).encode("utf-8")).hexdigest()
+        return "%s/%s.hdf5" % (self.args.cache_dir, digest)
+
+    def lookup(self, feature_nodes):
+        """
+        Look up cached results of nodes
+
+        Returns:
+            nodes not found in cache, Results for nodes found in cache (with targets from the data file)
+        """
+        remaining = []
+        losses, predictions, num_trials = {}, {}, {}
+        for node in feature_nodes:
+            filename = self.get_filename(node)
+            try:
+                with h5py.File(filename, "r") as root:
+                    losses[node.name] = root[constants.LOSSES][...]
+                    predictions[node.name] = root[constants.PREDICTIONS][...]
+                    if constants.NUM_TRIALS in root:
+                        num_trials[node.name] = root[constants.NUM_TRIALS][...]
+                os.utime(filename)  # Mark as recently used
+            except OSError:
+                remaining.append(node)
+        with h5py.File(self.args.data_filename, "r") as data_root:
+            targets = data_root[constants.TARGETS][...]
+        self.logger.info("Cache: found %d of %d nodes in %s" % (len(feature_nodes) - len(remaining), len(feature_nodes), self.args.cache_dir))
+        return remaining, Results(targets, losses, predictions, num_trials)
+
+    def store(self, feature_nodes, results):
+        """Store results of nodes, then evict least recently used entries exceeding the size limit"""
+        for node in feature_nodes:
+            filename = self.get_filename(node)
+            tmp_filename = "%s.tmp" % filename
+            with h5py.File(tmp_filename, "w") as root:
+                root.attrs[constants.NODE_NAME] = node.name
+                root.create_dataset(constants.LOSSES, data=results.losses[node.name])
+                root.create_dataset(constants.PREDICTIONS, data=results.predictions[node.name])
+                if node.name in results.num_trials:
+                    root.create_dataset(constants.NUM_TRIALS, data=results.num_trials[node.name])
+            os.replace(tmp_filename, filename)  # Concurrent runs never read partially written entries
+        evicted = evict(self.args.cache_dir, self.args.cache_size_limit * 2 ** 30)
+        if evicted:
+            self.logger.info("Cache: evicted %d least recently used entries" % evicted)
+
+
+def merge(cached_results, results):
+    """Merge cached results with results of remaining nodes"""
+    return Results(cached_results.targets, *[{**cached_outputs, **outputs}
+                                             for cached_outputs, outputs in zip(cached_results[1:], results[1:])])
+
+
+if __name__ == "__main__":
+    main()
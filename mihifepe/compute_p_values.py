@@ -1,11 +1,15 @@
 """Computes p-values for paired statistical tests over input vectors"""
 
+import math
+
 import numpy as np
 from numpy import asarray, compress, sqrt
-from scipy.stats import find_repeats, rankdata, norm, ttest_rel
 
 from mihifepe import constants
 
+# scipy.stats is slow to import, so it is imported only when computing p-values
+# pylint: disable = import-outside-toplevel
+
 
 def compute_p_value(baseline, perturbed, test=constants.WILCOXON_TEST, alternative=constants.LESS):
     """Compute p-value using paired difference test on input numpy arrays"""
@@ -13,11 +17,38 @@ def compute_p_value(baseline, perturbed, test=constants.WILCOXON_TEST, alternati
     assert test in valid_tests, "Invalid test name %s" % test
     if test == constants.PAIRED_TTEST:
         # Two-tailed paired t-test
+        from scipy.stats import ttest_rel
         return ttest_rel(baseline, perturbed)[1]
     # One-tailed Wilcoxon signed-rank test
     return wilcoxon_test(baseline, perturbed, alternative=alternative)
 
 
+def sign_test(baseline, perturbed):
+    """One-sided sign test of whether perturbed values exceed baseline values (zero differences are discarded)"""
+    from scipy.stats import binom
+    differences = perturbed - baseline
+    num_increased = np.sum(differences > 0)
+    num_changed = np.sum(differences != 0)
+    return binom.sf(num_increased - 1, num_changed, 0.5) if num_changed else 1.
+
+
+def sequential_p_value(baseline, perturbed, block_size):
+    """
+    p-value of group-sequential test (-sequential_testing), given losses over records in the order processed, where
+    losses of the perturbed feature are NaN for records not processed once its test stopped. This is the minimum
+    over the looks taken by the test - the sign test at each checkpoint reached, and the Wilcoxon test over all records
+    if the feature was never stopped - Bonferroni-adjusted for the number of possible looks, so that it remains valid
+    however the test stopped (unlike a p-value computed over the records used, as if their number were fixed).
+    """
+    num_records = len(baseline)
+    num_looks = math.ceil(num_records / block_size)  # Checkpoints after each block, and the end of the records
+    num_used = np.count_nonzero(~np.isnan(perturbed))
+    pvalues = [sign_test(baseline[:end], perturbed[:end]) for end in range(block_size, min(num_used, num_records - 1) + 1, block_size)]
+    if num_used == num_records:
+        pvalues.append(compute_p_value(baseline, perturbed))
+    return min(1., num_looks * min(pvalues))
+
+
 def wilcoxon_test(x, y, alternative):
     """
     One-sided Wilcoxon signed-rank test derived from Scipy's two-sided test
@@ -26,6 +57,7 @@ def wilcoxon_test(x, y, alternative):
     """
     # TODO: verify results identical to R's Wilcoxon test for a host of input values
     # pylint: disable = invalid-name, too-many-locals
+    from scipy.stats import find_repeats, rankdata, norm
     x, y = map(asarray, (x, y))
     d = x - y
 
@@ -62,3 +94,61 @@ def wilcoxon_test(x, y, alternative):
     if alternative == constants.GREATER:
         return norm.sf(z)
     return 2 * min(norm.cdf(z), norm.sf(z))  # two-sided
+
+
+def wilcoxon_test_batch(x, y, alternative):
+    """
+    Wilcoxon signed-rank test applied to each row of 2D arrays x and y, vectorized across rows
+    Returns vector of p-values, identical to those returned by wilcoxon_test applied row by row
+    """
+    # pylint: disable = invalid-name, too-many-locals
+    from scipy.stats import norm
+    d = np.asarray(x) - np.asarray(y)
+    num_rows, num_cols = d.shape
+    zeros = np.sum(d == 0, axis=1)  # zero differences are discarded, as in wilcoxon_test
+    count = num_cols - zeros
+
+    # Rank absolute differences within each row; zeros come first, so ranks of the remaining differences are offset by
+    # the number of zeros. Ties get average ranks (as with rankdata), computed from runs of equal values.
+    abs_d = abs(d)
+    order = np.argsort(abs_d, axis=1, kind="mergesort")
+    a = np.take_along_axis(abs_d, order, axis=1)
+    starts = np.ones(d.shape, dtype=bool)
+    starts[:, 1:] = a[:, 1:] != a[:, :-1]
+    starts = starts.ravel()
+    run_ids = np.cumsum(starts) - 1  # every row begins with a new run, so runs don't cross rows
+    run_starts = np.flatnonzero(starts)
+    run_sizes = np.diff(np.append(run_starts, starts.size))
+    sorted_ranks = (run_starts % num_cols + (run_sizes + 1) * 0.5)[run_ids].reshape(d.shape) - zeros[:, None]
+    r = np.empty(d.shape)
+    np.put_along_axis(r, order, sorted_ranks, axis=1)
+    T = np.sum((d > 0) * r, axis=1)
+
+    mn = count * (count + 1.) * 0.25
+    se = count * (count + 1.) * (2. * count + 1.)
+    degenerate = se < 1e-20
+
+    # Correction for repeated elements
+    run_values = a.ravel()[run_starts]
+    repnum = np.where(run_values != 0, run_sizes, 1)
+    se -= 0.5 * np.bincount(run_starts // num_cols, weights=repnum * (repnum * repnum - 1), minlength=num_rows)
+
+    se = sqrt(se / 24)
+    if alternative == constants.LESS:
+        correction = -0.5
+    elif alternative == constants.GREATER:
+        correction = 0.5
+    else:
+        correction = 0.5 * np.sign(T - mn)  # two-sided
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (T - mn - correction) / se
+
+    if alternative == constants.LESS:
+        pvalues = norm.cdf(z)
+    elif alternative == constants.GREATER:
+        pvalues = norm.sf(z)
+    else:
+        pvalues = 2 * np.minimum(norm.cdf(z), norm.sf(z))  # two-sided
+    pvalues[degenerate] = 1.  # Degenerate case
+    return pvalues
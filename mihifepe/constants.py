@@ -26,16 +26,49 @@ NORMAL_TERMINATION_FAILURE = "Normal termination (return value 1)"
 ABNORMAL_TERMINATION = "Abnormal termination"
 CLUSTER = "cluster"
 JOB_START_TIME = "job_start_time"
+TASK_IDX = "task_idx"
 VIRTUAL_ENV = "VIRTUAL_ENV"
 MEMORY_REQUIREMENT = "MEMORY_REQUIREMENT"
 SCRIPT_DIR = "SCRIPT_DIR"
 NORMAL_FAILURE_COUNT = "Normal failure count"
 MAX_NORMAL_FAILURE_COUNT = 5
 
+# Local worker daemons
+WORKER_DAEMON_SHUTDOWN_TIMEOUT = 60  # seconds
+
+# Auto-tuning
+TUNING_PROBE_FEATURES = 10  # Maximum number of features perturbed by probe
+TASK_MEMORY_OVERHEAD = 2 ** 29  # Bytes used by a worker process besides data, outputs and model
+TASK_MEMORY_SAFETY_FACTOR = 1.5
+
+# Metrics
+METRICS_FILENAME = "metrics.jsonl"
+
+# Profiling
+PROFILE_WORKERS_FILENAME = "profile_workers.prof"
+PROFILE_REPORT_FILENAME = "profile_report.txt"
+PROFILE_REPORT_LENGTH = 40  # Number of functions listed in report
+
+# Trace
+TRACE_SPANS_FILENAME = "trace_spans.jsonl"
+TRACE_FILENAME = "trace.json"
+
+# Progress
+HEARTBEAT_INTERVAL = 5  # Minimum seconds between heartbeats written by workers
+PROGRESS_INTERVAL = 30  # Minimum seconds between progress reports by master
+STATUS_FILENAME = "status.json"
+
+# Benchmarks
+BENCHMARKS_FILENAME = "benchmarks.json"
+
 # Evaluation
 EFFECT_SIZE = "effect_size"
 MEAN_LOSS = "mean_loss"
 PVALUE_LOSSES = "p-value-losses"
+NUM_RECORDS = "num_records"
+MEAN_NUM_TRIALS = "mean_num_trials"
+EFFECT_SIZE_STDERR = "effect_size_stderr"
+PRUNED = "pruned"
 PAIRED_TTEST = "paired-t-test"
 WILCOXON_TEST = "wilcoxon-test"
 PVALUES_FILENAME = "pvalues.csv"
@@ -47,10 +80,26 @@ TWOSIDED = "two-sided"
 INTERACTIONS_PVALUES_FILENAME = "interaction_pvalues.csv"
 DUMMY_ROOT = "dummy_root"
 INTERACTIONS_FDR_DIR = "interaction_fdr_results"
+CACHED_NODE_NAME = "cached_node_name"
+REDO_NODE_NAME = "redo_node_name"
+HIGHER_ORDER_INTERACTIONS_FILENAME = "higher_order_interactions.csv"
+INTERACTION_ORDER = "interaction_order"
+INTERACTIONS_FDR_ALPHA = 0.05
+INTERACTIONS_BATCH_SIZE = 2 ** 24  # Maximum number of prediction values processed at once when computing p-values
 
 # HDF5
 LOSSES = "losses"
 PREDICTIONS = "predictions"
+NUM_TRIALS = "num_trials"
+RECORD_INDICES = "record_indices"
+RUN_KEY = "run_key"
+
+# Incremental re-analysis
+INCREMENTAL_FILENAME = "node_results.hdf5"
+
+# Record sample
+RECORD_SAMPLE_FILENAME = "record_sample.hdf5"
+NUM_REGRESSION_STRATA = 10
 RECORD_IDS = "record_ids"
 TARGETS = "targets"
 STATIC = "static"
@@ -89,6 +138,7 @@ CONFIG_TRIAL = "config_run_simulations.ini"
 # Hierarchical FDR
 HIERARCHICAL_FDR_DIR = "hierarchical_fdr_results"
 HIERARCHICAL_FDR_OUTPUTS = "hierarchical_fdr_outputs"
+HIERARCHICAL_FDR_SWEEP = "hierarchical_fdr_sweep"
 ADJUSTED_PVALUE = "adjusted_p-value"
 REJECTED_STATUS = "rejected_status"
 # Dependence assumptions
@@ -98,12 +148,25 @@ ARBITRARY = "arbitrary"
 YEKUTIELI = "yekutieli"
 LYNCH_GUO = "lynch_guo"
 TREE = "tree"
+# Rendering
+RENDER_BACKGROUND = "background"
+RENDER_SYNC = "sync"
+RENDER_DEFERRED = "deferred"
 
 # Perturbation
 ZEROING = "zeroing"
 SHUFFLING = "shuffling"
 RNG_SEED = "rng_seed"
 
+# Losses computed from predictions
+SQUARED_ERROR = "squared_error"
+ABSOLUTE_ERROR = "absolute_error"
+LOG_LOSS = "log_loss"
+CROSS_ENTROPY = "cross_entropy"
+
+# Multi-output models
+OUTPUT_DIR_FORMAT = "output_%d"  # Subdirectory of output directory holding results for a single output (-per_output_pvalues)
+
 # Miscellaneous
 BASELINE = u"baseline"
 SEED = 13997
@@ -3,6 +3,8 @@
 
 import sys
 
+import numpy as np
+
 from mihifepe.constants import POSITIVE
 
 
@@ -71,7 +73,10 @@ def lynch_guo(args, logger, F, M):
 
 
 def yekutieli(args, logger, F, M):
-    """Yekutieli (2008) hierarchical FDR control procedure"""
+    """
+    Yekutieli (2008) hierarchical FDR control procedure
+    Families (children of rejected parents) at each depth are tested together using grouped array operations
+    """
     logger.info("Begin hierarchical FDR controlled hypothesis testing using Yekutieli (2008)")
     Rs = [0] * len(F)  # list of rejections at each level
     # Handle root
@@ -82,34 +87,87 @@ def yekutieli(args, logger, F, M):
         root.rejected = True
         Rs[0] = 1
     # Handle other (than root) nodes
-    for level in F:
-        for node in level:
-            # For each parent, test its child nodes as a family
-            if node.is_leaf or not node.rejected:
-                continue
-            family = sorted(node.children, key=lambda x: x.pvalue)
-            max_idx = 0
-            for idx, child in enumerate(family):
-                i = idx + 1
-                m = len(family)
-                child.adjusted_pvalue = m / i * child.pvalue
-                child.critical_constant = i * args.alpha / m
-                if child.pvalue <= child.critical_constant:
-                    max_idx = i
-            for idx in range(max_idx):
-                family[idx].rejected = True
-            Rs[node.depth + 1] += max_idx
-            for idx in reversed(range(m - 1)):
-                # Adjusted pvalues - see http://www.biostathandbook.com/multiplecomparisons.html
-                family[idx].adjusted_pvalue = min(family[idx].adjusted_pvalue, family[idx + 1].adjusted_pvalue)
+    for depth, level in enumerate(F[:-1]):
+        # For each parent, test its child nodes as a family
+        parents = [node for node in level if node.rejected and not node.is_leaf]
+        if not parents:
+            break  # No rejections at this depth, so no deeper families to test
+        Rs[depth + 1] = test_families(args, parents)
     # Sanity check
     for node in M:
-        if node.parent and node.rejected:
+        if node.rejected and node.parent:
             assert node.parent.rejected
     logger.info("End hierarchical FDR controlled hypothesis testing using Yekutieli (2008)")
     return Rs
 
 
+def test_families(args, parents):
+    """
+    Test the children of each parent as a family using the BH procedure, all families at once.
+    Sets critical constants, adjusted p-values and rejection status of the children; returns number of rejections.
+    """
+    families = [parent.children for parent in parents]
+    children = [child for family in families for child in family]
+    sizes = np.array([len(family) for family in families])
+    pvalues = np.fromiter((child.pvalue for child in children), dtype=float, count=len(children))
+    order, adjusted_pvalues, critical_constants, rejected = grouped_benjamini_hochberg(pvalues, sizes, args.alpha)
+    for idx, child_idx in enumerate(order):
+        child = children[child_idx]
+        child.adjusted_pvalue = float(adjusted_pvalues[idx])
+        child.critical_constant = float(critical_constants[idx])
+        child.rejected = bool(rejected[idx])
+    return int(rejected.sum())
+
+
+def benjamini_hochberg(pvalues, alpha):
+    """
+    BH procedure on vector of p-values
+    Returns adjusted p-values and rejection status, in the same order as the p-values
+    """
+    adjusted_pvalues = np.ones(len(pvalues))
+    rejected = np.zeros(len(pvalues), dtype=bool)
+    if len(pvalues) > 0:
+        order, sorted_adjusted_pvalues, _, sorted_rejected = grouped_benjamini_hochberg(pvalues, np.array([len(pvalues)]), alpha)
+        adjusted_pvalues[order] = sorted_adjusted_pvalues
+        rejected[order] = sorted_rejected
+    return adjusted_pvalues, rejected
+
+
+def grouped_benjamini_hochberg(pvalues, sizes, alpha):
+    """
+    BH procedure applied to each of a number of families at once, given the concatenated p-values of the families
+    and their sizes. Returns the indices that sort the p-values by (family, p-value), and the adjusted p-values,
+    critical constants and rejection status in that order.
+    """
+    starts = np.cumsum(sizes) - sizes  # index of first child of each family
+    groups = np.repeat(np.arange(len(sizes)), sizes)  # family of each child
+    # Sort by (family, p-value) - lexsort is stable, so ties retain the order of the children (as with sorted())
+    order = np.lexsort((pvalues, groups))
+    pvalues = pvalues[order]
+    m = sizes[groups]  # size of each child's family
+    i = np.arange(len(pvalues)) - starts[groups] + 1  # 1-indexed rank of each child within its family
+    adjusted_pvalues = m / i * pvalues
+    critical_constants = i * alpha / m
+    # Reject children up to the largest rank satisfying the BH condition within each family
+    max_ranks = np.maximum.reduceat(np.where(pvalues <= critical_constants, i, 0), starts)
+    rejected = i <= max_ranks[groups]
+    # Adjusted pvalues - see http://www.biostathandbook.com/multiplecomparisons.html
+    adjusted_pvalues = grouped_reverse_cummin(adjusted_pvalues, groups)
+    return order, adjusted_pvalues, critical_constants, rejected
+
+
+def grouped_reverse_cummin(values, groups):
+    """
+    Running minimum of values from the end of each group (groups must be contiguous and sorted).
+    Operates on the integer ranks of the values offset by group, so a single cumulative minimum over the
+    reversed array resets at group boundaries and returns the original values exactly.
+    """
+    uniques, ranks = np.unique(values, return_inverse=True)
+    offsets = groups * len(uniques)
+    keys = np.minimum.accumulate((offsets + ranks)[::-1])[::-1]
+    return uniques[keys - offsets]
+
+
 def alpha_star(args, node, r, total_rejected):
     """Alpha star"""
     if node.parent and not node.parent.rejected:
@@ -2,19 +2,27 @@
 
 import argparse
 import codecs
+import copy
 import csv
 import math
 import os
+import subprocess
+import threading
 
 import anytree
-from anytree.exporter import DotExporter
-from anytree.exporter import JsonExporter
 
 from mihifepe import constants, utils
 from mihifepe.fdr.fdr_algorithms import hierarchical_fdr_control
 
+# anytree exporters are slow to import, so they are imported where used
+# pylint: disable = import-outside-toplevel
+
 # pylint: disable = invalid-name
 
+# Daemon threads waiting on background graphviz processes (reaping them and logging failures). Callers running
+# FDR control in-process (e.g. the master) never wait on them; only the standalone command waits before exiting
+_render_threads = []
+
 
 def main():
     """Main"""
@@ -35,6 +43,18 @@ def main():
                         choices=[constants.ADJUSTED_PVALUE, constants.EFFECT_SIZE])
     parser.add_argument("-minimal_labels", help="do not write descriptions/effect sizes on node labels", action="store_true")
     parser.add_argument("-rectangle_leaves", help="enable to generate rectangular nodes for leaves of original hierarchy", action="store_true")
+    parser.add_argument("-render", help="how to render the tree of rejected hypotheses to PNG using Graphviz: '%s' (default) launches"
+                        " Graphviz in a background process (waited on before exiting, logging failures, only when run as a command),"
+                        " '%s' waits for Graphviz to complete, '%s' only writes the dot file, which may be rendered later using"
+                        " 'python -m mihifepe.fdr.render <output_dir>'"
+                        % (constants.RENDER_BACKGROUND, constants.RENDER_SYNC, constants.RENDER_DEFERRED),
+                        default=constants.RENDER_BACKGROUND, choices=[constants.RENDER_BACKGROUND, constants.RENDER_SYNC, constants.RENDER_DEFERRED])
+    parser.add_argument("-max_rendered_nodes", help="node budget for the rendered tree; subtrees beyond the budget (in level order)"
+                        " are collapsed into summary nodes. The text rendering of the tree is not affected", type=int, default=500)
+    parser.add_argument("-sweep_alphas", help="sweep mode: evaluate all given alpha levels (in combination with -sweep_procedures)"
+                        " over a single tree, writing the rejection status for each configuration to one CSV", nargs="+", type=float)
+    parser.add_argument("-sweep_procedures", help="sweep mode: evaluate all given procedures (in combination with -sweep_alphas)",
+                        nargs="+", choices=[constants.YEKUTIELI, constants.LYNCH_GUO])
     args = parser.parse_args()
 
     if not args.output_dir:
@@ -48,16 +68,49 @@ def main():
 
     tree = build_tree(args, logger)
     F, M = process_tree(logger, tree)
-    hierarchical_fdr_control(args, logger, F, M)
-    write_outputs(args, logger, tree)
+    if args.sweep_alphas or args.sweep_procedures:
+        sweep(args, logger, F, M)
+    else:
+        hierarchical_fdr_control(args, logger, F, M)
+        write_outputs(args, logger, tree)
     logger.info("End hierarchical_fdr_control")
 
 
+def sweep(args, logger, F, M):
+    """
+    Evaluate every combination of procedure and alpha on the same processed tree,
+    writing the rejection status of each node under each configuration as a column of a single CSV
+    """
+    logger.info("Begin hierarchical FDR sweep")
+    procedures = args.sweep_procedures or [args.procedure]
+    alphas = args.sweep_alphas or [args.alpha]
+    header = [constants.NODE_NAME, constants.PARENT_NAME, constants.PVALUE_LOSSES]
+    columns = []
+    for procedure in procedures:
+        for alpha in alphas:
+            logger.info("Sweep configuration: procedure %s, alpha %g" % (procedure, alpha))
+            sargs = copy.copy(args)
+            sargs.procedure = procedure
+            sargs.alpha = alpha
+            reset_tree(M)
+            hierarchical_fdr_control(sargs, logger, F, M)
+            header.append("%s_%s_alpha_%g" % (constants.REJECTED_STATUS, procedure, alpha))
+            columns.append([int(node.rejected) for node in M])
+    with open("%s/%s.csv" % (args.output_dir, constants.HIERARCHICAL_FDR_SWEEP), "w", newline="") as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(header)
+        for idx, node in enumerate(M):
+            parent_name = node.parent.name if node.parent else ""
+            writer.writerow([node.name, parent_name, node.pvalue] + [column[idx] for column in columns])
+    logger.info("End hierarchical FDR sweep")
+
+
 def write_outputs(args, logger, tree):
     """Write outputs"""
     logger.info("Begin writing outputs")
     # Export JSON using anytree
     with open("%s/%s.json" % (args.output_dir, constants.HIERARCHICAL_FDR_OUTPUTS), "w") as output_file:
+        from anytree.exporter import JsonExporter
         JsonExporter(indent=2).write(tree, output_file)
     # Write CSV with additional column for rejected or not
     with open("%s/%s.csv" % (args.output_dir, constants.HIERARCHICAL_FDR_OUTPUTS), "w", newline="") as output_file:
@@ -88,23 +141,93 @@ def generate_tree_of_rejected_hypotheses(args, logger, tree):
             nodes[newnode.name] = newnode
     newtree = next(iter(nodes.values())).root  # identify root
     prune_tree_on_effect_size(args, newtree)
+    render_text(args, newtree)
+    collapse_tree(args, logger, newtree)
     color_nodes(args, newtree)
-    render_tree(args, newtree)
+    render_tree(args, logger, newtree)
 
 
-def render_tree(args, tree):
-    """Render tree in ASCII and graphviz"""
+def render_text(args, tree):
+    """Render tree in ASCII"""
     with codecs.open("{0}/{1}.txt".format(args.output_dir, constants.TREE), "w", encoding="utf8") as txt_file:
         for pre, _, node in anytree.RenderTree(tree):
             txt_file.write("%s%s: %s (%s: %s)\n" % (pre, node.name, node.description.title(), args.effect_name, str(node.effect_size)))
+
+
+def render_tree(args, logger, tree):
+    """Render tree in graphviz - the dot file is written immediately, the picture depending on the render option"""
     graph_options = []  # Example: graph_options = ["dpi=300.0;", "style=filled;", "bgcolor=yellow;"]
-    DotExporter(tree, options=graph_options, nodeattrfunc=lambda node: nodeattrfunc(args, node)
-                ).to_dotfile("{0}/{1}.dot".format(args.output_dir, constants.TREE))
+    dot_filename = "{0}/{1}.dot".format(args.output_dir, constants.TREE)
+    from anytree.exporter import DotExporter
+    DotExporter(tree, options=graph_options, nodeattrfunc=lambda node: nodeattrfunc(args, node)).to_dotfile(dot_filename)
+    if args.render == constants.RENDER_DEFERRED:
+        logger.info("Deferred rendering of %s; run 'python -m mihifepe.fdr.render %s' to render" % (dot_filename, args.output_dir))
+        return
+    render_picture(logger, dot_filename, background=(args.render == constants.RENDER_BACKGROUND))
+
+
+def render_picture(logger, dot_filename, background=False):
+    """
+    Render dot file to PNG using graphviz, optionally in a background process that is waited on by a separate
+    daemon thread, which logs failures (see wait_for_renders)
+    """
+    png_filename = "%s.png" % os.path.splitext(dot_filename)[0]
+    cmd = ["dot", dot_filename, "-T", "png", "-o", png_filename]
+    logger.info("Running cmd%s: %s" % (" in background" if background else "", " ".join(cmd)))
+    if not background:
+        try:
+            subprocess.check_call(cmd)
+        except FileNotFoundError:
+            raise FileNotFoundError("Error during tree rendering - is Graphviz installed on your system?\n")
+        return
     try:
-        DotExporter(tree, options=graph_options, nodeattrfunc=lambda node: nodeattrfunc(args, node)
-                    ).to_picture("{0}/{1}.png".format(args.output_dir, constants.TREE))
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True)
     except FileNotFoundError:
-        raise FileNotFoundError("Error during tree rendering - is Graphviz installed on your system?\n")
+        logger.warn("Graphviz not found, skipping rendering of %s - is Graphviz installed on your system?" % dot_filename)
+        return
+    thread = threading.Thread(target=wait_for_render, args=(logger, process, dot_filename), daemon=True)
+    thread.start()
+    _render_threads[:] = [render_thread for render_thread in _render_threads if render_thread.is_alive()] + [thread]
+
+
+def wait_for_render(logger, process, dot_filename):
+    """Wait for background graphviz process, logging failure"""
+    _, stderr = process.communicate()
+    if process.returncode:
+        logger.error("Rendering of %s failed with exit code %d: %s"
+                     % (dot_filename, process.returncode, stderr.decode("utf-8", errors="replace").strip()))
+
+
+def wait_for_renders():
+    """Wait for all background graphviz processes to complete"""
+    while _render_threads:
+        _render_threads.pop().join()
+
+
+def collapse_tree(args, logger, tree):
+    """
+    Collapse subtrees beyond the node budget (in level order) to keep the rendered tree tractable.
+    Each collapsed set of children is replaced by a single summary node under their parent.
+    """
+    nodes = list(anytree.LevelOrderIter(tree))
+    if len(nodes) <= args.max_rendered_nodes:
+        return
+    logger.info("Tree has %d nodes, collapsing subtrees beyond the rendering budget of %d nodes" % (len(nodes), args.max_rendered_nodes))
+    kept = set(nodes[:max(1, args.max_rendered_nodes)])
+    for node in nodes:
+        if node not in kept:
+            continue
+        collapsed = [child for child in node.children if child not in kept]
+        if not collapsed:
+            continue
+        descendants = [descendant for child in collapsed for descendant in anytree.PreOrderIter(child)]
+        effect_sizes = [descendant.effect_size for descendant in descendants if descendant.effect_size != ""]
+        for child in collapsed:
+            child.parent = None
+        anytree.Node("%s: %d more" % (node.name, len(descendants)), parent=node,
+                     adjusted_pvalue=min([descendant.adjusted_pvalue for descendant in descendants]),
+                     description="%d collapsed nodes" % len(descendants), effect_size=max(effect_sizes) if effect_sizes else "",
+                     was_leaf=False)
 
 
 def prune_tree_on_effect_size(args, tree):
@@ -218,9 +341,6 @@ def process_tree(logger, tree):
             node.G_j_cardinality = len(level)  # number of nodes in tree upto and including this level
             if node.parent:
                 node.G_j_cardinality += node.parent.G_j_cardinality
-            node.rejected = False  # no hypothesis rejected to start with
-            node.critical_constant = 0.  # populated later
-            node.adjusted_pvalue = 1.  # populated later
     for level in reversed(F):
         # Iterate over tree bottom-up to identify l (number of leaves) and m (number of hypotheses) for each node
         for node in level:
@@ -229,9 +349,19 @@ def process_tree(logger, tree):
             if not node.is_leaf:
                 node.l = sum([child.l for child in node.children])  # noqa: E741
                 node.m = 1 + sum([child.m for child in node.children])
+    reset_tree(M)
     logger.info("End processing tree")
     return F, M
 
 
+def reset_tree(M):
+    """Reset testing outcomes of all hypotheses, allowing the processed tree to be tested again"""
+    for node in M:
+        node.rejected = False  # no hypothesis rejected to start with
+        node.critical_constant = 0.  # populated later
+        node.adjusted_pvalue = 1.  # populated later
+
+
 if __name__ == "__main__":
     main()
+    wait_for_renders()
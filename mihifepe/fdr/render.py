@@ -0,0 +1,20 @@
+"""Render tree of rejected hypotheses written by hierarchical FDR control (when rendering was deferred)"""
+
+import argparse
+
+from mihifepe import constants, utils
+from mihifepe.fdr.hierarchical_fdr_control import render_picture
+
+
+def main():
+    """Main"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir", help="output directory of hierarchical FDR control containing the tree's dot file")
+    args = parser.parse_args()
+
+    logger = utils.get_logger(__name__, "%s/render.log" % args.output_dir)
+    render_picture(logger, "%s/%s.dot" % (args.output_dir, constants.TREE))
+
+
+if __name__ == "__main__":
+    main()
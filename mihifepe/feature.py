@@ -1,4 +1,6 @@
 """Feature class"""
+from collections import namedtuple
+
 import anytree
 import cityhash
 import numpy as np
@@ -28,9 +30,12 @@ class Feature(anytree.Node):
         """Set RNG seed"""
         self._rng_seed = seed
 
-    def initialize_rng(self):
-        """Initialize random number generator for feature (used for shuffling perturbations)"""
-        self.rng = np.random.RandomState(self._rng_seed)
+    def initialize_rng(self, record_idx):
+        """
+        Initialize random number generator for feature and record (used for shuffling perturbations).
+        Keying the stream by record index makes it independent of how records are partitioned across workers.
+        """
+        self.rng = np.random.default_rng([self._rng_seed, record_idx])
 
     def uniquify(self, uniquifier):
         """Add uniquifying identifier to name"""
@@ -53,3 +58,26 @@ class Feature(anytree.Node):
     def size(feature):
         """Returns'size' of feature"""
         return len(feature.static_indices) + len(feature.temporal_indices)
+
+
+class InteractionPair(namedtuple("InteractionPair", ["name", "cached", "redo", "rng_seed"])):
+    """
+    Compact representation of pair of features tested for interaction: references to the cached and redo features
+    and the RNG seed to perturb them with. Workers expand it into the features to perturb.
+    """
+    __slots__ = ()
+
+    @property
+    def redo_name(self):
+        """Name of redo feature when perturbed along with the pair (for shuffling perturbations)"""
+        return "{0}->{1}".format(self.name, self.redo.name)
+
+    def get_features(self, perturbation):
+        """Features to perturb for pair: the pair itself and, for shuffling perturbations, the redo feature"""
+        features = [Feature(self.name, rng_seed=self.rng_seed,
+                            static_indices=self.cached.static_indices + self.redo.static_indices,
+                            temporal_indices=self.cached.temporal_indices + self.redo.temporal_indices)]
+        if perturbation == constants.SHUFFLING:
+            features.append(Feature(self.redo_name, rng_seed=self.rng_seed, static_indices=self.redo.static_indices,
+                                    temporal_indices=self.redo.temporal_indices))
+        return features
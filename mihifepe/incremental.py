@@ -0,0 +1,71 @@
+"""
+Incremental re-analysis (-incremental) after changes to the hierarchy: results of nodes are stored by their index sets,
+so that a subsequent run over a changed hierarchy (e.g. regrouped features, or added intermediate levels) only perturbs
+nodes whose index sets are new, however the nodes are named. Under shuffling perturbations, nodes are also identified by their
+RNG seeds (derived from their names), so that results are identical to those of a run from scratch.
+"""
+
+import hashlib
+import json
+import os
+
+import h5py
+
+from mihifepe import constants
+from mihifepe.cache import get_node_key, get_run_key
+from mihifepe.pipelines import Results
+
+
+def get_dataset_name(args, node):
+    """Name of datasets holding results of node, identifying it by its index sets (and RNG seed, for shuffling perturbations)"""
+    return hashlib.sha256(json.dumps(get_node_key(args, node)).encode("utf-8")).hexdigest()
+
+
+def load_previous_results(args, logger, feature_nodes):
+    """
+    Look up results of nodes, by their index sets, stored by the previous run in the output directory
+
+    Returns:
+        nodes without previous results, Results for nodes with previous results (named as in the current hierarchy)
+    """
+    filename = "%s/%s" % (args.output_dir, constants.INCREMENTAL_FILENAME)
+    if not os.path.exists(filename):
+        logger.info("Incremental: no results stored by previous run in %s, perturbing all nodes" % filename)
+        return feature_nodes, None
+    remaining = []
+    outputs = ({}, {}, {})
+    with h5py.File(filename, "r") as root:
+        if root.attrs[constants.RUN_KEY] != get_run_key(args):
+            logger.warning("Incremental: data, model or perturbation settings changed since previous run, perturbing all nodes")
+            return feature_nodes, None
+        for node in feature_nodes:
+            dataset_name = get_dataset_name(args, node)
+            if dataset_name not in root[constants.LOSSES]:
+                remaining.append(node)
+                continue
+            for group_name, group_outputs in zip((constants.LOSSES, constants.PREDICTIONS, constants.NUM_TRIALS), outputs):
+                if group_name in root and dataset_name in root[group_name]:
+                    group_outputs[node.name] = root[group_name][dataset_name][...]
+        targets = root[constants.TARGETS][...]
+    logger.info("Incremental: reusing results of %d of %d nodes with index sets unchanged since previous run"
+                % (len(feature_nodes) - len(remaining), len(feature_nodes)))
+    return remaining, Results(targets, *outputs)
+
+
+def save_results(args, logger, feature_nodes, results):
+    """Store results of nodes by their index sets in the output directory, for subsequent incremental runs"""
+    filename = "%s/%s" % (args.output_dir, constants.INCREMENTAL_FILENAME)
+    tmp_filename = "%s.tmp" % filename
+    with h5py.File(tmp_filename, "w") as root:
+        root.attrs[constants.RUN_KEY] = get_run_key(args)
+        root.create_dataset(constants.TARGETS, data=results.targets)
+        groups = [root.create_group(group_name) for group_name in (constants.LOSSES, constants.PREDICTIONS, constants.NUM_TRIALS)]
+        for node in feature_nodes:
+            dataset_name = get_dataset_name(args, node)
+            if node.name not in results.losses or dataset_name in groups[0]:
+                continue  # Pruned by screening, or same key as another node
+            for group, group_outputs in zip(groups, results[1:]):
+                if node.name in group_outputs:
+                    group.create_dataset(dataset_name, data=group_outputs[node.name])
+    os.replace(tmp_filename, filename)
+    logger.info("Incremental: stored results of nodes by index sets in %s" % filename)
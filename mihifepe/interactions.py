@@ -1,21 +1,19 @@
 """Tests pairwise interactions given output of mihifepe"""
 
-import copy
 import csv
 import itertools
-import sys
+import os
 import time
-from unittest.mock import patch
 
 import anytree
 from anytree.importer import JsonImporter
 import numpy as np
 
-from mihifepe.compute_p_values import compute_p_value
+from mihifepe.compute_p_values import wilcoxon_test_batch
 from mihifepe import constants
-from mihifepe.fdr import hierarchical_fdr_control
-from mihifepe.feature import Feature
-from mihifepe.pipelines import CondorPipeline, SerialPipeline, round_vector
+from mihifepe.fdr.fdr_algorithms import benjamini_hochberg
+from mihifepe.feature import Feature, InteractionPair
+from mihifepe.pipelines import CondorPipeline, LocalPipeline, SerialPipeline, round_vector
 
 
 def analyze_interactions(args, logger, feature_nodes, cached_predictions):
@@ -27,91 +25,345 @@ def analyze_interactions(args, logger, feature_nodes, cached_predictions):
     relevant_feature_nodes = get_relevant_features(args, feature_nodes)
     # Identify potential interactions to test
     potential_interactions = itertools.combinations(relevant_feature_nodes, 2)
+    if args.interaction_screening_num_pairs or args.interaction_model_call_budget:
+        # Test only the most promising pairs
+        potential_interactions = screen_interactions(args, logger, relevant_feature_nodes, cached_predictions)
     # TODO: Remove interactions already tested
-    # Transform into nodes for testing
-    interaction_groups = get_interaction_groups(args, potential_interactions)
-    # Perturb interaction nodes
-    interaction_predictions = perturb_interactions(args, logger, interaction_groups)
+    # Transform into pairs for testing
+    interaction_pairs = get_interaction_pairs(potential_interactions)
+    # Perturb interaction pairs
+    interaction_predictions = perturb_interactions(args, logger, interaction_pairs) if interaction_pairs else {}
     # Compute p-values
-    compute_p_values(args, interaction_groups, interaction_predictions, cached_predictions)
+    pvalues = compute_p_values(args, interaction_pairs, interaction_predictions, cached_predictions)
     # Perform BH procedure on interaction p-values
-    bh_procedure(args, logger)
+    bh_procedure(args, logger, [pair.name for pair in interaction_pairs], pvalues)
+    if args.interaction_order > 2:
+        # Search for higher-order interactions among features participating in pairwise interactions
+        analyze_higher_order_interactions(args, logger, interaction_pairs, interaction_predictions, cached_predictions)
     logger.info("End analyzing interactions")
 
 
-def bh_procedure(args, logger):
-    """Performs BH procedure on interaction p-values"""
-    # TODO: Directly use BH procedure
-    input_filename = "%s/%s" % (args.output_dir, constants.INTERACTIONS_PVALUES_FILENAME)
-    output_dir = "%s/%s" % (args.output_dir, constants.INTERACTIONS_FDR_DIR)
-    cmd = ("python -m mihifepe.fdr.hierarchical_fdr_control -output_dir %s -procedure yekutieli "
-           "-rectangle_leaves %s" % (output_dir, input_filename))
-    logger.info("Running cmd: %s" % cmd)
-    pass_args = cmd.split()[2:]
-    with patch.object(sys, 'argv', pass_args):
-        hierarchical_fdr_control.main()
+def get_interaction_filenames(args, order=2):
+    """Returns p-values filename and FDR output directory for interactions of given order"""
+    pvalues_filename = constants.INTERACTIONS_PVALUES_FILENAME
+    fdr_dir = constants.INTERACTIONS_FDR_DIR
+    if order > 2:
+        root, ext = os.path.splitext(pvalues_filename)
+        pvalues_filename = "%s_order_%d%s" % (root, order, ext)
+        fdr_dir = "%s_order_%d" % (fdr_dir, order)
+    return "%s/%s" % (args.output_dir, pvalues_filename), "%s/%s" % (args.output_dir, fdr_dir)
 
 
-def compute_p_values(args, interaction_groups, interaction_predictions, cached_predictions):
+def bh_procedure(args, logger, names, pvalues, order=2):
+    """
+    Performs BH procedure on interaction p-values.
+    Results are written in the format output by hierarchical FDR control, as applied to a two-level hierarchy
+    with a dummy root node and the interactions as its children.
+    """
+    _, output_dir = get_interaction_filenames(args, order)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    pvalues = np.where(np.isnan(pvalues), 1., pvalues)
+    adjusted_pvalues, rejected = benjamini_hochberg(pvalues, constants.INTERACTIONS_FDR_ALPHA)
+    logger.info("BH procedure: %d of %d interactions of order %d rejected" % (np.sum(rejected), len(names), order))
+    with open("%s/%s.csv" % (output_dir, constants.HIERARCHICAL_FDR_OUTPUTS), "w", newline="") as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow([constants.NODE_NAME, constants.PARENT_NAME, constants.PVALUE_LOSSES, constants.REJECTED_STATUS, constants.ADJUSTED_PVALUE])
+        writer.writerow([constants.DUMMY_ROOT, "", 0., 1, 0.])
+        for idx, name in enumerate(names):
+            writer.writerow([name, constants.DUMMY_ROOT, float(pvalues[idx]), int(rejected[idx]), float(adjusted_pvalues[idx])])
+
+
+def compute_p_values(args, interaction_pairs, interaction_predictions, cached_predictions):
     """Computes p-values for assessing interaction significance"""
     # TODO: handle non-identity transfer function
-    outfile = open("%s/%s" % (args.output_dir, constants.INTERACTIONS_PVALUES_FILENAME), "w", newline="")
+    baseline_prediction = cached_predictions[constants.BASELINE]
+
+    def get_terms(start, end):
+        """Predictions with both features of each pair perturbed, and their expected values in the absence of interaction"""
+        pairs = interaction_pairs[start:end]
+        if args.perturbation == constants.SHUFFLING:
+            redo_predictions = np.array([interaction_predictions[pair.redo_name] for pair in pairs])
+        else:
+            redo_predictions = np.array([cached_predictions[pair.redo.name] for pair in pairs])
+        lhs = np.array([interaction_predictions[pair.name] for pair in pairs])
+        rhs = np.array([cached_predictions[pair.cached.name] for pair in pairs]) + redo_predictions - baseline_prediction
+        return lhs, rhs
+
+    names = [pair.name for pair in interaction_pairs]
+    return write_p_values(get_interaction_filenames(args)[0], names, get_terms, len(baseline_prediction))
+
+
+def write_p_values(filename, names, get_terms, num_records):
+    """
+    Computes interaction p-values and writes them to file, processing interactions in batches.
+    get_terms(start, end) returns matrices lhs and rhs for interactions names[start:end], where each row of lhs
+    is the vector of predictions with all features of the interaction perturbed and the corresponding row of rhs
+    is its expected value in the absence of interaction. Returns vector of p-values.
+    """
+    pvalues = np.ones(len(names))
+    batch_size = max(1, constants.INTERACTIONS_BATCH_SIZE // max(1, num_records))
+    outfile = open(filename, "w", newline="")
     writer = csv.writer(outfile, delimiter=",")
-    # Construct two-level hierarchy with dummy root node and interactions as its children
-    # Leverages existing hierarchical FDR code to perform BH procedure on interactions
-    # TODO: Directly use BH procedure, maybe?
+    # Two-level hierarchy with dummy root node and interactions as its children, allowing the hierarchical FDR code
+    # to be run on the file
     # TODO: Since we're using outputs and not losses here, the p-values schema is misleading
     writer.writerow([constants.NODE_NAME, constants.PARENT_NAME, constants.DESCRIPTION, constants.EFFECT_SIZE,
                      constants.MEAN_LOSS, constants.PVALUE_LOSSES])
     writer.writerow([constants.DUMMY_ROOT, "", "", "", "", 0.])
-    baseline_prediction = cached_predictions[constants.BASELINE]
-    redo_predictions = interaction_predictions if args.perturbation == constants.SHUFFLING else cached_predictions
-    for cached_node, redo_node, parent_node in interaction_groups:
-        lhs = round_vector(interaction_predictions[parent_node.name])
-        rhs = round_vector(cached_predictions[cached_node.name] + redo_predictions[redo_node.name] - baseline_prediction)
-        pvalue = compute_p_value(lhs, rhs, alternative=constants.TWOSIDED)
-        effect_size = np.mean(lhs - rhs)  # TODO: confirm sign
+    for start in range(0, len(names), batch_size):
+        end = min(start + batch_size, len(names))
+        lhs, rhs = get_terms(start, end)
+        lhs = round_vector(lhs)
+        rhs = round_vector(rhs)
+        pvalues[start:end] = wilcoxon_test_batch(lhs, rhs, alternative=constants.TWOSIDED)
+        effect_sizes = np.mean(lhs - rhs, axis=1)  # TODO: confirm sign
         # TODO: Add description?
-        writer.writerow([parent_node.name, constants.DUMMY_ROOT, "", effect_size, "", pvalue])
+        writer.writerows([[names[idx], constants.DUMMY_ROOT, "", effect_sizes[idx - start], "", pvalues[idx]]
+                          for idx in range(start, end)])
     outfile.close()
+    return pvalues
 
 
-def perturb_interactions(args, logger, interaction_groups):
+def perturb_interactions(args, logger, interaction_pairs):
     """Perturb interactions, observe effect on model loss and aggregate results"""
     logger.info("Begin perturbing interactions")
-    interaction_nodes = []
-    for _, redo_node, parent_node in interaction_groups:
-        interaction_nodes.append(parent_node)
-        if args.perturbation == constants.SHUFFLING:
-            interaction_nodes.append(redo_node)
-    worker_pipeline = SerialPipeline(args, logger, interaction_nodes)
+    if interaction_pairs and isinstance(interaction_pairs[0], InteractionPair):
+        # Pairs sharing a cached feature are assigned to the same workers, allowing their perturbations to be batched
+        interaction_pairs = sorted(interaction_pairs, key=lambda pair: pair.cached.name)
+    worker_pipeline = SerialPipeline(args, logger, interaction_pairs)
     if args.condor:
-        worker_pipeline = CondorPipeline(args, logger, interaction_nodes)
-    _, _, interaction_predictions = worker_pipeline.run()
+        worker_pipeline = CondorPipeline(args, logger, interaction_pairs)
+    elif args.local_workers:
+        worker_pipeline = LocalPipeline(args, logger, interaction_pairs)
+    interaction_predictions = worker_pipeline.run().predictions
     logger.info("End perturbing interactions")
     return interaction_predictions
 
 
-def get_interaction_groups(args, potential_interactions):
-    """Transform into nodes for testing"""
-    interaction_groups = []
+def analyze_higher_order_interactions(args, logger, interaction_pairs, interaction_predictions, cached_predictions):
+    """
+    Search for interactions of order up to -interaction_order, walking the lattice of feature sets level by level.
+    As in the Apriori algorithm, a set of k features is tested only if all its subsets of k-1 features were identified
+    as interactions at the previous level. The BH procedure is performed separately on each level, so the FDR is
+    controlled among the interactions reported at each order, but not over the union of interactions of all orders
+    (whose FDR may exceed the level by up to a factor of the number of orders tested).
+
+    The interaction effect of set S is the inclusion-exclusion sum over its subsets T of (-1)^(|S|-|T|) f(T),
+    where f(T) is the prediction with the features in T perturbed. For zeroing perturbations, predictions for subsets
+    are reused from previous levels; for shuffling perturbations, subsets are perturbed again using the same RNG seed.
+    """
+    logger.info("Begin analyzing higher-order interactions")
+    nodes = {}
+    names = {frozenset(): constants.BASELINE}
+    predictions = {frozenset(): cached_predictions[constants.BASELINE]}
+    for pair in interaction_pairs:
+        for node in (pair.cached, pair.redo):
+            key = frozenset([node.name])
+            nodes[node.name] = node
+            names[key] = node.name
+            predictions[key] = cached_predictions[node.name]
+        key = frozenset([pair.cached.name, pair.redo.name])
+        names[key] = pair.name
+        predictions[key] = interaction_predictions[pair.name]
+    results = read_interaction_results(args, 2, names)
+    found = [(2, key, result) for key, result in results.items() if result[constants.REJECTED_STATUS]]
+    for order in range(3, args.interaction_order + 1):
+        rejected = {key: result for key, result in results.items() if result[constants.REJECTED_STATUS]}
+        candidates = get_higher_order_candidates(args, logger, order, rejected)
+        if not candidates:
+            logger.info("No candidate interactions of order %d, ending search" % order)
+            break
+        for candidate in candidates:
+            names[candidate] = " + ".join(sorted(candidate))
+        level_predictions = perturb_interactions(args, logger, get_higher_order_features(args, candidates, nodes, names))
+        for candidate in candidates:
+            predictions[candidate] = level_predictions[names[candidate]]
+
+        def get_terms(start, end, order=order, candidates=candidates, level_predictions=level_predictions):
+            """Predictions with all features of each candidate perturbed, and their expected values in the absence of interaction"""
+            lhs = np.array([predictions[candidate] for candidate in candidates[start:end]])
+            rhs = np.zeros(lhs.shape)
+            for idx, candidate in enumerate(candidates[start:end]):
+                anchor = get_anchor(candidate, nodes)
+                for size in range(order):
+                    sign = (-1) ** (order - size + 1)
+                    for subset in itertools.combinations(sorted(candidate), size):
+                        subset = frozenset(subset)
+                        if args.perturbation == constants.SHUFFLING and size and subset != {anchor}:
+                            prediction = level_predictions["{0}->{1}".format(names[candidate], " + ".join(sorted(subset)))]
+                        else:
+                            prediction = predictions[subset]
+                        rhs[idx] += sign * prediction
+            return lhs, rhs
+
+        level_names = [names[candidate] for candidate in candidates]
+        pvalues = write_p_values(get_interaction_filenames(args, order)[0], level_names, get_terms, len(predictions[frozenset()]))
+        bh_procedure(args, logger, level_names, pvalues, order)
+        results = read_interaction_results(args, order, names)
+        found.extend([(order, key, result) for key, result in results.items() if result[constants.REJECTED_STATUS]])
+    write_higher_order_interactions(args, found, names)
+    logger.info("FDR controlled at level %g separately for each order of interactions, not over interactions of all orders"
+                % constants.INTERACTIONS_FDR_ALPHA)
+    logger.info("End analyzing higher-order interactions")
+
+
+def get_higher_order_candidates(args, logger, order, rejected):
+    """
+    Candidate interactions of given order: sets of features all of whose subsets of order - 1 features were identified
+    as interactions. If there are more than -max_interaction_candidates candidates, the ones whose least significant
+    subset has the smallest p-value are retained
+    """
+    candidates = set()
+    for left, right in itertools.combinations(rejected, 2):
+        union = left | right
+        if len(union) == order and union not in candidates:
+            if all(union - {name} in rejected for name in union):
+                candidates.add(union)
+    candidates = sorted(candidates, key=lambda candidate: (max(rejected[candidate - {name}][constants.PVALUE_LOSSES]
+                                                               for name in candidate), sorted(candidate)))
+    if args.max_interaction_candidates and len(candidates) > args.max_interaction_candidates:
+        logger.info("Pruned %d candidate interactions of order %d, testing %d"
+                    % (len(candidates) - args.max_interaction_candidates, order, args.max_interaction_candidates))
+        candidates = candidates[:args.max_interaction_candidates]
+    return candidates
+
+
+def get_anchor(candidate, nodes):
+    """Returns name of largest feature in candidate interaction, whose RNG seed is used to perturb the interaction"""
+    return max(sorted(candidate), key=lambda name: Feature.size(nodes[name]))
+
+
+def get_higher_order_features(args, candidates, nodes, names):
+    """
+    Features to perturb for candidate interactions: the interaction itself and, for shuffling perturbations,
+    its non-empty proper subsets other than the anchor feature (whose cached predictions are reused)
+    """
+    features = []
+    for candidate in candidates:
+        anchor = get_anchor(candidate, nodes)
+        subsets = [(names[candidate], candidate)]
+        if args.perturbation == constants.SHUFFLING:
+            for size in range(1, len(candidate)):
+                for subset in itertools.combinations(sorted(candidate), size):
+                    if subset != (anchor,):
+                        subsets.append(("{0}->{1}".format(names[candidate], " + ".join(subset)), subset))
+        for name, subset in subsets:
+            members = [nodes[member] for member in sorted(subset)]
+            features.append(Feature(name, rng_seed=nodes[anchor].rng_seed,
+                                    static_indices=[idx for member in members for idx in member.static_indices],
+                                    temporal_indices=[idx for member in members for idx in member.temporal_indices]))
+    return features
+
+
+def read_interaction_results(args, order, names):
+    """Reads p-values, adjusted p-values and rejected status of interactions of given order from BH procedure output"""
+    keys = {name: key for key, name in names.items() if len(key) == order}
+    results = {}
+    with open("%s/%s.csv" % (get_interaction_filenames(args, order)[1], constants.HIERARCHICAL_FDR_OUTPUTS), "r") as results_file:
+        for row in csv.DictReader(results_file):
+            if row[constants.NODE_NAME] == constants.DUMMY_ROOT:
+                continue
+            results[keys[row[constants.NODE_NAME]]] = {constants.PVALUE_LOSSES: float(row[constants.PVALUE_LOSSES]),
+                                                       constants.ADJUSTED_PVALUE: float(row[constants.ADJUSTED_PVALUE]),
+                                                       constants.REJECTED_STATUS: int(row[constants.REJECTED_STATUS])}
+    return results
+
+
+def write_higher_order_interactions(args, found, names):
+    """
+    Writes interactions of all orders identified by the BH procedure on their respective levels
+    (with adjusted p-values relative to the other interactions of the same order)
+    """
+    with open("%s/%s" % (args.output_dir, constants.HIGHER_ORDER_INTERACTIONS_FILENAME), "w", newline="") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow([constants.NODE_NAME, constants.INTERACTION_ORDER, constants.PVALUE_LOSSES, constants.ADJUSTED_PVALUE])
+        for order, key, result in found:
+            writer.writerow([names[key], order, result[constants.PVALUE_LOSSES], result[constants.ADJUSTED_PVALUE]])
+
+
+def get_interaction_pairs(potential_interactions):
+    """Transform into compact pairs for testing (workers expand these into features to perturb)"""
+    interaction_pairs = []
     for left, right in potential_interactions:
         name = left.name + " + " + right.name
-        parent_node = Feature(name, static_indices=left.static_indices + right.static_indices,
-                              temporal_indices=left.temporal_indices + right.temporal_indices)
         if Feature.size(left) >= Feature.size(right):
             cached_node = left
             redo_node = right
         else:
             cached_node = right
             redo_node = left
-        if args.perturbation == constants.SHUFFLING:  # Set attributes on redo_node
-            redo_node = copy.deepcopy(redo_node)
-            redo_node.uniquify(parent_node.name)
-            redo_node.rng_seed = cached_node.rng_seed
-        parent_node.rng_seed = cached_node.rng_seed  # Set attribute on parent_node
-        interaction_groups.append((cached_node, redo_node, parent_node))
-    return interaction_groups
+        interaction_pairs.append(InteractionPair(name, cached_node, redo_node, cached_node.rng_seed))
+    return interaction_pairs
+
+
+def screen_interactions(args, logger, relevant_feature_nodes, cached_predictions):
+    """
+    Rank candidate pairs using a cheap statistic computed from cached predictions (no model calls) and select the
+    top pairs within the limits set by -interaction_screening_num_pairs and -interaction_model_call_budget.
+
+    The statistic for pair (i, j) is the mean over a subsample of records of |d_i * d_j|, where d_i is the change in
+    prediction due to perturbing feature i; it is zero for pairs of features that never affect the same record.
+    This is a heuristic based on marginal effects: it favors pairs of features with large effects on the same records,
+    which are necessary for (but do not imply) non-additive effects, which would require perturbing each pair jointly.
+    Since pairs are selected using the same records over which they are then tested, selected pairs are tested
+    without correction for the selection.
+
+    Pairs are scored one feature at a time, retaining only the top pairs, so that at most 2 * num_pairs + num_features
+    scores are held (besides the perturbation effects over the record subsample) rather than scores of all candidate pairs.
+    """
+    # pylint: disable = too-many-locals
+    start_time = time.time()
+    baseline_prediction = cached_predictions[constants.BASELINE]
+    num_records = len(baseline_prediction)
+    num_features = len(relevant_feature_nodes)
+    num_candidates = num_features * (num_features - 1) // 2
+    num_pairs = num_candidates
+    if args.interaction_screening_num_pairs:
+        num_pairs = min(num_pairs, args.interaction_screening_num_pairs)
+    if args.interaction_model_call_budget:
+        calls_per_pair = get_model_calls_per_pair(args, num_records)
+        if args.interaction_model_call_budget < calls_per_pair:
+            logger.warning("Interaction screening: model call budget %d is less than the %d model calls required to test a"
+                           " single pair, skipping interaction testing" % (args.interaction_model_call_budget, calls_per_pair))
+            return []
+        num_pairs = min(num_pairs, args.interaction_model_call_budget // calls_per_pair)
+        if args.perturbation == constants.SHUFFLING and args.shuffling_trials_tolerance:
+            logger.info("Interaction screening: budget assumes %d model calls per pair (-num_shuffling_trials); adaptive shuffling"
+                        " trials may use as few as %d, so fewer pairs may be tested than the budget allows"
+                        % (calls_per_pair, calls_per_pair * args.min_shuffling_trials // args.num_shuffling_trials))
+    # Perturbation effects on subsample of records
+    sample = np.random.RandomState(constants.SEED).permutation(num_records)[:args.interaction_screening_sample_size]
+    sample.sort()
+    effects = np.abs(np.array([cached_predictions[node.name][sample] - baseline_prediction[sample]
+                               for node in relevant_feature_nodes]))
+    # Top pairs (i, j), i < j, identified by their index in the order of itertools.combinations
+    scores, indices = np.empty(0), np.empty(0, dtype=int)
+    offset = 0
+    for left in range(num_features - 1):
+        row = np.mean(effects[left] * effects[left + 1:], axis=1)
+        scores = np.concatenate((scores, row))
+        indices = np.concatenate((indices, np.arange(offset, offset + len(row))))
+        offset += len(row)
+        if len(scores) >= 2 * num_pairs or left == num_features - 2:
+            top = np.lexsort((indices, -scores))[:num_pairs]  # Stable w.r.t. ties
+            scores, indices = scores[top], indices[top]
+    selected = set(indices.tolist())
+    logger.info("Interaction screening: scored %d candidate pairs on %d records in %f seconds, pruned %d pairs, testing %d pairs"
+                % (num_candidates, len(sample), time.time() - start_time, num_candidates - len(selected), len(selected)))
+    # Retain original order
+    return [pair for idx, pair in enumerate(itertools.combinations(relevant_feature_nodes, 2)) if idx in selected]
+
+
+def get_model_calls_per_pair(args, num_records):
+    """
+    Number of model calls required to test a pair of features. With adaptive shuffling trials (-shuffling_trials_tolerance),
+    this is an upper bound, assuming -num_shuffling_trials trials for all records
+    """
+    calls_per_pair = num_records
+    if args.perturbation == constants.SHUFFLING:
+        calls_per_pair *= 2 * args.num_shuffling_trials  # Redo node perturbed along with pair
+    return calls_per_pair
 
 
 def get_relevant_features(args, feature_nodes):
@@ -0,0 +1,83 @@
+"""
+Loss functions computed by the master from stored predictions (-losses), vectorized over the matrix of
+predictions of all features (and over outputs of multi-output models, -num_outputs), so that several losses
+may be evaluated over a single perturbation run
+"""
+
+import numpy as np
+
+from mihifepe import constants
+
+EPSILON = 1e-15  # Clipping of predicted probabilities for log-loss
+
+
+def squared_error(targets, predictions):
+    """Squared error of predictions (features X records [X outputs]) for targets (records [X outputs])"""
+    return (predictions - targets) ** 2
+
+
+def absolute_error(targets, predictions):
+    """Absolute error of predictions (features X records [X outputs]) for targets (records [X outputs])"""
+    return np.abs(predictions - targets)
+
+
+def log_loss(targets, predictions):
+    """
+    Log-loss of predicted probabilities of the positive class (features X records [X outputs]) for binary labels
+    (records [X outputs]), i.e. one-vs-rest log-loss per output of multi-output models
+    """
+    probabilities = np.clip(predictions, EPSILON, 1 - EPSILON)
+    return -(targets * np.log(probabilities) + (1 - targets) * np.log(1 - probabilities))
+
+
+def cross_entropy(targets, predictions):
+    """
+    Terms of the categorical cross-entropy of predicted class probabilities (features X records X outputs) for one-hot
+    labels (records X outputs). These sum over outputs to the cross-entropy of each record, so losses averaged over
+    outputs (see aggregate_loss), and hence effect sizes, are the cross-entropy divided by the number of outputs
+    """
+    return -targets * np.log(np.clip(predictions, EPSILON, 1))
+
+
+LOSS_FUNCTIONS = {constants.SQUARED_ERROR: squared_error, constants.ABSOLUTE_ERROR: absolute_error, constants.LOG_LOSS: log_loss,
+                  constants.CROSS_ENTROPY: cross_entropy}
+
+
+def compute_losses(loss, targets, predictions, model_type=constants.REGRESSION):
+    """
+    Compute loss vectors from prediction vectors
+
+    Args:
+        loss:           name of loss function
+        targets:        vector of targets over records (or matrix over records X outputs for multi-output models;
+                        a vector of targets of a multi-output model is one-hot encoded for classifiers, and is
+                        otherwise shared by all outputs)
+        predictions:    mapping of feature names to prediction vectors over records (or matrices over records X outputs)
+        model_type:     model type (see -model_type)
+
+    Returns:
+        mapping of feature names to loss vectors over records (or matrices over records X outputs)
+    """
+    if not predictions:
+        return {}
+    names = list(predictions.keys())
+    predictions = np.array([predictions[name] for name in names])
+    if predictions.ndim == 3 and targets.ndim == 1:
+        targets = np.eye(predictions.shape[2])[targets.astype(int)] if model_type == constants.CLASSIFIER else targets[:, np.newaxis]
+    matrix = LOSS_FUNCTIONS[loss](targets, predictions)
+    return dict(zip(names, matrix))
+
+
+def aggregate_loss(loss):
+    """Average loss matrix (records X outputs) of multi-output models over outputs, leaving loss vectors unchanged"""
+    return np.mean(loss, axis=1) if loss.ndim > 1 else loss
+
+
+def aggregate_losses(losses):
+    """Average losses of multi-output models over outputs, mapping feature names to loss vectors over records"""
+    return {name: aggregate_loss(loss) for name, loss in losses.items()}
+
+
+def select_output(losses, output_idx):
+    """Losses of multi-output models for a single output, mapping feature names to loss vectors over records"""
+    return {name: loss[:, output_idx] for name, loss in losses.items()}
@@ -6,24 +6,30 @@ in the hierarchy.
 """
 
 import argparse
+import copy
 import csv
 import os
 import sys
-from unittest.mock import patch
 
 import anytree
 import numpy as np
 
-from mihifepe.compute_p_values import compute_p_value
-from mihifepe import constants, utils
-from mihifepe.fdr import hierarchical_fdr_control
+from mihifepe.compute_p_values import compute_p_value, sequential_p_value
+from mihifepe import cache, constants, metrics, profiling, trace, utils
 from mihifepe.feature import Feature
-from mihifepe.interactions import analyze_interactions
-from mihifepe.pipelines import CondorPipeline, SerialPipeline, round_vectordict
+from mihifepe.pipelines import CondorPipeline, LocalPipeline, Results, SerialPipeline, WorkerPool, round_vectordict
+from mihifepe.record_sample import get_complement, load_record_sample, merge_results, sample_records, save_record_sample
+from mihifepe.incremental import load_previous_results, save_results
+from mihifepe.losses import aggregate_losses, compute_losses, select_output
+from mihifepe.tuning import auto_tune
+from mihifepe.worker import get_sequential_order
 
+# Modules only required by some code paths (interactions, hierarchical FDR) are imported where used, to reduce startup time
+# pylint: disable = import-outside-toplevel
 
-def main():
-    """Parse arguments"""
+
+def get_parser():
+    """Command-line argument parser"""
     parser = argparse.ArgumentParser()
     # Required arguments
     parser.add_argument("-model_generator_filename", help="python script that generates model "
@@ -38,21 +44,70 @@ def main():
                         "%s: works only on static data" % (constants.ZEROING, constants.SHUFFLING))
     parser.add_argument("-num_shuffling_trials", type=int, default=500, help="Number of shuffling trials to average over, "
                         "when shuffling perturbations are selected")
+    parser.add_argument("-shuffling_trials_tolerance", type=float, default=0., help="enables adaptive shuffling trials: for"
+                        " each record and feature, shuffling trials are drawn in batches until the standard error of the mean"
+                        " loss over trials falls below this tolerance, with -num_shuffling_trials as the maximum number of"
+                        " trials (default 0: disabled, always use -num_shuffling_trials trials)")
+    parser.add_argument("-min_shuffling_trials", type=int, default=20, help="minimum number of shuffling trials per record"
+                        " and feature, for adaptive shuffling trials")
+    parser.add_argument("-shuffling_trials_batch_size", type=int, default=20, help="number of additional shuffling trials"
+                        " drawn at a time, for adaptive shuffling trials")
     parser.add_argument("-condor", dest="condor", action="store_true",
                         help="Enable parallelization using condor (default disabled)")
     parser.add_argument("-no-condor", dest="condor", action="store_false", help="Disable parallelization using condor")
     parser.set_defaults(condor=False)
+    parser.add_argument("-local_workers", type=int, default=0, help="run tasks in parallel on this many persistent local"
+                        " worker daemons, which load the model and data once for all tasks of the run (default 0: run"
+                        " tasks serially in the master process)")
     parser.add_argument("-features_per_worker", type=int, default=10, help="worker load")
+    parser.add_argument("-records_per_worker", type=int, default=0, help="also partition records across workers, into tiles"
+                        " of up to this many records (default 0: each worker perturbs all records for its features)."
+                        " Results are identical however the work is partitioned")
     parser.add_argument("-eviction_timeout", type=int, default=14400, help="time in seconds to allow condor jobs"
                         " to run before evicting and restarting them on another condor node")
     parser.add_argument("-idle_timeout", type=int, default=3600, help="time in seconds to allow condor jobs"
                         " to stay idle before removing them from condor and attempting them on the master node.")
     parser.add_argument("-memory_requirement", type=int, default=16, help="memory requirement in GB, minimum 1, default 16")
+    parser.add_argument("-cache_dir", help="directory of cache of perturbation results across runs, keyed on the data,"
+                        " model generator, perturbation settings and each node's index sets, so that only new or changed"
+                        " nodes are perturbed (default: disabled). Not used when perturbing a subset of records")
+    parser.add_argument("-cache_size_limit", type=float, default=10, help="size limit of cache in GB, beyond which least"
+                        " recently used entries are evicted")
+    parser.add_argument("-cache_extra_files", nargs="*", default=[], help="files loaded by the model generator (e.g."
+                        " pickled models), whose contents are included in cache keys")
+    parser.add_argument("-incremental", action="store_true", help="reuse results of nodes whose index sets are unchanged"
+                        " since the previous run with -incremental in the same output directory (e.g. after regrouping"
+                        " features or adding intermediate levels to the hierarchy), perturbing only new nodes, and store"
+                        " results for subsequent runs. Under shuffling perturbations, renamed nodes are also perturbed anew,"
+                        " since shuffling draws depend on node names")
+    parser.add_argument("-auto_tune", action="store_true", help="derive -features_per_worker (and -records_per_worker"
+                        " if required) from a timed probe of the model to meet -target_task_duration, and -memory_requirement"
+                        " from the shape of the data and the size of the tasks, overriding their values")
+    parser.add_argument("-target_task_duration", type=float, default=600, help="target duration of tasks in seconds,"
+                        " for -auto_tune")
+    parser.add_argument("-tuning_probe_records", type=int, default=10, help="number of records over which -auto_tune"
+                        " times the model (0: skip probe, only tuning -memory_requirement)")
     parser.add_argument("-compile_results_only", help="only compile results (assuming they already exist), "
                         "skipping actually launching jobs", action="store_true")
+    parser.add_argument("-profile", action="store_true", help="profile the master and each worker task using cProfile,"
+                        " writing profiles to profile_master.prof and profile_worker_<task_idx>.prof, and a report of hot"
+                        " functions over all worker tasks to %s" % constants.PROFILE_REPORT_FILENAME)
     parser.add_argument("-model_type", default=constants.REGRESSION,
-                        help="Model type (default: regression). Note: this variable is currently unused.",
+                        help="Model type (default: regression), used to stratify record samples and to validate -losses",
                         choices=[constants.BINARY_CLASSIFIER, constants.CLASSIFIER, constants.REGRESSION],)
+    parser.add_argument("-losses", nargs="+", choices=[constants.SQUARED_ERROR, constants.ABSOLUTE_ERROR, constants.LOG_LOSS,
+                                                       constants.CROSS_ENTROPY],
+                        help="workers store only predictions, and the master computes these losses from the predictions"
+                        " instead of using the losses returned by the model. Results for the first loss are written to the"
+                        " output directory, and p-values and FDR control for each further loss to <output_dir>/<loss>."
+                        " %s requires predicted probabilities of a %s, and %s predicted class probabilities of a %s with"
+                        " -num_outputs > 1" % (constants.LOG_LOSS, constants.BINARY_CLASSIFIER, constants.CROSS_ENTROPY, constants.CLASSIFIER))
+    parser.add_argument("-num_outputs", type=int, default=1, help="number of outputs of the model, e.g. classes of a"
+                        " multi-class classifier or targets of a multi-target regression model. With more than one output,"
+                        " the model returns vectors of losses and predictions over outputs, and p-values are computed from"
+                        " losses averaged over outputs")
+    parser.add_argument("-per_output_pvalues", action="store_true", help="also compute p-values and FDR control for each"
+                        " output of a multi-output model (-num_outputs), written to <output_dir>/output_<idx>")
     parser.add_argument("-analyze_interactions", help="flag to enable testing of interaction significance. By default,"
                         " only pairwise interactions between leaf features identified as important by hierarchical FDR"
                         " are tested. To enable testing of all pairwise interactions, also use -analyze_all_pairwise_interactions",
@@ -60,36 +115,163 @@ def main():
     parser.add_argument("-analyze_all_pairwise_interactions", help="analyze all pairwise interactions between leaf features,"
                         " instead of just pairwise interactions of leaf features identified by hierarchical FDR",
                         action="store_true")
+    parser.add_argument("-interaction_screening_num_pairs", type=int, default=0, help="screen candidate pairwise interactions"
+                        " using a cheap statistic computed from existing perturbations (a heuristic based on marginal effects),"
+                        " and test only the given number of top-ranked pairs (default 0: no limit)")
+    parser.add_argument("-interaction_model_call_budget", type=int, default=0, help="screen candidate pairwise interactions"
+                        " as above, testing only as many top-ranked pairs as fit within the given number of model calls"
+                        " (default 0: no limit). With adaptive shuffling trials (-shuffling_trials_tolerance), pairs are assumed"
+                        " to use -num_shuffling_trials trials, so the budget is conservative")
+    parser.add_argument("-interaction_screening_sample_size", type=int, default=1000, help="number of records subsampled to"
+                        " compute the interaction screening statistic")
+    parser.add_argument("-interaction_order", type=int, default=2, help="maximum order of interactions to test (default 2:"
+                        " pairwise only). Interactions of order k are tested only among sets of features all of whose"
+                        " subsets of k - 1 features were identified as interactions. The FDR is controlled separately for"
+                        " each order, not over interactions of all orders")
+    parser.add_argument("-max_interaction_candidates", type=int, default=1000, help="maximum number of candidate"
+                        " interactions tested at each order above 2 (0: no limit)")
     parser.add_argument("-no-condor-cleanup", action="store_false", help="disable removal of intermediate condor files"
                         " after completion (typically for debugging). By default these files will be cleared to remove"
                         " space and clutter, and to avoid condor file issues", dest="cleanup")
     parser.set_defaults(cleanup=True)
 
+    parser.add_argument("-sequential_testing", action="store_true", help="perturb features over blocks of records (in random"
+                        " order), and stop perturbing a feature once a group-sequential sign test over the records processed"
+                        " so far has decided whether perturbing it increases the model's loss. Each feature's p-value is that of the"
+                        " group-sequential test: the minimum p-value over the checkpoints it reached (and the Wilcoxon test over"
+                        " all records, if it was never stopped), Bonferroni-adjusted for the number of checkpoints."
+                        " Incompatible with -analyze_interactions")
+    parser.add_argument("-sequential_block_size", type=int, default=100, help="number of records processed between"
+                        " sequential testing checkpoints")
+    parser.add_argument("-sequential_alpha", type=float, default=0.001, help="significance level of the sequential efficacy"
+                        " bound, split evenly across checkpoints (Bonferroni)")
+    parser.add_argument("-sequential_futility_pvalue", type=float, default=0.5, help="sequential futility bound: stop"
+                        " perturbing a feature once its sign test p-value at a checkpoint is at least this value")
+
+    parser.add_argument("-record_sample", type=float, default=0., help="approximate mode: only perturb a reproducible random"
+                        " sample of records, of the given size (number of records if greater than 1, else fraction of"
+                        " records). Sampled results are saved to %s in the output directory" % constants.RECORD_SAMPLE_FILENAME)
+    parser.add_argument("-stratify_record_sample", action="store_true", help="stratify record sample by target (label for"
+                        " classifiers, target quantiles for regression models, see -model_type)")
+    parser.add_argument("-reuse_record_sample", help="results file %s saved by a previous run with -record_sample (using the"
+                        " same data, model and hierarchy): reuse its results for the sampled records, and only perturb the"
+                        " remaining records" % constants.RECORD_SAMPLE_FILENAME)
+
+    parser.add_argument("-screening_sample", type=float, default=0., help="coarse-to-fine mode: first perturb all nodes over"
+                        " a reproducible random sample of records of the given size (number of records if greater than 1,"
+                        " else fraction of records; see -stratify_record_sample), and prune subtrees rooted at nodes whose"
+                        " screening p-value is at least -screening_pvalue_threshold. Surviving nodes are then perturbed over"
+                        " the remaining records, and pruned nodes are assigned p-values of 1")
+    parser.add_argument("-screening_pvalue_threshold", type=float, default=0.5, help="prune subtrees rooted at nodes whose"
+                        " p-value over the screening sample is at least this value")
+
+    parser.add_argument("-progressive", action="store_true", help="anytime mode: perturb nodes level by level in order of"
+                        " hierarchy depth (root and top-level groups first), updating %s and hierarchical FDR results over the"
+                        " levels completed so far as each level completes" % constants.PVALUES_FILENAME)
+    return parser
+
+
+def main():
+    """Parse arguments"""
+    parser = get_parser()
     args = parser.parse_args()
+    if args.progressive and (args.record_sample or args.reuse_record_sample):
+        parser.error("-progressive is incompatible with -record_sample and -reuse_record_sample")
+    if args.screening_sample and (args.record_sample or args.reuse_record_sample or args.sequential_testing):
+        parser.error("-screening_sample is incompatible with -record_sample, -reuse_record_sample and -sequential_testing")
+    if args.screening_sample and args.analyze_all_pairwise_interactions:
+        parser.error("-screening_sample is incompatible with -analyze_all_pairwise_interactions, which requires"
+                     " predictions for all leaf features")
+    if args.record_sample and args.reuse_record_sample:
+        parser.error("-record_sample and -reuse_record_sample are mutually exclusive")
+    if args.shuffling_trials_tolerance and args.min_shuffling_trials < 2:
+        parser.error("-min_shuffling_trials must be at least 2 to estimate standard errors")
+    if args.incremental and (args.record_sample or args.reuse_record_sample or args.screening_sample or args.sequential_testing):
+        parser.error("-incremental is incompatible with -record_sample, -reuse_record_sample, -screening_sample and"
+                     " -sequential_testing, since stored results cover all records")
+    if args.losses and constants.LOG_LOSS in args.losses and args.model_type != constants.BINARY_CLASSIFIER:
+        parser.error("%s requires -model_type %s" % (constants.LOG_LOSS, constants.BINARY_CLASSIFIER))
+    if args.losses and constants.CROSS_ENTROPY in args.losses and (args.model_type != constants.CLASSIFIER or args.num_outputs < 2):
+        parser.error("%s requires -model_type %s and -num_outputs > 1" % (constants.CROSS_ENTROPY, constants.CLASSIFIER))
+    if args.num_outputs < 1:
+        parser.error("-num_outputs must be at least 1")
+    if args.per_output_pvalues and args.num_outputs < 2:
+        parser.error("-per_output_pvalues requires -num_outputs > 1")
+    if args.analyze_interactions and args.num_outputs > 1:
+        parser.error("-analyze_interactions is incompatible with -num_outputs > 1")
+    if args.condor and args.local_workers:
+        parser.error("-condor and -local_workers are mutually exclusive")
+    if args.sequential_testing and args.records_per_worker:
+        parser.error("-sequential_testing is incompatible with -records_per_worker, since tests are sequential over records")
+    if args.sequential_testing and args.reuse_record_sample:
+        parser.error("-sequential_testing is incompatible with -reuse_record_sample, since the group-sequential test is"
+                     " over the records of a single run in the order processed")
+    if args.sequential_testing and args.analyze_interactions:
+        parser.error("-sequential_testing is incompatible with -analyze_interactions, which requires predictions over all records")
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
     args.rng = np.random.RandomState(constants.SEED)
+    args.record_indices = None  # indices of records to perturb (default all)
     logger = utils.get_logger(__name__, "%s/master.log" % args.output_dir)
-    pipeline(args, logger)
+    with profiling.profile(args, "master"):
+        pipeline(args, logger)
 
 
 def pipeline(args, logger):
     """Master pipeline"""
     logger.info("Begin mihifepe master pipeline with args: %s" % args)
-    # Load hierarchy from file
-    hierarchy_root = load_hierarchy(args.hierarchy_filename)
-    # Flatten hierarchy to allow partitioning across workers
-    feature_nodes = flatten_hierarchy(args, hierarchy_root)
-    # Perturb features
-    _, losses, predictions = perturb_features(args, logger, feature_nodes)
-    # Compute p-values
-    compute_p_values(args, hierarchy_root, losses, predictions)
-    # Run hierarchical FDR
-    hierarchical_fdr(args, logger)
+    metrics.reset(args.output_dir)
+    profiling.reset(args.output_dir)
+    trace.reset(args.output_dir)
+    with metrics.phase(args.output_dir, "master", "load_hierarchy"):
+        # Load hierarchy from file
+        hierarchy_root = load_hierarchy(args.hierarchy_filename)
+        # Flatten hierarchy to allow partitioning across workers
+        feature_nodes = flatten_hierarchy(args, hierarchy_root)
+    # Tune task granularity and memory requirement
+    if args.auto_tune:
+        with metrics.phase(args.output_dir, "master", "auto_tune"):
+            auto_tune(args, logger, feature_nodes)
+    # Screen features over record sample, pruning subtrees without apparent effect
+    pruned = set()
+    if args.screening_sample:
+        with metrics.phase(args.output_dir, "master", "screen_features"):
+            feature_nodes, pruned = screen_features(args, logger, hierarchy_root, feature_nodes)
+    if args.progressive:
+        # Perturb features, compute p-values and run hierarchical FDR level by level
+        with metrics.phase(args.output_dir, "master", "perturb_progressively"):
+            results = perturb_features_progressively(args, logger, hierarchy_root, feature_nodes, pruned)
+    else:
+        # Perturb features
+        with metrics.phase(args.output_dir, "master", "perturb_features"):
+            results = perturb_features(args, logger, feature_nodes)
+        # Compute p-values
+        with metrics.phase(args.output_dir, "master", "compute_p_values"):
+            compute_p_values(args, logger, hierarchy_root, results, pruned)
+        # Run hierarchical FDR
+        with metrics.phase(args.output_dir, "master", "hierarchical_fdr"):
+            hierarchical_fdr(args, logger)
+    # Compute p-values and run hierarchical FDR for further losses from the same predictions
+    if args.losses and len(args.losses) > 1:
+        with metrics.phase(args.output_dir, "master", "additional_losses"):
+            analyze_additional_losses(args, logger, hierarchy_root, results, pruned)
+    # Compute p-values and run hierarchical FDR for each output of multi-output models
+    if args.per_output_pvalues:
+        with metrics.phase(args.output_dir, "master", "per_output_pvalues"):
+            analyze_outputs(args, logger, hierarchy_root, results, pruned)
+    # Store results for subsequent incremental runs
+    if args.incremental:
+        save_results(args, logger, feature_nodes, results)
     # Analyze pairwise interactions
     if args.analyze_interactions:
-        analyze_interactions(args, logger, feature_nodes, predictions)
+        from mihifepe.interactions import analyze_interactions
+        with metrics.phase(args.output_dir, "master", "analyze_interactions"):
+            analyze_interactions(args, logger, feature_nodes, results.predictions)
+    WorkerPool.close()
+    logger.info("Metrics written to %s/%s, summary:\n%s"
+                % (args.output_dir, constants.METRICS_FILENAME, metrics.summarize(args.output_dir)))
+    logger.info("Timeline of run written to %s" % trace.write_trace(args.output_dir))
     logger.info("End mihifepe master pipeline")
 
 
@@ -163,6 +345,37 @@ def flatten_hierarchy(args, hierarchy_root):
     return nodes
 
 
+def screen_features(args, logger, hierarchy_root, feature_nodes):
+    """
+    Coarse screening pass: perturb all features over a record sample, and prune subtrees rooted at nodes
+    whose screening p-value is at least -screening_pvalue_threshold.
+
+    Pruned nodes are assigned p-values of 1, so their descendants are never tested by hierarchical FDR control
+    and need not be perturbed. Surviving nodes are subsequently perturbed over the remaining records only, so their
+    p-values are independent of the screening decision and FDR control over the reported nodes is retained.
+
+    Returns:
+        surviving feature nodes (and baseline), set of names of pruned nodes
+    """
+    args.record_indices = sample_records(args, logger, args.screening_sample)
+    worker_pipeline = SerialPipeline(args, logger, feature_nodes)
+    if args.condor:
+        worker_pipeline = CondorPipeline(args, logger, feature_nodes)
+    elif args.local_workers:
+        worker_pipeline = LocalPipeline(args, logger, feature_nodes)
+    losses = round_vectordict(aggregate_losses(worker_pipeline.run().losses))
+    baseline_loss = losses[constants.BASELINE]
+    pruned = set()
+    for node in anytree.PreOrderIter(hierarchy_root):
+        if (node.parent and node.parent.name in pruned) or \
+                compute_p_value(baseline_loss, losses[node.name]) >= args.screening_pvalue_threshold:
+            pruned.add(node.name)
+    args.record_indices = get_complement(args, args.record_indices)
+    logger.info("Screening: pruned %d of %d nodes over %d records, perturbing remaining nodes over %d records"
+                % (len(pruned), len(losses) - 1, len(baseline_loss), len(args.record_indices)))
+    return [node for node in feature_nodes if node.name not in pruned], pruned
+
+
 def perturb_features(args, logger, feature_nodes):
     """
     Perturb features, observe effect on model loss and aggregate results
@@ -174,42 +387,182 @@ def perturb_features(args, logger, feature_nodes):
     Returns:
         Aggregated results from workers
     """
+    if args.reuse_record_sample:
+        sample_indices, sample_results = load_record_sample(args.reuse_record_sample)
+        args.record_indices = get_complement(args, sample_indices)
+        logger.info("Reusing results for %d sampled records from %s, perturbing remaining %d records"
+                    % (len(sample_indices), args.reuse_record_sample, len(args.record_indices)))
+        if not args.record_indices.size:
+            args.record_indices = None
+            return sample_results
+    elif args.record_sample:
+        args.record_indices = sample_records(args, logger, args.record_sample)
+    # Reuse results of nodes with unchanged index sets from previous run
+    previous_results = None
+    if args.incremental:
+        feature_nodes, previous_results = load_previous_results(args, logger, feature_nodes)
+        if not feature_nodes:
+            return previous_results
+    # Look up results cached by previous runs (only available over all records)
+    run_cache = None
+    if args.cache_dir and args.record_indices is None and not args.sequential_testing:
+        run_cache = cache.Cache(args, logger)
+        feature_nodes, cached_results = run_cache.lookup(feature_nodes)
+        if not feature_nodes:
+            return cache.merge(previous_results, cached_results) if previous_results else cached_results
     # Partition features, Launch workers, Aggregate results
     worker_pipeline = SerialPipeline(args, logger, feature_nodes)
     if args.condor:
         worker_pipeline = CondorPipeline(args, logger, feature_nodes)
-    return worker_pipeline.run()
+    elif args.local_workers:
+        worker_pipeline = LocalPipeline(args, logger, feature_nodes)
+    results = worker_pipeline.run()
+    if run_cache:
+        run_cache.store(feature_nodes, results)
+        results = cache.merge(cached_results, results)
+    if previous_results:
+        results = cache.merge(previous_results, results)
+    if args.reuse_record_sample:
+        results = merge_results(sample_indices, sample_results, args.record_indices, results)
+        args.record_indices = None  # Subsequent analyses use all records
+    elif args.record_sample:
+        save_record_sample(args, logger, results)
+    return results
+
+
+def perturb_features_progressively(args, logger, hierarchy_root, feature_nodes, pruned):
+    """
+    Anytime mode: perturb features level by level in order of hierarchy depth, root (and baseline) first,
+    updating p-values and hierarchical FDR results over the levels completed so far after each level.
+    Since hierarchical FDR tests each level only given rejections at shallower levels,
+    findings at completed levels are final.
+
+    Returns:
+        Aggregated results over all levels
+    """
+    levels = {}
+    for node in feature_nodes:
+        levels.setdefault(node.depth, []).append(node)
+    results = None
+    for depth in range(hierarchy_root.height + 1):
+        if depth in levels:  # Levels may be empty if pruned by screening
+            level_results = perturb_features(args, logger, levels[depth])
+            if results is None:
+                results = level_results
+            else:
+                results = Results(results.targets, *[{**outputs, **level_outputs}
+                                                     for outputs, level_outputs in zip(results[1:], level_results[1:])])
+        compute_p_values(args, logger, hierarchy_root, results, pruned, max_depth=depth)
+        # Only render the final tree, since rendering rewritten trees of successive levels would race
+        hierarchical_fdr(args, logger, render=constants.RENDER_BACKGROUND if depth == hierarchy_root.height else constants.RENDER_DEFERRED)
+        logger.info("Progressive: completed hierarchy level %d of %d, results updated in %s"
+                    % (depth + 1, hierarchy_root.height + 1, args.output_dir))
+    return results
 
 
-def compute_p_values(args, hierarchy_root, losses, predictions):
-    """Evaluates and compares different feature erasures"""
+def compute_p_values(args, logger, hierarchy_root, results, pruned=frozenset(), max_depth=None):
+    """
+    Evaluates and compares different feature erasures, assigning p-values of 1 to nodes pruned by screening.
+    If max_depth is given, only nodes up to that depth in the hierarchy are evaluated.
+    Losses of multi-output models are averaged over outputs.
+    """
     # pylint: disable = too-many-locals
-    losses = round_vectordict(losses)
-    predictions = round_vectordict(predictions)
+    losses = round_vectordict(aggregate_losses(results.losses))
     outfile = open("%s/%s" % (args.output_dir, constants.PVALUES_FILENAME), "w", newline="")
     writer = csv.writer(outfile, delimiter=",")
-    writer.writerow([constants.NODE_NAME, constants.PARENT_NAME, constants.DESCRIPTION, constants.EFFECT_SIZE,
-                     constants.MEAN_LOSS, constants.PVALUE_LOSSES])
+    header = [constants.NODE_NAME, constants.PARENT_NAME, constants.DESCRIPTION, constants.EFFECT_SIZE,
+              constants.MEAN_LOSS, constants.PVALUE_LOSSES]
+    if args.sequential_testing or args.record_sample:
+        header.append(constants.NUM_RECORDS)
+    if args.record_sample:
+        header.append(constants.EFFECT_SIZE_STDERR)
+    if results.num_trials:
+        header.append(constants.MEAN_NUM_TRIALS)
+    if args.screening_sample:
+        header.append(constants.PRUNED)
+    writer.writerow(header)
     baseline_loss = losses[constants.BASELINE]
     mean_baseline_loss = np.mean(baseline_loss)
-    for node in anytree.PreOrderIter(hierarchy_root):
+    records_used = 0
+    records_total = 0
+    for node in anytree.PreOrderIter(hierarchy_root, maxlevel=None if max_depth is None else max_depth + 1):
         name = node.name
         parent_name = node.parent.name if node.parent else ""
+        if name in pruned:
+            writer.writerow([name, parent_name, node.description, "", "", 1.] + [""] * (len(header) - 7) + [1])
+            continue
         loss = losses[node.name]
+        node_baseline_loss = baseline_loss
+        node_mean_baseline_loss = mean_baseline_loss
+        if args.sequential_testing:
+            # Records not used by feature (since sequential test stopped early) have NaN losses
+            used = ~np.isnan(loss)
+            loss = loss[used]
+            node_baseline_loss = baseline_loss[used]
+            node_mean_baseline_loss = np.mean(node_baseline_loss)
+            records_used += len(loss)
+            records_total += len(baseline_loss)
         mean_loss = np.mean(loss)
-        pvalue_loss = compute_p_value(baseline_loss, loss)
-        effect_size = mean_loss - mean_baseline_loss
-        writer.writerow([name, parent_name, node.description, effect_size, mean_loss, pvalue_loss])
+        if args.sequential_testing:
+            # p-value of the group-sequential test, valid however the test stopped
+            order = get_sequential_order(len(baseline_loss))
+            pvalue_loss = sequential_p_value(baseline_loss[order], losses[node.name][order], args.sequential_block_size)
+        else:
+            pvalue_loss = compute_p_value(node_baseline_loss, loss)
+        effect_size = mean_loss - node_mean_baseline_loss
+        row = [name, parent_name, node.description, effect_size, mean_loss, pvalue_loss]
+        if args.sequential_testing or args.record_sample:
+            row.append(len(loss))
+        if args.record_sample:
+            # Standard error of effect size (mean paired difference) estimated from the sample
+            row.append(np.std(loss - node_baseline_loss, ddof=1) / np.sqrt(len(loss)) if len(loss) > 1 else np.nan)
+        if results.num_trials:
+            num_trials = results.num_trials[node.name]
+            row.append(np.mean(num_trials[num_trials > 0]))
+        if args.screening_sample:
+            row.append(0)
+        writer.writerow(row)
     outfile.close()
+    if args.sequential_testing:
+        logger.info("Sequential testing: features used %d of %d record evaluations (%.1f%%)"
+                    % (records_used, records_total, 100. * records_used / records_total))
+
+
+def analyze_additional_losses(args, logger, hierarchy_root, results, pruned):
+    """Compute p-values and run hierarchical FDR for each loss after the first of -losses, written to <output_dir>/<loss>"""
+    for loss in args.losses[1:]:
+        largs = copy.copy(args)
+        largs.output_dir = "%s/%s" % (args.output_dir, loss)
+        if not os.path.exists(largs.output_dir):
+            os.makedirs(largs.output_dir)
+        logger.info("Computing p-values for loss %s, written to %s" % (loss, largs.output_dir))
+        loss_results = Results(results.targets, compute_losses(loss, results.targets, results.predictions, args.model_type), *results[2:])
+        compute_p_values(largs, logger, hierarchy_root, loss_results, pruned)
+        hierarchical_fdr(largs, logger)
+
+
+def analyze_outputs(args, logger, hierarchy_root, results, pruned):
+    """Compute p-values and run hierarchical FDR for each output of a multi-output model, written to <output_dir>/output_<idx>"""
+    for output_idx in range(args.num_outputs):
+        oargs = copy.copy(args)
+        oargs.output_dir = "%s/%s" % (args.output_dir, constants.OUTPUT_DIR_FORMAT % output_idx)
+        if not os.path.exists(oargs.output_dir):
+            os.makedirs(oargs.output_dir)
+        logger.info("Computing p-values for output %d, written to %s" % (output_idx, oargs.output_dir))
+        output_results = Results(results.targets, select_output(results.losses, output_idx), *results[2:])
+        compute_p_values(oargs, logger, hierarchy_root, output_results, pruned)
+        hierarchical_fdr(oargs, logger)
 
 
-def hierarchical_fdr(args, logger):
-    """Performs hierarchical FDR control on results"""
+def hierarchical_fdr(args, logger, render=constants.RENDER_BACKGROUND):
+    """Performs hierarchical FDR control on results, rendering the tree of rejected hypotheses as given (see -render)"""
     input_filename = "%s/%s" % (args.output_dir, constants.PVALUES_FILENAME)
     output_dir = "%s/%s" % (args.output_dir, constants.HIERARCHICAL_FDR_DIR)
     cmd = ("python -m mihifepe.fdr.hierarchical_fdr_control -output_dir %s -procedure yekutieli "
-           "-rectangle_leaves %s" % (output_dir, input_filename))
+           "-rectangle_leaves -render %s %s" % (output_dir, render, input_filename))
     logger.info("Running cmd: %s" % cmd)
+    from unittest.mock import patch
+    from mihifepe.fdr import hierarchical_fdr_control
     pass_args = cmd.split()[2:]
     with patch.object(sys, 'argv', pass_args):
         hierarchical_fdr_control.main()
@@ -0,0 +1,111 @@
+"""Per-phase timing and resource metrics, written as JSON lines to the output directory"""
+
+import contextlib
+import json
+import os
+import time
+
+import numpy as np
+
+from mihifepe import constants
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+@contextlib.contextmanager
+def phase(output_dir, source, name):
+    """
+    Measure wall time, CPU time, bytes read/written and peak RSS of the enclosed phase, and append them to the
+    metrics file. Yields a dictionary to which the phase may add fields, e.g. num_records (records/sec is then derived).
+
+    Args:
+        output_dir: output directory containing metrics file
+        source:     component running the phase, e.g. master, worker_<task_idx> or pipeline class
+        name:       phase name
+    """
+    fields = {}
+    start_time = time.time()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    start_io = get_io_bytes()
+    yield fields
+    wall_seconds = time.perf_counter() - start_wall
+    metrics = {"source": source, "phase": name, "pid": os.getpid(), "start_time": start_time, "wall_seconds": wall_seconds,
+               "cpu_seconds": time.process_time() - start_cpu, "peak_rss_bytes": get_peak_rss_bytes()}
+    end_io = get_io_bytes()
+    if start_io and end_io:
+        metrics["bytes_read"] = end_io[0] - start_io[0]
+        metrics["bytes_written"] = end_io[1] - start_io[1]
+    if fields.get("num_records") and wall_seconds > 0:
+        metrics["records_per_second"] = fields["num_records"] / wall_seconds
+    metrics.update(fields)
+    # Single write of a whole line in append mode, so that lines from concurrent workers don't interleave
+    with open("%s/%s" % (output_dir, constants.METRICS_FILENAME), "a") as metrics_file:
+        metrics_file.write(json.dumps(metrics) + "\n")
+
+
+def get_io_bytes():
+    """Bytes read and written by the process so far (Linux only, else None)"""
+    try:
+        with open("/proc/self/io", "r") as io_file:
+            counters = dict(line.split(": ") for line in io_file.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def get_peak_rss_bytes():
+    """Peak resident set size of the process in bytes (None if unavailable)"""
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if os.uname().sysname == "Darwin" else peak_rss * 1024  # Reported in kilobytes on Linux
+
+
+def latency_summary(latencies):
+    """Summarize distribution of latencies (in seconds) of model calls"""
+    if not latencies:
+        return {"model_calls": 0}
+    latencies = np.array(latencies)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {"model_calls": len(latencies), "model_call_seconds": np.sum(latencies), "model_call_mean_seconds": np.mean(latencies),
+            "model_call_p50_seconds": p50, "model_call_p90_seconds": p90, "model_call_p99_seconds": p99,
+            "model_call_max_seconds": np.max(latencies)}
+
+
+def reset(output_dir):
+    """Remove metrics from previous runs"""
+    filename = "%s/%s" % (output_dir, constants.METRICS_FILENAME)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def summarize(output_dir):
+    """
+    Summary table of metrics file, aggregating phases over workers
+
+    Returns:
+        table as string, one row per (source, phase) with count, total wall and CPU time, maximum peak RSS,
+        and (where reported) records processed per second of wall time and number of model calls
+    """
+    rows = {}
+    with open("%s/%s" % (output_dir, constants.METRICS_FILENAME), "r") as metrics_file:
+        for line in metrics_file:
+            metrics = json.loads(line)
+            source = "worker" if metrics["source"].startswith("worker_") else metrics["source"]
+            row = rows.setdefault((source, metrics["phase"]), [0, 0., 0., 0, 0, 0])
+            row[0] += 1
+            row[1] += metrics["wall_seconds"]
+            row[2] += metrics["cpu_seconds"]
+            row[3] = max(row[3], metrics["peak_rss_bytes"] or 0)
+            row[4] += metrics.get("num_records", 0)
+            row[5] += metrics.get("model_calls", 0)
+    lines = ["%-16s %-20s %6s %12s %12s %14s %12s %12s"
+             % ("source", "phase", "count", "wall (s)", "cpu (s)", "peak RSS (MB)", "records/s", "model calls")]
+    for (source, name), (count, wall_seconds, cpu_seconds, peak_rss, num_records, model_calls) in rows.items():
+        records_per_second = "%.1f" % (num_records / wall_seconds) if num_records and wall_seconds > 0 else ""
+        lines.append("%-16s %-20s %6d %12.3f %12.3f %14.1f %12s %12s"
+                     % (source, name, count, wall_seconds, cpu_seconds, peak_rss / 2 ** 20, records_per_second, model_calls or ""))
+    return "\n".join(lines)
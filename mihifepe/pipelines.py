@@ -1,10 +1,12 @@
 """Serial and distributed (condor) perturbation pipelines"""
 
+from collections import namedtuple
 import copy
 import csv
 from datetime import datetime
 import glob
-import math
+import multiprocessing
+from multiprocessing.connection import wait
 import os
 import pickle
 import re
@@ -14,8 +16,13 @@ import time
 import h5py
 import numpy as np
 
-from mihifepe import constants, worker
-from mihifepe.feature import Feature
+from mihifepe import constants, metrics, profiling, progress, trace, worker
+from mihifepe.feature import Feature, InteractionPair
+from mihifepe.losses import compute_losses
+
+# Outputs of perturbation pipeline: targets and mappings of feature names to vectors of losses, predictions and
+# numbers of shuffling trials over records (the last only for adaptive shuffling trials)
+Results = namedtuple("Results", ["targets", "losses", "predictions", "num_trials"])
 
 
 class SerialPipeline():
@@ -30,20 +37,147 @@ class SerialPipeline():
         """Run serial pipeline"""
         self.logger.info("Begin running serial pipeline")
         condor_helper = CondorPipeline(self.args, self.logger, [])
-        condor_helper.task_count = 1
+        # Only partition records (if required), perturbing all features in each tile
+        condor_helper.tiles = get_tiles(self.args, self.feature_nodes, max(1, len(self.feature_nodes)))
+        condor_helper.task_count = len(condor_helper.tiles)
         if not self.args.compile_results_only:
-            # Write all features to file
-            self.args.task_idx = 0
-            condor_helper.write_features(self.args, self.feature_nodes)
-            # Run worker pipeline
-            worker.pipeline(self.args, self.logger)
+            with metrics.phase(self.args.output_dir, type(self).__name__, "run_tasks") as metrics_fields:
+                metrics_fields["num_tasks"] = condor_helper.task_count
+                task_progress = progress.Progress(self.args, self.logger, type(self).__name__, condor_helper.tiles)
+                for task_idx, (task_features, record_indices, _) in enumerate(condor_helper.tiles):
+                    # Write features to file
+                    self.args.task_idx = task_idx
+                    self.args.record_indices = record_indices
+                    condor_helper.write_features(self.args, task_features)
+                    # Run worker pipeline
+                    worker.pipeline(self.args, self.logger)
+                    task_progress.report()
+                task_progress.report(force=True)
         # Aggregate results
-        results = condor_helper.compile_results()
+        with metrics.phase(self.args.output_dir, type(self).__name__, "compile_results"):
+            results = condor_helper.compile_results()
+        profiling.merge_worker_profiles(self.args, self.logger, condor_helper.task_count)
         if self.args.cleanup:
             condor_helper.cleanup()
         return results
 
 
+class LocalPipeline():
+    """Local parallel implementation, running tasks on persistent worker daemons (see WorkerPool)"""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, args, logger, feature_nodes):
+        self.args = copy.deepcopy(args)
+        self.logger = logger
+        self.feature_nodes = feature_nodes
+
+    def run(self):
+        """Run local pipeline"""
+        self.logger.info("Begin running local pipeline")
+        condor_helper = CondorPipeline(self.args, self.logger, self.feature_nodes)
+        if not self.args.compile_results_only:
+            with metrics.phase(self.args.output_dir, type(self).__name__, "run_tasks") as metrics_fields:
+                metrics_fields["num_tasks"] = condor_helper.task_count
+                tasks = []
+                for task_idx, (task_features, record_indices, _) in enumerate(condor_helper.tiles):
+                    targs = copy.deepcopy(self.args)
+                    targs.task_idx = task_idx
+                    targs.record_indices = record_indices
+                    condor_helper.write_features(targs, task_features)
+                    tasks.append(targs)
+                task_progress = progress.Progress(self.args, self.logger, type(self).__name__, condor_helper.tiles)
+                WorkerPool.get(self.args, self.logger).run(tasks, task_progress)
+                task_progress.report(force=True)
+        # Aggregate results
+        with metrics.phase(self.args.output_dir, type(self).__name__, "compile_results"):
+            results = condor_helper.compile_results()
+        profiling.merge_worker_profiles(self.args, self.logger, condor_helper.task_count)
+        if self.args.cleanup:
+            condor_helper.cleanup()
+        self.logger.info("End running local pipeline")
+        return results
+
+
+class WorkerPool():
+    """
+    Persistent local worker daemons (see worker.serve), which load the model and data once and run tasks sent
+    over pipes. The pool persists across pipelines (e.g. perturbing features, then interactions) until closed.
+    """
+    instance = None
+
+    def __init__(self, args, logger):
+        self.logger = logger
+        self.key = (args.model_generator_filename, args.data_filename, args.local_workers)
+        context = multiprocessing.get_context("spawn")
+        self.connections = []
+        self.processes = []
+        for daemon_idx in range(args.local_workers):
+            connection, daemon_connection = context.Pipe()
+            log_filename = "%s/daemon_%d.log" % (args.output_dir, daemon_idx)
+            process = context.Process(target=worker.serve, daemon=True,
+                                      args=(daemon_connection, args.model_generator_filename, args.data_filename, log_filename))
+            process.start()
+            daemon_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.logger.info("Started %d worker daemons" % args.local_workers)
+
+    @classmethod
+    def get(cls, args, logger):
+        """Get pool of worker daemons for given model and data, starting it if required"""
+        if cls.instance and cls.instance.key != (args.model_generator_filename, args.data_filename, args.local_workers):
+            cls.close()
+        if not cls.instance:
+            cls.instance = cls(args, logger)
+        return cls.instance
+
+    @classmethod
+    def close(cls):
+        """Gracefully shut down worker daemons, if running, once they complete their current tasks"""
+        if not cls.instance:
+            return
+        pool, cls.instance = cls.instance, None
+        for connection in pool.connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass  # Daemon already exited
+        for process in pool.processes:
+            process.join(constants.WORKER_DAEMON_SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        pool.logger.info("Shut down %d worker daemons" % len(pool.processes))
+
+    def run(self, tasks, task_progress):
+        """
+        Run tasks on worker daemons, sending each daemon its next task once it completes its previous task,
+        and reporting progress (progress.Progress) periodically
+        """
+        pending = list(reversed(tasks))
+        idle = list(self.connections)
+        busy = set()
+        latencies = []
+        while pending or busy:
+            while pending and idle:
+                connection = idle.pop()
+                connection.send(pending.pop())
+                busy.add(connection)
+            task_progress.report()
+            for connection in wait(busy, timeout=constants.PROGRESS_INTERVAL):
+                try:
+                    task_idx, latency, error = connection.recv()
+                except EOFError:
+                    raise RuntimeError("Worker daemon exited unexpectedly")
+                if error:
+                    raise RuntimeError("Task %d failed on worker daemon:\n%s" % (task_idx, error))
+                self.logger.info("Task %d completed in %.3f seconds" % (task_idx, latency))
+                latencies.append(latency)
+                busy.remove(connection)
+                idle.append(connection)
+        if latencies:
+            self.logger.info("Worker daemons completed %d tasks, task latency: mean %.3f seconds, max %.3f seconds"
+                             % (len(latencies), np.mean(latencies), np.max(latencies)))
+
+
 class CondorPipeline():
     """Class managing condor pipeline for distributing load across workers"""
 
@@ -55,7 +189,9 @@ class CondorPipeline():
         assert self.master_args.memory_requirement >= 1, "Required memory must be 1 or more GB"
         self.memory_requirement = str(self.master_args.memory_requirement)
         self.script_dir = os.path.dirname(os.path.abspath(__file__))
-        self.task_count = math.ceil(len(self.feature_nodes) / self.master_args.features_per_worker)
+        self.tiles = get_tiles(self.master_args, self.feature_nodes, self.master_args.features_per_worker)
+        self.task_count = len(self.tiles)
+        self.progress = None  # Progress of tasks, while running
 
     @staticmethod
     def get_output_filepath(targs, prefix, suffix="txt"):
@@ -63,8 +199,21 @@ class CondorPipeline():
         return "%s/%s_worker_%d.%s" % (targs.output_dir, prefix, targs.task_idx, suffix)
 
     def write_features(self, targs, task_features):
-        """Write features to file"""
+        """
+        Write features to file.
+        Interaction pairs are written to a separate pairs file, with the features file listing the features they reference.
+        """
         targs.features_filename = self.get_output_filepath(targs, "features")
+        targs.pairs_filename = ""
+        pairs = [item for item in task_features if isinstance(item, InteractionPair)]
+        if pairs:
+            targs.pairs_filename = self.get_output_filepath(targs, "pairs")
+            with open(targs.pairs_filename, "w", newline="") as pairs_file:
+                writer = csv.writer(pairs_file)
+                writer.writerow([constants.NODE_NAME, constants.CACHED_NODE_NAME, constants.REDO_NODE_NAME, constants.RNG_SEED])
+                for pair in pairs:
+                    writer.writerow([pair.name, pair.cached.name, pair.redo.name, pair.rng_seed])
+            task_features = list({node.name: node for pair in pairs for node in (pair.cached, pair.redo)}.values())
         with open(targs.features_filename, "w", newline="") as features_file:
             writer = csv.writer(features_file)
             writer.writerow([constants.NODE_NAME, constants.RNG_SEED,
@@ -104,6 +253,7 @@ class CondorPipeline():
         task[constants.CMD] = "condor_submit %s" % submit_filename
         task[constants.ATTEMPT] = 0
         task[constants.NORMAL_FAILURE_COUNT] = 0
+        task[constants.TASK_IDX] = targs.task_idx
         return task
 
     def launch_tasks(self, tasks):
@@ -116,6 +266,9 @@ class CondorPipeline():
         if task[constants.ATTEMPT] < constants.MAX_ATTEMPTS:
             task[constants.ATTEMPT] += 1
             self.logger.info("\nAttempt %d: running cmd: '%s'" % (task[constants.ATTEMPT], task[constants.CMD]))
+            if task[constants.ATTEMPT] > 1:
+                trace.add_spans(self.master_args.output_dir, [trace.span(task[constants.TASK_IDX], "retry", time.time(),
+                                                                         attempt=task[constants.ATTEMPT])])
             try:
                 output = subprocess.check_output(task[constants.CMD], shell=True).decode("utf-8")
                 self.logger.info(output)
@@ -149,6 +302,7 @@ class CondorPipeline():
             release_tasks = []
             unfinished_tasks = 0
             time.sleep(30)
+            self.progress.report(force=True)
             for task in tasks:
                 if constants.JOB_COMPLETE in task:
                     continue
@@ -162,17 +316,20 @@ class CondorPipeline():
                 for line in reversed(lines):
                     if line.find(constants.ABNORMAL_TERMINATION) >= 0:
                         self.logger.warn("Cmd '%s' failed due to abnormal termination. Re-attempting..." % task[constants.CMD])
+                        self.trace_attempt(task, "abnormal termination")
                         rerun_tasks.append(task)
                         task_updated = True
                         break
                     if line.find(constants.NORMAL_TERMINATION_SUCCESS) >= 0:
                         self.logger.info("Cmd '%s' completed successfully" % task[constants.CMD])
+                        self.trace_attempt(task, "completed")
                         task[constants.JOB_COMPLETE] = 1
                         unfinished_tasks -= 1
                         task_updated = True
                         break
                     if line.find(constants.NORMAL_TERMINATION_FAILURE) >= 0:
                         task[constants.NORMAL_FAILURE_COUNT] += 1
+                        self.trace_attempt(task, "invalid return code")
                         if task[constants.NORMAL_FAILURE_COUNT] > constants.MAX_NORMAL_FAILURE_COUNT:
                             self.logger.error("Cmd '%s' terminated with invalid return code. Reached maximum number of "
                                               "normal failures %d on condor workers, attempting in master node." %
@@ -189,6 +346,7 @@ class CondorPipeline():
                         task_updated = True
                         break
                     if line.find(constants.JOB_HELD) >= 0:
+                        trace.add_spans(self.master_args.output_dir, [trace.span(task[constants.TASK_IDX], "held", time.time())])
                         release_tasks.append(task)
                         task_updated = True
                         break
@@ -208,6 +366,7 @@ class CondorPipeline():
                         schedule_rerun = True
 
                     if schedule_rerun:
+                        self.trace_attempt(task, "timed out")
                         subprocess.call("condor_rm %d" % task[constants.CLUSTER], shell=True)
                         rerun_tasks.append(task)
 
@@ -253,21 +412,22 @@ class CondorPipeline():
             os.remove(kill_filename)
         self.logger.info("All workers completed running successfully, cleaning up condor files")
 
+    def trace_attempt(self, task, outcome):
+        """Record span of task's current attempt, from submission until its outcome was observed"""
+        trace.add_spans(self.master_args.output_dir, [trace.span(task[constants.TASK_IDX], "attempt %d" % task[constants.ATTEMPT],
+                                                                 task[constants.JOB_START_TIME].timestamp(), time.time(),
+                                                                 submitted=True, outcome=outcome)])
+
     def create_tasks(self):
         """Create condor task setup"""
         tasks = []
-        task_idx = 0
-        node_idx = 0
-        while node_idx < len(self.feature_nodes):
+        for task_idx, (task_features, record_indices, _) in enumerate(self.tiles):
             targs = copy.deepcopy(self.master_args)
             targs.task_idx = task_idx
-            task_features = self.feature_nodes[node_idx:min(len(self.feature_nodes), node_idx + targs.features_per_worker)]
+            targs.record_indices = record_indices
             self.write_features(targs, task_features)
             self.write_arguments(targs)
             tasks.append(self.write_submit_file(targs))
-            task_idx += 1
-            node_idx += targs.features_per_worker
-        assert task_idx == self.task_count
         return tasks
 
     def compile_results(self):
@@ -275,48 +435,93 @@ class CondorPipeline():
         self.logger.info("Compiling condor task results")
         all_losses = {}
         all_predictions = {}
-        targets = None
-        for task_idx in range(self.task_count):
+        all_num_trials = {}
+        all_targets = {}
+        num_records = max([record_slice.stop for _, _, record_slice in self.tiles if record_slice], default=None)
+        spans = []
+        for task_idx, (_, _, record_slice) in enumerate(self.tiles):
+            start_time = time.time()
             results_filename = "results_worker_%d.hdf5" % task_idx
             self.logger.info("Processing %s" % results_filename)
             root = h5py.File("%s/%s" % (self.master_args.output_dir, results_filename), "r")
 
-            def load_data(group):
-                """Helper function to load data"""
-                results = {}
+            def load_data(results, group):
+                """Helper function to load data, stitching together tiles of records"""
                 for feature_id, feature_data in group.items():
-                    results[feature_id] = feature_data[...]
-                return results
-
-            all_losses.update(load_data(root[constants.LOSSES]))
-            all_predictions.update(load_data(root[constants.PREDICTIONS]))
-            if task_idx == 0:
-                # Only first worker outputs labels since they're common
-                targets = root[constants.TARGETS][...]
-        assert targets is not None
-        return targets, all_losses, all_predictions
+                    if record_slice is None:
+                        results[feature_id] = feature_data[...]
+                    else:
+                        shape = (num_records,) + feature_data.shape[1:]  # Matrices over records X outputs for multi-output models
+                        results.setdefault(feature_id, np.empty(shape, dtype=feature_data.dtype))[record_slice] = feature_data[...]
+
+            if constants.LOSSES in root:
+                load_data(all_losses, root[constants.LOSSES])
+            load_data(all_predictions, root[constants.PREDICTIONS])
+            if constants.NUM_TRIALS in root:
+                load_data(all_num_trials, root[constants.NUM_TRIALS])
+            load_data(all_targets, {constants.TARGETS: root[constants.TARGETS]})  # Targets are common across features
+            root.close()
+            spans.append(trace.span(task_idx, "compile_results", start_time, time.time()))
+        trace.add_spans(self.master_args.output_dir, spans)
+        assert constants.TARGETS in all_targets
+        if self.master_args.losses:
+            # Workers stored only predictions
+            all_losses = compute_losses(self.master_args.losses[0], all_targets[constants.TARGETS], all_predictions,
+                                        self.master_args.model_type)
+        return Results(all_targets[constants.TARGETS], all_losses, all_predictions, all_num_trials)
 
     def cleanup(self):
         """Clean files after completion"""
         self.logger.info("Begin intermediate condor file cleanup")
-        filetypes = ["err*", "out*", "log*", "args*", "condor_task*", "results*", "features*", "worker*"]
+        filetypes = ["err*", "out*", "log*", "args*", "condor_task*", "results*", "features*", "pairs*", "worker*", "heartbeat*"]
         for filetype in filetypes:
             for filename in glob.glob("%s/%s" % (self.master_args.output_dir, filetype)):
-                os.remove(filename)
+                if os.path.isfile(filename):  # Not results directories, e.g. output_<idx> or log_loss
+                    os.remove(filename)
         self.logger.info("End intermediate condor file cleanup")
 
     def run(self):
         """Run condor pipeline"""
         self.logger.info("Begin condor pipeline")
         if not self.master_args.compile_results_only:
-            tasks = self.create_tasks()
-            self.launch_tasks(tasks)
-            self.monitor_tasks(tasks)
-        targets, losses, predictions = self.compile_results()
+            with metrics.phase(self.master_args.output_dir, type(self).__name__, "run_tasks") as metrics_fields:
+                metrics_fields["num_tasks"] = self.task_count
+                tasks = self.create_tasks()
+                self.progress = progress.Progress(self.master_args, self.logger, type(self).__name__, self.tiles)
+                self.launch_tasks(tasks)
+                self.monitor_tasks(tasks)
+                self.progress.report(force=True)
+        with metrics.phase(self.master_args.output_dir, type(self).__name__, "compile_results"):
+            results = self.compile_results()
+        profiling.merge_worker_profiles(self.master_args, self.logger, self.task_count)
         if self.master_args.cleanup:
             self.cleanup()
         self.logger.info("End condor pipeline")
-        return targets, losses, predictions
+        return results
+
+
+def get_tiles(args, feature_nodes, features_per_worker):
+    """
+    Partition work into tiles of features X records, of up to the given number of features and
+    up to -records_per_worker records (default all records).
+
+    Returns:
+        list of (features, record indices, record slice) tuples, where the record indices (as in args.record_indices)
+        are the records perturbed by the tile, and the record slice locates them in the compiled results
+        (None if records are not partitioned)
+    """
+    feature_chunks = [feature_nodes[idx: idx + features_per_worker] for idx in range(0, len(feature_nodes), features_per_worker)]
+    if not feature_chunks:
+        feature_chunks = [[]]  # Single featureless tile, so that targets are still compiled
+    if not args.records_per_worker:
+        return [(features, args.record_indices, None) for features in feature_chunks]
+    record_indices = args.record_indices
+    if record_indices is None:
+        with h5py.File(args.data_filename, "r") as data_root:
+            record_indices = np.arange(len(data_root[constants.RECORD_IDS]))
+    record_slices = [slice(start, min(start + args.records_per_worker, len(record_indices)))
+                     for start in range(0, len(record_indices), args.records_per_worker)]
+    return [(features, record_indices[record_slice], record_slice) for features in feature_chunks for record_slice in record_slices]
 
 
 def round_vectordict(vectordict):
@@ -0,0 +1,76 @@
+"""Profiling of master and worker tasks using cProfile (-profile)"""
+
+import contextlib
+import cProfile
+import os
+import pstats
+
+from mihifepe import constants
+
+# Profilers enabled in this process, innermost last. Profilers cannot be nested, so the enclosing profiler
+# (e.g. the master's, when the serial pipeline runs tasks in the master process) is paused while a task is profiled
+_active_profilers = []
+
+
+@contextlib.contextmanager
+def profile(args, name):
+    """
+    Profile enclosed code if -profile is enabled, writing stats to <output_dir>/profile_<name>.prof
+
+    Args:
+        args: arguments passed down from master
+        name: name of profiled component, e.g. master or worker_<task_idx>
+    """
+    if not args.profile:
+        yield
+        return
+    profiler = cProfile.Profile()
+    if _active_profilers:
+        _active_profilers[-1].disable()
+    _active_profilers.append(profiler)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats("%s/profile_%s.prof" % (args.output_dir, name))
+        _active_profilers.pop()
+        if _active_profilers:
+            _active_profilers[-1].enable()
+
+
+def reset(output_dir):
+    """Remove merged worker profile from previous runs"""
+    filename = "%s/%s" % (output_dir, constants.PROFILE_WORKERS_FILENAME)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def merge_worker_profiles(args, logger, task_count):
+    """
+    Merge profiles of worker tasks into the merged profile of all tasks of the run so far,
+    and write report of hot functions (by own time) across tasks. Tasks without profiles (e.g. tasks that failed
+    before writing them) are skipped with a warning.
+    """
+    if not args.profile or args.compile_results_only:
+        return
+    merged_filename = "%s/%s" % (args.output_dir, constants.PROFILE_WORKERS_FILENAME)
+    filenames = []
+    for task_idx in range(task_count):
+        filename = "%s/profile_worker_%d.prof" % (args.output_dir, task_idx)
+        if os.path.exists(filename):
+            filenames.append(filename)
+        else:
+            logger.warning("Profile %s of worker task %d not found, skipping" % (filename, task_idx))
+    if os.path.exists(merged_filename):
+        filenames.append(merged_filename)
+    if not filenames:
+        logger.warning("No worker profiles found, skipping merging of worker profiles")
+        return
+    stats = pstats.Stats(*filenames)
+    stats.dump_stats(merged_filename)
+    report_filename = "%s/%s" % (args.output_dir, constants.PROFILE_REPORT_FILENAME)
+    with open(report_filename, "w") as report_file:
+        stats.stream = report_file
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(constants.PROFILE_REPORT_LENGTH)
+    logger.info("Merged profiles of %d worker tasks into %s, hot functions listed in %s" % (task_count, merged_filename, report_filename))
@@ -0,0 +1,97 @@
+"""
+Progress reporting: workers write heartbeat files with the records and features they have processed,
+which the master aggregates into overall progress, throughput and ETA, logged and written to a status file
+"""
+
+import glob
+import json
+import os
+import time
+
+import h5py
+
+from mihifepe import constants
+
+
+def write_json(filename, data):
+    """Write JSON file atomically, so that readers never see partially written files"""
+    tmp_filename = "%s.tmp" % filename
+    with open(tmp_filename, "w") as tmp_file:
+        json.dump(data, tmp_file)
+    os.replace(tmp_filename, filename)
+
+
+class Heartbeat():
+    """Worker-side heartbeat, written at most every HEARTBEAT_INTERVAL seconds"""
+    # pylint: disable = too-few-public-methods
+    def __init__(self, args, num_records, num_features):
+        self.filename = "%s/heartbeat_worker_%d.json" % (args.output_dir, args.task_idx)
+        self.num_records = num_records
+        self.num_features = num_features
+        self.last_time = 0
+        self.update(0, force=True)
+
+    def update(self, records_done, force=False):
+        """Write heartbeat with number of records done (by all features), if due or forced"""
+        current_time = time.time()
+        if not force and current_time - self.last_time < constants.HEARTBEAT_INTERVAL:
+            return
+        self.last_time = current_time
+        write_json(self.filename, {"time": current_time, "records_done": records_done, "num_records": self.num_records,
+                                   "num_features": self.num_features})
+
+
+class Progress():
+    """Master-side aggregation of worker heartbeats over the tasks of a pipeline"""
+
+    def __init__(self, args, logger, name, tiles):
+        self.output_dir = args.output_dir
+        self.logger = logger
+        self.name = name
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+        for filename in glob.glob("%s/heartbeat_worker_*.json" % self.output_dir):
+            os.remove(filename)  # Stale heartbeats of previous pipelines
+        num_records = None
+        if any(record_indices is None for _, record_indices, _ in tiles):
+            with h5py.File(args.data_filename, "r") as data_root:
+                num_records = len(data_root[constants.RECORD_IDS])
+        # Expected (records, features) per task, until reported by heartbeat
+        self.expected = [(num_records if record_indices is None else len(record_indices), len(features))
+                         for features, record_indices, _ in tiles]
+
+    def report(self, force=False):
+        """Log progress and write status file, if PROGRESS_INTERVAL seconds have passed since the last report or forced"""
+        current_time = time.time()
+        if not force and current_time - self.last_report_time < constants.PROGRESS_INTERVAL:
+            return
+        self.last_report_time = current_time
+        work_done, work_total, records_done, tasks_done = 0, 0, 0, 0
+        for task_idx, (num_records, num_features) in enumerate(self.expected):
+            heartbeat = self.read_heartbeat(task_idx)
+            task_records_done = 0
+            if heartbeat:
+                num_records, num_features = heartbeat["num_records"], heartbeat["num_features"]
+                task_records_done = heartbeat["records_done"]
+                tasks_done += task_records_done == num_records
+            work_done += task_records_done * num_features
+            work_total += num_records * num_features
+            records_done += task_records_done
+        elapsed = current_time - self.start_time
+        fraction = work_done / work_total if work_total else 1.
+        status = {"pipeline": self.name, "time": current_time, "elapsed_seconds": elapsed,
+                  "tasks_done": tasks_done, "num_tasks": len(self.expected), "percent_complete": 100. * fraction,
+                  "records_per_second": records_done / elapsed if elapsed > 0 else None,
+                  "eta_seconds": elapsed * (1 - fraction) / fraction if fraction else None}
+        write_json("%s/%s" % (self.output_dir, constants.STATUS_FILENAME), status)
+        self.logger.info("Progress: %.1f%% complete (%d of %d tasks), %.1f records/sec, ETA %s"
+                         % (status["percent_complete"], tasks_done, len(self.expected), status["records_per_second"] or 0.,
+                            "unknown" if status["eta_seconds"] is None else "%.0f seconds" % status["eta_seconds"]))
+
+    def read_heartbeat(self, task_idx):
+        """Read heartbeat of task, if written"""
+        try:
+            with open("%s/heartbeat_worker_%d.json" % (self.output_dir, task_idx), "r") as heartbeat_file:
+                return json.load(heartbeat_file)
+        except (OSError, ValueError):
+            return None
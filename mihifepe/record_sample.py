@@ -0,0 +1,102 @@
+"""Approximate analysis over a (stratified) sample of records, and reuse of sampled results by a subsequent full run"""
+
+import h5py
+import numpy as np
+
+from mihifepe import constants
+from mihifepe.pipelines import Results
+
+
+def sample_records(args, logger, sample_size):
+    """
+    Select reproducible sample of record indices, of given size (number of records if greater than 1,
+    else fraction of records). With -stratify_record_sample, the sample is stratified by target: by label
+    for classifiers, and by target quantiles for regression models.
+
+    Returns:
+        sorted array of indices of sampled records
+    """
+    with h5py.File(args.data_filename, "r") as data_root:
+        targets = data_root[constants.TARGETS][...]
+    num_records = len(targets)
+    sample_size = sample_size if sample_size > 1 else sample_size * num_records
+    sample_size = min(int(round(sample_size)), num_records)
+    rng = np.random.RandomState(constants.SEED)
+    if not args.stratify_record_sample:
+        indices = rng.choice(num_records, sample_size, replace=False)
+    else:
+        strata = get_strata(args, targets)
+        # Allocate sample proportionally to strata, distributing records left over by rounding down by largest remainder
+        stratum_ids, stratum_sizes = np.unique(strata, return_counts=True)
+        allocation = sample_size * stratum_sizes / num_records
+        stratum_sample_sizes = np.floor(allocation).astype(int)
+        remainders = np.argsort(-(allocation - stratum_sample_sizes), kind="mergesort")
+        stratum_sample_sizes[remainders[:sample_size - np.sum(stratum_sample_sizes)]] += 1
+        indices = np.concatenate([rng.choice(np.flatnonzero(strata == stratum_id), stratum_sample_size, replace=False)
+                                  for stratum_id, stratum_sample_size in zip(stratum_ids, stratum_sample_sizes)])
+    indices.sort()
+    logger.info("Record sample: selected %d of %d records" % (len(indices), num_records))
+    return indices
+
+
+def get_strata(args, targets):
+    """
+    Stratum of each record: its label for classifiers, or its target quantile bin for regression models.
+    Multi-output models are stratified by the label of one-hot targets, or by the quantile bin of the mean target.
+    """
+    if targets.ndim > 1:
+        targets = np.argmax(targets, axis=1) if args.model_type != constants.REGRESSION else np.mean(targets, axis=1)
+    if args.model_type != constants.REGRESSION:
+        return targets
+    edges = np.quantile(targets, np.linspace(0, 1, constants.NUM_REGRESSION_STRATA + 1)[1:-1])
+    return np.digitize(targets, edges)
+
+
+def save_record_sample(args, logger, results):
+    """Save sampled results, allowing a subsequent full run to reuse them"""
+    filename = "%s/%s" % (args.output_dir, constants.RECORD_SAMPLE_FILENAME)
+    logger.info("Saving sampled results to %s" % filename)
+    with h5py.File(filename, "w") as root:
+        root.create_dataset(constants.RECORD_INDICES, data=args.record_indices)
+        root.create_dataset(constants.TARGETS, data=results.targets)
+        for group_name, data in [(constants.LOSSES, results.losses), (constants.PREDICTIONS, results.predictions),
+                                 (constants.NUM_TRIALS, results.num_trials)]:
+            group = root.create_group(group_name)
+            for feature_id, feature_data in data.items():
+                group.create_dataset(feature_id, data=feature_data)
+
+
+def load_record_sample(filename):
+    """Load sampled results saved by save_record_sample"""
+    with h5py.File(filename, "r") as root:
+        indices = root[constants.RECORD_INDICES][...]
+        outputs = [{feature_id: feature_data[...] for feature_id, feature_data in root[group_name].items()}
+                   for group_name in (constants.LOSSES, constants.PREDICTIONS, constants.NUM_TRIALS)]
+        return indices, Results(root[constants.TARGETS][...], *outputs)
+
+
+def get_complement(args, indices):
+    """Sorted array of indices of records not in given sample"""
+    with h5py.File(args.data_filename, "r") as data_root:
+        num_records = len(data_root[constants.RECORD_IDS])
+    return np.setdiff1d(np.arange(num_records), indices)
+
+
+def merge_results(sample_indices, sample_results, complement_indices, complement_results):
+    """Merge results over sampled records with results over remaining records, ordered by record index"""
+    num_records = len(sample_indices) + len(complement_indices)
+
+    def merge(sample_data, complement_data):
+        """Merge vectors (or matrices over records X outputs) over sample and complement"""
+        data = np.empty((num_records,) + complement_data.shape[1:], dtype=complement_data.dtype)
+        data[sample_indices] = sample_data
+        data[complement_indices] = complement_data
+        return data
+
+    outputs = []
+    for sample_outputs, complement_outputs in zip(sample_results[1:], complement_results[1:]):
+        missing = set(complement_outputs.keys()).difference(sample_outputs.keys())
+        assert not missing, "Reused record sample lacks results for features: %s" % sorted(missing)
+        outputs.append({feature_id: merge(sample_outputs[feature_id], feature_data)
+                        for feature_id, feature_data in complement_outputs.items()})
+    return Results(merge(sample_results.targets, complement_results.targets), *outputs)
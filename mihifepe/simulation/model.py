@@ -52,6 +52,41 @@ class Model():
         loss = self.loss(prediction, target)
         return (loss, prediction)
 
+    def predict_batch(self, target, static_data, temporal_data):
+        """
+        Predicts the model's outputs for multiple (perturbed) versions of the same instance in a single call.
+        Outputs are identical to calling predict on each version.
+
+        Args:
+            target:         classification label or regression output (scalar value)
+            static_data:    static data (matrix, one row per version of instance)
+            temporal_data:  temporal data (list, one element per version of instance)
+
+        Returns:
+            losses:         model's output losses (vector, one element per version of instance)
+            predictions:    model's output predictions (vector, one element per version of instance)
+        """
+        num_rows, num_features = static_data.shape
+        data = static_data.transpose()  # Model function takes one vector (over versions of instance) per feature
+        noise = []
+        if self.noise_type == constants.EPSILON_IRRELEVANT:
+            noise = np.zeros((num_rows, num_features))
+        elif self.noise_type == constants.ADDITIVE_GAUSSIAN:
+            noise = np.zeros(num_rows)
+        elif self.noise_type != constants.NO_NOISE:
+            raise NotImplementedError("Unknown noise type")
+        if self.noise_type != constants.NO_NOISE:
+            for idx, row in enumerate(static_data):
+                self.rng.seed(hashxx(row.data.tobytes()))
+                if self.noise_type == constants.EPSILON_IRRELEVANT:
+                    noise[idx] = self.noise_multiplier * self.rng.uniform(-1, 1, num_features)
+                else:
+                    noise[idx] = self.rng.normal(0, self.noise_multiplier)
+            noise = noise.transpose()
+        predictions = np.zeros(num_rows) + self.model_fn(data, noise)  # Broadcast in case model function is constant
+        losses = self.loss(predictions, target)
+        return (losses, predictions)
+
     @staticmethod
     def loss(prediction, target):
         """Compute RMSE"""
@@ -14,13 +14,13 @@ import anytree
 from anytree.importer import JsonImporter
 import h5py
 import numpy as np
-from scipy.cluster.hierarchy import linkage
-import sympy
-from sympy.utilities.lambdify import lambdify
-from sklearn.metrics import precision_recall_fscore_support
 
 from mihifepe import constants, master, utils
 from mihifepe.fdr import hierarchical_fdr_control
+from mihifepe.interactions import get_interaction_filenames
+
+# Heavy dependencies (scipy, sympy, sklearn) are imported where used, so that code paths not using them don't pay for them
+# pylint: disable = import-outside-toplevel
 
 # TODO maybe: write arguments to separate readme.txt for documentating runs
 
@@ -48,7 +48,10 @@ def main():
     parser.add_argument("-clustering_instance_count", type=int, help="If provided, uses this number of instances to "
                         "cluster the data to generate a hierarchy, allowing the hierarchy to remain same across multiple "
                         "sets of instances", default=0)
-    parser.add_argument("-num_interactions", type=int, default=0, help="number of interaction pairs in model")
+    parser.add_argument("-num_interactions", type=int, default=0, help="number of interaction terms in model")
+    parser.add_argument("-interaction_order", type=int, default=2, help="number of features in each interaction term in"
+                        " model (default 2: pairwise). Also passed to mihifepe.master as the maximum order of interactions"
+                        " to test, when analyzing interactions")
     parser.add_argument("-exclude_interaction_only_features", help="exclude interaction-only features in model"
                         " in addition to linear + interaction features (default included)", action="store_false",
                         dest="include_interaction_only_features")
@@ -186,6 +189,7 @@ def cluster_data(args, data):
     """Cluster data using hierarchical clustering with Hamming distance"""
     # Cluster data
     args.logger.info("Begin clustering data")
+    from scipy.cluster.hierarchy import linkage
     clusters = linkage(data.transpose(), metric="hamming", method="complete")
     args.logger.info("End clustering data")
     return clusters
@@ -221,6 +225,8 @@ def gen_polynomial(args, relevant_features):
     """Generate polynomial which decides the ground truth and noisy model"""
     # Note: using sympy to build function appears to be 1.5-2x slower than erstwhile raw numpy implementation (for linear terms)
     # TODO: possibly negative coefficients
+    import sympy
+    from sympy.utilities.lambdify import lambdify
     sym_features = sympy.symbols(["x%d" % x for x in range(args.num_features)])
     relevant_feature_map = {}  # map of relevant feature sets to coefficients
     # Generate polynomial expression
@@ -261,13 +267,13 @@ def get_relevant_features(args):
 
 
 def update_interaction_terms(args, relevant_features, relevant_feature_map, sym_features, sym_polynomial_fn):
-    """Pairwise interaction terms for polynomial"""
-    # TODO: higher-order interactions
+    """Interaction terms for polynomial (pairwise by default, of order -interaction_order in general)"""
+    from scipy.special import comb
     num_relevant_features = len(relevant_features)
-    num_interactions = min(args.num_interactions, num_relevant_features * (num_relevant_features - 1) / 2)
+    num_interactions = min(args.num_interactions, comb(num_relevant_features, args.interaction_order, exact=True))
     if not num_interactions:
         return sym_polynomial_fn
-    potential_pairs = list(itertools.combinations(sorted(relevant_features), 2))
+    potential_pairs = list(itertools.combinations(sorted(relevant_features), args.interaction_order))
     potential_pairs_arr = np.empty(len(potential_pairs), dtype=np.object)
     potential_pairs_arr[:] = potential_pairs
     interaction_pairs = args.rng.choice(potential_pairs_arr, size=num_interactions, replace=False)
@@ -410,6 +416,8 @@ def run_mihifepe(args, pass_args, data_filename, hierarchy_filename, gen_model_f
     """Run mihifepe algorithm"""
     args.logger.info("Begin running mihifepe")
     analyze_interactions = "-analyze_interactions" if args.analyze_interactions else ""
+    if args.analyze_interactions and args.interaction_order > 2:
+        analyze_interactions += " -interaction_order %d" % args.interaction_order
     args.logger.info("Passing the following arguments to mihifepe.master without parsing: %s" % pass_args)
     memory_requirement = 1 + (os.stat(data_filename).st_size // (2 ** 30))  # Compute approximate memory requirement in GB
     cmd = ("python -m mihifepe.master -data_filename %s -hierarchy_filename %s -model_generator_filename %s -output_dir %s "
@@ -464,6 +472,8 @@ def evaluate(args, relevant_feature_map, feature_id_map):
     Evaluate mihifepe results - obtain power/FDR measures for all nodes/outer nodes/base features/interactions
     """
     # pylint: disable = too-many-locals
+    from sklearn.metrics import precision_recall_fscore_support
+
     def get_relevant_rejected(nodes, outer=False, leaves=False):
         """Get set of relevant and rejected nodes"""
         assert not (outer and leaves)
@@ -500,34 +510,39 @@ def get_precision_recall_interactions(args, relevant_feature_map, feature_id_map
     # pylint: disable = invalid-name, too-many-locals
     # The set of all possible interactions might be very big, so don't construct label vector for all
     # possible interactions - compute precision/recall from basics
-    # TODO: alter to handle higher-order interactions
     if not args.analyze_interactions:
         return (0.0, 0.0)
-    true_interactions = {key for key in relevant_feature_map.keys() if len(key) > 1}
-    tree_filename = "%s/%s/%s.json" % (args.output_dir, constants.INTERACTIONS_FDR_DIR, constants.HIERARCHICAL_FDR_OUTPUTS)
+    # An interaction term among k features also manifests as interactions among each of its subsets of 2 or more features
+    true_interactions = {frozenset(subset) for key in relevant_feature_map.keys() if len(key) > 1
+                         for size in range(2, len(key) + 1) for subset in itertools.combinations(key, size)}
     tp = 0
     fp = 0
     tn = 0
     fn = 0
     tested = set()
-    with open(tree_filename, "r") as tree_file:
-        tree = JsonImporter().read(tree_file)
-        # Two-level tree with tested interactions on level 2
-        for node in tree.children:
-            pair = frozenset({int(idx) for idx in node.name.split(" + ")})
-            if feature_id_map:
-                pair = frozenset({feature_id_map[visual_id] for visual_id in pair})
-            tested.add(pair)
-            if node.rejected:
-                if relevant_feature_map.get(pair):
-                    tp += 1
-                else:
-                    fp += 1
-            else:
-                if relevant_feature_map.get(pair):
-                    fn += 1
+    for order in range(2, args.interaction_order + 1):
+        results_filename = "%s/%s.csv" % (get_interaction_filenames(args, order)[1], constants.HIERARCHICAL_FDR_OUTPUTS)
+        if not os.path.exists(results_filename):
+            break  # No candidate interactions of this order were tested
+        with open(results_filename, "r") as results_file:
+            # Tested interactions are listed as children of dummy root node
+            for row in csv.DictReader(results_file):
+                if row[constants.NODE_NAME] == constants.DUMMY_ROOT:
+                    continue
+                interaction = frozenset({int(idx) for idx in row[constants.NODE_NAME].split(" + ")})
+                if feature_id_map:
+                    interaction = frozenset({feature_id_map[visual_id] for visual_id in interaction})
+                tested.add(interaction)
+                if int(row[constants.REJECTED_STATUS]):
+                    if interaction in true_interactions:
+                        tp += 1
+                    else:
+                        fp += 1
                 else:
-                    tn += 1
+                    if interaction in true_interactions:
+                        fn += 1
+                    else:
+                        tn += 1
     if not tp > 0:
         return (0.0, 0.0)
     missed = true_interactions.difference(tested)
@@ -0,0 +1,97 @@
+"""
+Timeline of a run in Chrome trace-event format (viewable in chrome://tracing or Perfetto),
+combining the phases recorded in the metrics file with spans of tasks observed by the pipelines
+(e.g. condor attempts, retries and compilation of task results)
+"""
+
+import json
+import os
+
+from mihifepe import constants
+
+# Process IDs grouping tracks in trace
+MASTER_PID = 0
+TASKS_PID = 1
+
+
+def add_spans(output_dir, spans):
+    """
+    Append spans to spans file
+
+    Args:
+        output_dir: output directory
+        spans:      list of dictionaries as returned by span
+    """
+    if not spans:
+        return
+    with open("%s/%s" % (output_dir, constants.TRACE_SPANS_FILENAME), "a") as spans_file:
+        spans_file.write("".join(json.dumps(span) + "\n" for span in spans))
+
+
+def span(task_idx, name, start_time, end_time=None, **args):
+    """Span of given task from start to end time (epoch seconds), or instant event if end time is None"""
+    return dict(task_idx=task_idx, name=name, start_time=start_time, end_time=end_time, args=args)
+
+
+def reset(output_dir):
+    """Remove spans from previous runs"""
+    filename = "%s/%s" % (output_dir, constants.TRACE_SPANS_FILENAME)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def write_trace(output_dir):
+    """
+    Write trace combining metrics file and spans file, with one track for master phases, one per pipeline class
+    and one per task. Time spent by condor tasks in the queue is shown as idle spans, from submission until the
+    first worker phase of the attempt.
+
+    Returns:
+        trace filename
+    """
+    # pylint: disable = too-many-locals
+    events = []
+    master_tracks = {"master": 0}
+    task_phases = {}
+    with open("%s/%s" % (output_dir, constants.METRICS_FILENAME), "r") as metrics_file:
+        for line in metrics_file:
+            metrics = json.loads(line)
+            args = {key: value for key, value in metrics.items() if key not in ("source", "phase", "start_time", "wall_seconds")}
+            event = dict(name=metrics["phase"], cat=metrics["source"], ph="X", ts=metrics["start_time"] * 1e6,
+                         dur=metrics["wall_seconds"] * 1e6, args=args)
+            if metrics["source"].startswith("worker_"):
+                task_idx = int(metrics["source"][len("worker_"):])
+                event.update(pid=TASKS_PID, tid=task_idx)
+                task_phases.setdefault(task_idx, []).append(metrics["start_time"])
+            else:
+                event.update(pid=MASTER_PID, tid=master_tracks.setdefault(metrics["source"], len(master_tracks)))
+            events.append(event)
+    spans_filename = "%s/%s" % (output_dir, constants.TRACE_SPANS_FILENAME)
+    spans = []
+    if os.path.exists(spans_filename):
+        with open(spans_filename, "r") as spans_file:
+            spans = [json.loads(line) for line in spans_file]
+    for task_span in spans:
+        task_idx, start_time, end_time = task_span["task_idx"], task_span["start_time"], task_span["end_time"]
+        event = dict(name=task_span["name"], cat="task", pid=TASKS_PID, tid=task_idx, ts=start_time * 1e6, args=task_span["args"])
+        if end_time is None:
+            event.update(ph="i", s="t")
+        else:
+            event.update(ph="X", dur=(end_time - start_time) * 1e6)
+            if task_span["args"].get("submitted"):
+                run_start_times = [phase_start for phase_start in task_phases.get(task_idx, []) if start_time <= phase_start <= end_time]
+                if run_start_times:
+                    events.append(dict(name="idle", cat="task", ph="X", pid=TASKS_PID, tid=task_idx, ts=start_time * 1e6,
+                                       dur=(min(run_start_times) - start_time) * 1e6, args={}))
+        events.append(event)
+    # Track names
+    events.append(dict(name="process_name", ph="M", pid=MASTER_PID, args={"name": "master"}))
+    events.append(dict(name="process_name", ph="M", pid=TASKS_PID, args={"name": "tasks"}))
+    for source, tid in master_tracks.items():
+        events.append(dict(name="thread_name", ph="M", pid=MASTER_PID, tid=tid, args={"name": source}))
+    for task_idx in sorted(set(task_phases).union(task_span["task_idx"] for task_span in spans)):
+        events.append(dict(name="thread_name", ph="M", pid=TASKS_PID, tid=task_idx, args={"name": "task %d" % task_idx}))
+    trace_filename = "%s/%s" % (output_dir, constants.TRACE_FILENAME)
+    with open(trace_filename, "w") as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+    return trace_filename
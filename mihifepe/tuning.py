@@ -0,0 +1,75 @@
+"""
+Automatic tuning (-auto_tune) of task granularity and per-task memory requirement, from the shape of the data,
+the number of features and a short timed probe of the model
+"""
+
+import copy
+import math
+import time
+
+import h5py
+import numpy as np
+
+from mihifepe import constants, metrics, worker
+from mihifepe.feature import Feature
+
+
+def auto_tune(args, logger, feature_nodes):
+    """
+    Set -features_per_worker (and -records_per_worker, if perturbing a single feature over all records would exceed
+    the target task duration) from the time taken by the model per perturbed record and feature, measured by a probe
+    over -tuning_probe_records records, and set -memory_requirement from the data held by a task of that size.
+    Without a probe (-tuning_probe_records 0), only the memory requirement is tuned.
+    """
+    with h5py.File(args.data_filename, "r") as data_root:
+        static_shape = data_root[constants.STATIC].shape
+        itemsize = data_root[constants.STATIC].dtype.itemsize
+    num_records = static_shape[0]
+    num_static = static_shape[1] if len(static_shape) > 1 else 0
+    model_bytes = 0
+    if args.tuning_probe_records:
+        seconds_per_evaluation, model_bytes = probe(args, logger, feature_nodes)
+        seconds_per_feature = seconds_per_evaluation * num_records
+        args.features_per_worker = int(max(1, min(len(feature_nodes), args.target_task_duration // seconds_per_feature)))
+        if seconds_per_feature > args.target_task_duration and not args.sequential_testing and not args.records_per_worker:
+            args.records_per_worker = int(max(1, args.target_task_duration // seconds_per_evaluation))
+        logger.info("Auto-tuning: model takes %.6f seconds per record and feature, estimated task duration %.1f seconds"
+                    % (seconds_per_evaluation, args.features_per_worker * seconds_per_evaluation
+                       * min(num_records, args.records_per_worker or num_records)))
+    # Memory held by a task: data for its records (and all records as donors for shuffling), batched perturbed inputs
+    # for a record, outputs (losses and predictions per model output, numbers of trials) for its features, and the model
+    task_records = min(num_records, args.records_per_worker or num_records)
+    num_trials = args.num_shuffling_trials if args.perturbation == constants.SHUFFLING else 1
+    data_bytes = task_records * num_static * itemsize
+    if args.perturbation == constants.SHUFFLING:
+        data_bytes += num_records * num_static * itemsize
+    inputs_bytes = args.features_per_worker * num_trials * num_static * itemsize
+    outputs_bytes = (2 * args.num_outputs + 1) * args.features_per_worker * task_records * np.dtype(np.float64).itemsize
+    memory_bytes = (constants.TASK_MEMORY_OVERHEAD + data_bytes + inputs_bytes + outputs_bytes + model_bytes) * constants.TASK_MEMORY_SAFETY_FACTOR
+    args.memory_requirement = max(1, math.ceil(memory_bytes / 2 ** 30))
+    logger.info("Auto-tuning: -features_per_worker %d, -records_per_worker %d, -memory_requirement %d GB"
+                % (args.features_per_worker, args.records_per_worker, args.memory_requirement))
+
+
+def probe(args, logger, feature_nodes):
+    """
+    Time the model over a few records and features
+
+    Returns:
+        seconds per perturbed record and feature, bytes of memory used by loading the model
+    """
+    peak_rss = metrics.get_peak_rss_bytes() or 0
+    model = worker.load_model(logger, args.model_generator_filename)
+    model_bytes = max(0, (metrics.get_peak_rss_bytes() or 0) - peak_rss)
+    pargs = copy.deepcopy(args)
+    pargs.sequential_testing = False
+    features = [Feature(node.name, rng_seed=node.rng_seed, static_indices=node.static_indices, temporal_indices=node.temporal_indices)
+                for node in feature_nodes[:constants.TUNING_PROBE_FEATURES]]
+    with h5py.File(args.data_filename, "r") as data_root:
+        pargs.record_indices = np.arange(min(args.tuning_probe_records, len(data_root[constants.RECORD_IDS])))
+        perturber = worker.Perturber(pargs, features, data_root, model)
+        start_time = time.perf_counter()
+        for record_idx in range(perturber.num_records):
+            perturber.perturb_features_for_record(record_idx)
+        elapsed = time.perf_counter() - start_time
+    return elapsed / (perturber.num_records * len(features)), model_bytes
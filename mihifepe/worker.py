@@ -7,15 +7,20 @@ computes the effect on the model's output loss
 import argparse
 import csv
 import importlib
+import math
 import os
 import pickle
 import sys
+import time
+import traceback
 
 import h5py
 import numpy as np
 
-from mihifepe import constants, utils
-from mihifepe.feature import Feature
+from mihifepe import constants, metrics, profiling, progress, utils
+from mihifepe.compute_p_values import sign_test
+from mihifepe.feature import Feature, InteractionPair
+from mihifepe.losses import aggregate_loss
 
 
 def main():
@@ -33,19 +38,62 @@ def main():
 def pipeline(args, logger):
     """Worker pipeline"""
     logger.info("Begin mihifepe worker pipeline")
-    # Load features to perturb from file
-    features = load_features(args.features_filename)
+    source = "worker_%d" % args.task_idx
     # Load data
-    records = load_data(args.data_filename)
+    with metrics.phase(args.output_dir, source, "load_data"):
+        records = load_data(args.data_filename)
     # Load model
-    model = load_model(logger, args.model_generator_filename)
-    # Perturb features
-    targets, losses, predictions = perturb_features(args, logger, features, records, model)
-    # Write outputs
-    write_outputs(args, logger, targets, losses, predictions)
+    with metrics.phase(args.output_dir, source, "load_model"):
+        model = load_model(logger, args.model_generator_filename)
+    # Perturb features and write outputs
+    run_task(args, logger, records, model)
+    records.close()
     logger.info("End mihifepe worker pipeline")
 
 
+def serve(connection, model_generator_filename, data_filename, log_filename):
+    """
+    Worker daemon: loads model and data once, then runs tasks (worker arguments) received over the connection
+    until receiving None. Replies to each task with (task index, latency in seconds, traceback if the task failed).
+    """
+    logger = utils.get_logger(__name__, log_filename)
+    logger.info("Begin mihifepe worker daemon")
+    records = load_data(data_filename)
+    model = load_model(logger, model_generator_filename)
+    while True:
+        args = connection.recv()
+        if args is None:
+            break
+        assert (args.model_generator_filename, args.data_filename) == (model_generator_filename, data_filename)
+        start_time = time.time()
+        try:
+            run_task(args, logger, records, model)
+        except Exception:  # pylint: disable = broad-except
+            connection.send((args.task_idx, time.time() - start_time, traceback.format_exc()))
+            continue
+        connection.send((args.task_idx, time.time() - start_time, None))
+    records.close()
+    connection.close()
+    logger.info("End mihifepe worker daemon")
+
+
+def run_task(args, logger, records, model):
+    """Perturb features listed in task files and write outputs"""
+    with profiling.profile(args, "worker_%d" % args.task_idx):
+        # Load features to perturb from file
+        features = load_features(args.features_filename)
+        if args.pairs_filename:
+            # Expand interaction pairs into features to perturb
+            features = load_pairs(args, features)
+        source = "worker_%d" % args.task_idx
+        # Perturb features
+        with metrics.phase(args.output_dir, source, "perturb_features") as metrics_fields:
+            targets, losses, predictions, num_trials = perturb_features(args, logger, features, records, model, metrics_fields)
+        # Write outputs
+        with metrics.phase(args.output_dir, source, "write_outputs"):
+            write_outputs(args, logger, targets, losses, predictions, num_trials)
+
+
 def load_features(features_filename):
     """
     Load features from file
@@ -63,11 +111,32 @@ def load_features(features_filename):
             node = Feature(row[constants.NODE_NAME], rng_seed=int(row[constants.RNG_SEED]),
                            static_indices=Feature.unpack_indices(row[constants.STATIC_INDICES]),
                            temporal_indices=Feature.unpack_indices(row[constants.TEMPORAL_INDICES]))
-            node.initialize_rng()
             features.append(node)
     return features
 
 
+def load_pairs(args, features):
+    """
+    Load interaction pairs from file and expand them into features to perturb
+
+    Args:
+        args:       command-line arguments passed down from master
+        features:   list of features referenced by pairs
+
+    Returns:
+        list of features to perturb
+    """
+    nodes = {feature.name: feature for feature in features}
+    features = []
+    with open(args.pairs_filename, "r") as pairs_file:
+        reader = csv.DictReader(pairs_file)
+        for row in reader:
+            pair = InteractionPair(row[constants.NODE_NAME], nodes[row[constants.CACHED_NODE_NAME]],
+                                   nodes[row[constants.REDO_NODE_NAME]], int(row[constants.RNG_SEED]))
+            features.extend(pair.get_features(args.perturbation))
+    return features
+
+
 def load_data(data_filename):
     """
     Load data from file.
@@ -110,16 +179,17 @@ def load_model(logger, gen_model_filename):
     return model
 
 
-def perturb_features(args, logger, features, hdf5_root, model):
+def perturb_features(args, logger, features, hdf5_root, model, metrics_fields=None):
     """
     Perturbs features and observes effect on model loss
 
     Args:
-        args:       command-line arguments passed down from master
-        logger:     logger
-        features:   list of features to perturb
-        hdf5_root:  HDF5 root object containing data
-        model:      model object passed by client
+        args:           command-line arguments passed down from master
+        logger:         logger
+        features:       list of features to perturb
+        hdf5_root:      HDF5 root object containing data
+        model:          model object passed by client
+        metrics_fields: if given, dictionary to populate with number of records processed and model call statistics
 
     Returns:
         targets:        array of target values
@@ -130,16 +200,42 @@ def perturb_features(args, logger, features, hdf5_root, model):
         predictions:    (feature_id-> prediction))
                         mapping of feature names to prediction vectors,
                         describing the predictions of the model over the data with that feature perturbed
+        num_trials:     (feature_id-> num_trials))
+                        mapping of feature names to vectors of the number of shuffling trials used for each record
+                        (only populated for adaptive shuffling trials)
     """
     logger.info("Begin perturbing features")
     perturber = Perturber(args, features, hdf5_root, model)
-    for record_idx, _ in enumerate(perturber.record_ids):
-        if record_idx % 100 == 0:
-            logger.info("Begin processing record index %d of %d" % (record_idx + 1, perturber.num_records))
+    heartbeat = progress.Heartbeat(args, perturber.num_records, len(features))
+    record_indices = range(perturber.num_records)
+    if args.sequential_testing:
+        record_indices = get_sequential_order(perturber.num_records)
+    count = -1
+    for count, record_idx in enumerate(record_indices):
+        if count % 100 == 0:
+            logger.info("Begin processing record index %d of %d" % (count + 1, perturber.num_records))
         # Perturb each feature for given record
         perturber.perturb_features_for_record(record_idx)
+        heartbeat.update(count + 1)
+        if args.sequential_testing and (count + 1) % args.sequential_block_size == 0 and count + 1 < perturber.num_records:
+            perturber.sequential_checkpoint(record_indices[:count + 1])
+            if not perturber.active_features:
+                logger.info("Sequential testing: all features decided after %d records" % (count + 1))
+                break
+    heartbeat.update(perturber.num_records, force=True)  # Also when sequential testing stops early
+    if perturber.adaptive_trials:
+        trials_used = sum(np.sum(num_trials) for num_trials in perturber.num_trials.values())
+        trials_max = args.num_shuffling_trials * sum(np.count_nonzero(num_trials) for num_trials in perturber.num_trials.values())
+        logger.info("Adaptive shuffling trials: used %d of %d trials (%.1f%%)" % (trials_used, trials_max, 100. * trials_used / trials_max))
+    if metrics_fields is not None:
+        metrics_fields.update(num_records=count + 1, num_features=len(features), **metrics.latency_summary(perturber.model_call_latencies))
     logger.info("End perturbing features")
-    return perturber.targets, perturber.losses, perturber.predictions
+    return perturber.targets, perturber.losses, perturber.predictions, perturber.num_trials
+
+
+def get_sequential_order(num_records):
+    """Order in which records are processed for sequential testing: random, so that every block of records is a random sample"""
+    return np.random.RandomState(constants.SEED).permutation(num_records)
 
 
 class Perturber():
@@ -150,14 +246,38 @@ class Perturber():
         self.args = args
         self.features = features
         self.model = model
-        self.record_ids = hdf5_root[constants.RECORD_IDS][...]
-        self.targets = hdf5_root[constants.TARGETS][...]
-        self.static_dataset = hdf5_root[constants.STATIC][...]
+        # Only read the records to perturb (all by default)
+        rows = Ellipsis if self.args.record_indices is None else self.args.record_indices
+        self.record_ids = hdf5_root[constants.RECORD_IDS][rows]
+        self.record_indices = np.arange(len(self.record_ids)) if self.args.record_indices is None else self.args.record_indices
+        self.targets = hdf5_root[constants.TARGETS][rows]
+        self.static_dataset = hdf5_root[constants.STATIC][rows]
+        self.donor_dataset = self.static_dataset
+        if self.args.record_indices is not None and self.args.perturbation == constants.SHUFFLING:
+            # Shuffling draws replacement values from all records, so that results over a sample of records
+            # are consistent with those over the remaining records
+            self.donor_dataset = hdf5_root[constants.STATIC][...]
         self.temporal_grp = hdf5_root.get(constants.TEMPORAL)
         self.num_records = len(self.record_ids)
         self.static_data_input = bool(self.static_dataset.size)
-        self.losses = {feature.name: np.zeros(self.num_records) for feature in self.features}
-        self.predictions = {feature.name: np.zeros(self.num_records) for feature in self.features}
+        self.batch_predict = hasattr(self.model, "predict_batch")
+        self.model_call_latencies = []  # seconds
+        # Outputs are vectors over records, or matrices over records X outputs for multi-output models
+        self.output_shape = (self.args.num_outputs,) if self.args.num_outputs > 1 else ()
+        self.losses = {feature.name: np.zeros((self.num_records,) + self.output_shape) for feature in self.features}
+        self.predictions = {feature.name: np.zeros((self.num_records,) + self.output_shape) for feature in self.features}
+        self.active_features = self.features
+        self.adaptive_trials = self.args.perturbation == constants.SHUFFLING and self.args.shuffling_trials_tolerance > 0
+        self.num_trials = {}
+        if self.adaptive_trials:
+            self.num_trials = {feature.name: np.zeros(self.num_records, dtype=int) for feature in self.features}
+        if self.args.sequential_testing:
+            # Records not used by a feature (since it was decided before they were processed) retain NaN outputs
+            for outputs in (self.losses, self.predictions):
+                for feature_outputs in outputs.values():
+                    feature_outputs.fill(np.nan)
+            self.baseline_losses = np.zeros((self.num_records,) + self.output_shape)
+            self.num_checkpoints = max(1, math.ceil(self.num_records / self.args.sequential_block_size) - 1)
 
     def perturb_features_for_record(self, record_idx):
         """Perturbs all features for given record"""
@@ -166,22 +286,122 @@ class Perturber():
         static_data = self.static_dataset[record_idx] if self.static_data_input else []
         record_id = self.record_ids[record_idx]
         temporal_data = self.temporal_grp[record_id][...] if self.temporal_grp else []
-        # Perturb each feature
-        for feature in self.features:
-            tdata = self.perturb_temporal_data(feature, temporal_data)
-            sdata = None
-            if self.args.perturbation == constants.SHUFFLING:
-                tvals = np.zeros((2, self.args.num_shuffling_trials))
-                for trial in range(self.args.num_shuffling_trials):
-                    sdata = self.perturb_static_data(feature, static_data)
-                    tvals[:, trial] = self.model.predict(target, static_data=sdata, temporal_data=tdata)
-                (loss, prediction) = np.average(tvals, axis=1)
-            else:
-                sdata = self.perturb_static_data(feature, static_data)
-                (loss, prediction) = self.model.predict(target, static_data=sdata, temporal_data=tdata)
+        features = self.active_features
+        if self.args.perturbation == constants.SHUFFLING:
+            for feature in features:
+                feature.initialize_rng(self.record_indices[record_idx])
+        if self.adaptive_trials:
+            outputs = self.perturb_features_adaptively(record_idx, target, features, static_data, temporal_data)
+        else:
+            # Perturb each feature (num_trials times for shuffling perturbations)
+            num_trials = self.args.num_shuffling_trials if self.args.perturbation == constants.SHUFFLING else 1
+            all_outputs = self.predict(target, self.perturbed_inputs(features, num_trials, static_data, temporal_data,
+                                                                     unperturbed=self.args.sequential_testing))
+            if self.args.sequential_testing:
+                self.baseline_losses[record_idx] = all_outputs[0, 0]
+                all_outputs = all_outputs[:, 1:]
+            outputs = [all_outputs[:, idx * num_trials: (idx + 1) * num_trials] for idx in range(len(features))]
+        for feature, feature_outputs in zip(features, outputs):
+            (loss, prediction) = np.average(feature_outputs, axis=1)
             # Update outputs
             self.losses[feature.name][record_idx] = loss
             self.predictions[feature.name][record_idx] = prediction
+            if self.adaptive_trials:
+                self.num_trials[feature.name][record_idx] = feature_outputs.shape[1]
+
+    def perturb_features_adaptively(self, record_idx, target, features, static_data, temporal_data):
+        """
+        Draws shuffling trials for features in batches, until the standard error of the mean loss over the trials
+        for a feature falls below -shuffling_trials_tolerance (drawing between -min_shuffling_trials and
+        -num_shuffling_trials trials per feature; for multi-output models, until it does for every output).
+        Returns list of 2 X (number of trials) [X outputs] arrays of losses and predictions, one per feature.
+        """
+        outputs = [np.empty((2, 0) + self.output_shape) for _ in features]
+        pending = list(range(len(features)))  # Features requiring more trials, all with the same number of trials so far
+        num_trials = min(self.args.min_shuffling_trials, self.args.num_shuffling_trials)
+        unperturbed = self.args.sequential_testing
+        while pending:
+            batch_outputs = self.predict(target, self.perturbed_inputs([features[idx] for idx in pending], num_trials,
+                                                                       static_data, temporal_data, unperturbed=unperturbed))
+            if unperturbed:
+                self.baseline_losses[record_idx] = batch_outputs[0, 0]
+                batch_outputs = batch_outputs[:, 1:]
+                unperturbed = False
+            remaining = []
+            for batch_idx, idx in enumerate(pending):
+                outputs[idx] = np.concatenate((outputs[idx], batch_outputs[:, batch_idx * num_trials: (batch_idx + 1) * num_trials]), axis=1)
+                total_trials = outputs[idx].shape[1]
+                if total_trials < self.args.num_shuffling_trials:
+                    standard_error = np.max(np.std(outputs[idx][0], axis=0, ddof=1)) / np.sqrt(total_trials)
+                    if not standard_error <= self.args.shuffling_trials_tolerance:
+                        remaining.append(idx)
+            pending = remaining
+            if pending:
+                num_trials = min(self.args.shuffling_trials_batch_size, self.args.num_shuffling_trials - outputs[pending[0]].shape[1])
+        return outputs
+
+    def perturbed_inputs(self, features, num_trials, static_data, temporal_data, unperturbed=False):
+        """Generates perturbed inputs for given features, preceded by the unperturbed input if required"""
+        if unperturbed:
+            yield static_data, temporal_data  # Unperturbed input, to compare losses against
+        for feature in features:
+            tdata = self.perturb_temporal_data(feature, temporal_data)
+            for _ in range(num_trials):
+                yield self.perturb_static_data(feature, static_data), tdata
+
+    def sequential_checkpoint(self, record_indices):
+        """
+        Group-sequential one-sided sign test, for each active feature, of whether perturbing the feature increases the
+        model's loss over the given (processed) records. Features are no longer perturbed once the test is decided:
+        either the p-value falls below the efficacy bound (-sequential_alpha, split across checkpoints), or it is at
+        least the (non-binding) futility bound (-sequential_futility_pvalue).
+        """
+        # Multi-output models are tested on losses averaged over outputs
+        baseline_losses = np.around(aggregate_loss(self.baseline_losses[record_indices]), decimals=4)
+        efficacy_bound = self.args.sequential_alpha / self.num_checkpoints
+        active_features = []
+        for feature in self.active_features:
+            if feature.name == constants.BASELINE:
+                active_features.append(feature)  # Baseline losses are needed over all records
+                continue
+            pvalue = sign_test(baseline_losses, np.around(aggregate_loss(self.losses[feature.name][record_indices]), decimals=4))
+            if efficacy_bound < pvalue < self.args.sequential_futility_pvalue:
+                active_features.append(feature)
+        self.active_features = active_features
+
+    def predict(self, target, inputs):
+        """
+        Evaluates model on (perturbed) inputs for a record, in a single batched call if the model supports it.
+
+        Args:
+            target: target for record
+            inputs: iterable of (static data, temporal data) inputs
+
+        Returns:
+            2 X (number of inputs) [X outputs] array of losses and predictions
+        """
+        if self.batch_predict:
+            inputs = list(inputs)
+            if not inputs:
+                return np.empty((2, 0) + self.output_shape)
+            static_data, temporal_data = zip(*inputs)
+            start_time = time.perf_counter()
+            outputs = self.model.predict_batch(target, static_data=np.array(static_data), temporal_data=list(temporal_data))
+            self.model_call_latencies.append(time.perf_counter() - start_time)
+            outputs = np.array(outputs)
+        else:
+            outputs = []
+            for sdata, tdata in inputs:
+                start_time = time.perf_counter()
+                outputs.append(self.model.predict(target, static_data=sdata, temporal_data=tdata))
+                self.model_call_latencies.append(time.perf_counter() - start_time)
+            if not outputs:
+                return np.empty((2, 0) + self.output_shape)
+            outputs = np.ascontiguousarray(np.swapaxes(np.array(outputs), 0, 1))
+        if outputs.shape[2:] != self.output_shape:
+            raise ValueError("Model returned outputs of shape %s per input, expected %s (-num_outputs %d)"
+                             % (outputs.shape[2:], self.output_shape, self.args.num_outputs))
+        return outputs
 
     def perturb_static_data(self, feature, static_data):
         """Perturb static data for given feature"""
@@ -191,8 +411,8 @@ class Perturber():
         if self.args.perturbation == constants.ZEROING:
             sdata[feature.static_indices] = 0
         elif self.args.perturbation == constants.SHUFFLING:
-            replace_idx = feature.rng.randint(0, self.num_records)
-            sdata[feature.static_indices] = self.static_dataset[replace_idx][feature.static_indices]
+            replace_idx = feature.rng.integers(0, len(self.donor_dataset))
+            sdata[feature.static_indices] = self.donor_dataset[replace_idx][feature.static_indices]
         return sdata
 
     def perturb_temporal_data(self, feature, temporal_data):
@@ -212,21 +432,23 @@ class Perturber():
         return tdata
 
 
-def write_outputs(args, logger, targets, losses, predictions):
+def write_outputs(args, logger, targets, losses, predictions, num_trials):
     """Write outputs to results file"""
     logger.info("Begin writing outputs")
     results_filename = "%s/results_worker_%d.hdf5" % (args.output_dir, args.task_idx)
     root = h5py.File(results_filename, "w")
 
     def store_data(group, data):
-        """Helper function to store data"""
+        """Helper function to store data, chunking matrices over records X outputs of multi-output models"""
         for feature_id, feature_data in data.items():
-            group.create_dataset(feature_id, data=feature_data)
+            group.create_dataset(feature_id, data=feature_data, chunks=True if feature_data.ndim > 1 else None)
 
-    store_data(root.create_group(constants.LOSSES), losses)
+    if not args.losses:  # Otherwise the master computes losses from predictions
+        store_data(root.create_group(constants.LOSSES), losses)
     store_data(root.create_group(constants.PREDICTIONS), predictions)
-    if args.task_idx == 0:
-        root.create_dataset(constants.TARGETS, data=targets)
+    if num_trials:
+        store_data(root.create_group(constants.NUM_TRIALS), num_trials)
+    root.create_dataset(constants.TARGETS, data=targets)
     root.close()
     logger.info("End writing outputs")
 
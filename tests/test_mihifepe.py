@@ -1,9 +1,21 @@
 """Tests for `mihifepe` package."""
 
+import argparse
+import csv
+import glob
+import json
+import os
 import sys
-from unittest.mock import patch
+import time
+from unittest.mock import MagicMock, patch
 
-from mihifepe import constants
+import anytree
+import h5py
+import numpy as np
+
+from mihifepe import cache, compute_p_values, constants, interactions, losses, master, profiling, trace, tuning, worker
+from mihifepe.benchmarks import import_time, run_benchmarks
+from mihifepe.fdr import fdr_algorithms, hierarchical_fdr_control, render
 from mihifepe.simulation import simulation
 
 # pylint: disable = invalid-name, redefined-outer-name, protected-access
@@ -106,6 +118,27 @@ def test_simulation_interactions(file_regression, tmpdir):
     file_regression.check("\n".join(fdr), extension="_fdr.json")
 
 
+def test_empty_interactions(tmpdir):
+    """Test interaction analysis without any pairs of relevant features to test, and perturbation without inputs"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.1"
+           " -analyze_interactions -hierarchy_type random -perturbation zeroing -output_dir %s" % output_dir)
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        simulation.main()
+    with open("%s/%s" % (output_dir, constants.INTERACTIONS_PVALUES_FILENAME), "r") as pvalues_file:
+        rows = list(csv.DictReader(pvalues_file))
+    assert [row[constants.NODE_NAME] for row in rows] == [constants.DUMMY_ROOT]
+    args = argparse.Namespace(record_indices=None, perturbation=constants.ZEROING, shuffling_trials_tolerance=0.,
+                              sequential_testing=False, num_outputs=1)
+    model = worker.load_model(MagicMock(), "%s/gen_model.py" % output_dir)
+    with h5py.File("%s/data.hdf5" % output_dir, "r") as data_root:
+        perturber = worker.Perturber(args, [], data_root, model)
+        assert perturber.predict(0., iter([])).shape == (2, 0)
+        perturber.batch_predict = False
+        assert perturber.predict(0., iter([])).shape == (2, 0)
+
+
 def test_simulation_all_pairwise_interactions(file_regression, tmpdir):
     """Test simulation with all pairwise (leaf)interactions"""
     func_name = sys._getframe().f_code.co_name
@@ -164,3 +197,708 @@ def test_simulation_shuffling_interactions(file_regression, tmpdir):
     with open(fdr_filename, "r") as fdr_file:
         fdr = sorted(fdr_file.readlines())
     file_regression.check("\n".join(fdr), extension="_fdr.json")
+
+
+def test_hierarchical_fdr_sweep(file_regression, tmpdir):
+    """Test sweep over FDR procedures and alpha levels against individual hierarchical FDR runs"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -contiguous_node_names -hierarchy_type random -perturbation zeroing -output_dir %s" % output_dir)
+    pass_args = cmd.split()[2:]
+    with patch.object(sys, 'argv', pass_args):
+        simulation.main()
+    sweep_dir = "%s/sweep" % output_dir
+    cmd = ("python -m mihifepe.fdr.hierarchical_fdr_control -output_dir %s %s/%s -sweep_alphas 0.05 0.2"
+           " -sweep_procedures yekutieli lynch_guo" % (sweep_dir, output_dir, constants.PVALUES_FILENAME))
+    pass_args = cmd.split()[2:]
+    with patch.object(sys, 'argv', pass_args):
+        hierarchical_fdr_control.main()
+    sweep_filename = "%s/%s.csv" % (sweep_dir, constants.HIERARCHICAL_FDR_SWEEP)
+    with open(sweep_filename, "r") as sweep_file:
+        sweep = {row[constants.NODE_NAME]: row for row in csv.DictReader(sweep_file)}
+    fdr_filename = "%s/%s/%s.csv" % (output_dir, constants.HIERARCHICAL_FDR_DIR, constants.HIERARCHICAL_FDR_OUTPUTS)
+    with open(fdr_filename, "r") as fdr_file:
+        for row in csv.DictReader(fdr_file):
+            column = "%s_%s_alpha_0.05" % (constants.REJECTED_STATUS, constants.YEKUTIELI)
+            assert sweep[row[constants.NODE_NAME]][column] == row[constants.REJECTED_STATUS]
+    with open(sweep_filename, "r") as sweep_file:
+        lines = sorted(sweep_file.readlines())
+    file_regression.check("\n".join(lines), extension="_sweep.csv")
+
+
+def test_collapse_tree():
+    """Test collapsing of rendered tree to node budget, with summary nodes for collapsed children"""
+    root = anytree.Node("root", adjusted_pvalue=0.01, effect_size=1.)
+    for idx in range(3):
+        child = anytree.Node("child%d" % idx, parent=root, adjusted_pvalue=0.02, effect_size=0.5)
+        for gidx in range(3):
+            anytree.Node("grandchild%d%d" % (idx, gidx), parent=child, adjusted_pvalue=0.03 + 0.01 * gidx, effect_size=0.1 * gidx)
+    args = argparse.Namespace(max_rendered_nodes=5)
+    hierarchical_fdr_control.collapse_tree(args, MagicMock(), root)
+    children = {child.name: [grandchild.name for grandchild in child.children] for child in root.children}
+    assert children == {"child0": ["grandchild00", "child0: 2 more"], "child1": ["child1: 3 more"], "child2": ["child2: 3 more"]}
+    summary = root.children[1].children[0]
+    assert summary.adjusted_pvalue == 0.03 and summary.effect_size == 0.2 and summary.description == "3 collapsed nodes"
+
+
+def test_render(tmpdir):
+    """Test deferred rendering, and logging of failed background rendering, using stand-ins for Graphviz"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -perturbation zeroing -output_dir %s" % output_dir)
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        simulation.main()
+    fdr_dir = "%s/deferred" % output_dir
+    cmd = ("python -m mihifepe.fdr.hierarchical_fdr_control -output_dir %s -render deferred %s/%s"
+           % (fdr_dir, output_dir, constants.PVALUES_FILENAME))
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        hierarchical_fdr_control.main()
+    png_filename = "%s/%s.png" % (fdr_dir, constants.TREE)
+    assert os.path.exists("%s/%s.dot" % (fdr_dir, constants.TREE)) and not os.path.exists(png_filename)
+    # Stand-in for dot, writing the output file (-o <png_filename>) or failing
+    bin_dir = "%s/bin" % output_dir
+    os.makedirs(bin_dir)
+    dot_filename = "%s/dot" % bin_dir
+    with patch.dict(os.environ, {"PATH": "%s:%s" % (bin_dir, os.environ["PATH"])}):
+        with open(dot_filename, "w") as dot_file:
+            dot_file.write("#!/bin/sh\ntouch \"$5\"\n")
+        os.chmod(dot_filename, 0o755)
+        with patch.object(sys, 'argv', ["render.py", fdr_dir]):
+            render.main()
+        assert os.path.exists(png_filename)
+        with open(dot_filename, "w") as dot_file:
+            dot_file.write("#!/bin/sh\necho 'syntax error' >&2\nexit 1\n")
+        logger = MagicMock()
+        hierarchical_fdr_control.render_picture(logger, "%s/%s.dot" % (fdr_dir, constants.TREE), background=True)
+        hierarchical_fdr_control.wait_for_renders()
+        assert logger.error.called and "syntax error" in logger.error.call_args[0][0]
+        # In-process callers (e.g. the master) never wait on background rendering, whose waiters are daemon threads
+        with open(dot_filename, "w") as dot_file:
+            dot_file.write("#!/bin/sh\nsleep 10\n")
+        cmd = ("python -m mihifepe.fdr.hierarchical_fdr_control -output_dir %s/background %s/%s"
+               % (output_dir, output_dir, constants.PVALUES_FILENAME))
+        start_time = time.time()
+        with patch.object(sys, 'argv', cmd.split()[2:]):
+            hierarchical_fdr_control.main()
+        assert time.time() - start_time < 10
+        assert all(thread.daemon for thread in hierarchical_fdr_control._render_threads)
+
+
+def test_grouped_benjamini_hochberg():
+    """Test vectorized BH over families against BH applied to each family in turn, for p-values with ties"""
+    rng = np.random.RandomState(constants.SEED)
+    sizes = rng.randint(1, 20, size=50)
+    pvalues = np.around(rng.uniform(0, 0.2, size=np.sum(sizes)), decimals=2)  # Rounding produces ties
+    alpha = 0.1
+    order, adjusted_pvalues, critical_constants, rejected = fdr_algorithms.grouped_benjamini_hochberg(pvalues, sizes, alpha)
+    start = 0
+    for size in sizes:
+        family_order = start + np.argsort(pvalues[start: start + size], kind="stable")
+        family_pvalues = pvalues[family_order]
+        ranks = np.arange(1, size + 1)
+        family_critical_constants = ranks * alpha / size
+        passing = np.flatnonzero(family_pvalues <= family_critical_constants)
+        max_rank = passing[-1] + 1 if len(passing) else 0
+        family_adjusted_pvalues = [min(size / rank * pvalue for rank, pvalue in zip(ranks[idx:], family_pvalues[idx:]))
+                                   for idx in range(size)]
+        assert np.array_equal(order[start: start + size], family_order)
+        assert np.array_equal(adjusted_pvalues[start: start + size], family_adjusted_pvalues)
+        assert np.array_equal(critical_constants[start: start + size], family_critical_constants)
+        assert np.array_equal(rejected[start: start + size], ranks <= max_rank)
+        start += size
+
+
+def test_simulation_screened_interactions(file_regression, tmpdir):
+    """Test simulation with all pairwise interactions, screened down to a fixed number of pairs"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    pvalues_filename = "%s/%s" % (output_dir, constants.INTERACTIONS_PVALUES_FILENAME)
+    cmd = ("python -m mihifepe.simulation -seed 5 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -analyze_interactions -hierarchy_type random -perturbation zeroing -noise_multiplier 0.0 -noise_type additive_gaussian"
+           " -num_interactions 3 -output_dir %s -analyze_all_pairwise_interactions -interaction_screening_num_pairs 10" % output_dir)
+    pass_args = cmd.split()[2:]
+    with patch.object(sys, 'argv', pass_args):
+        simulation.main()
+    with open(pvalues_filename, "r") as pvalues_file:
+        pvalues = sorted(pvalues_file.readlines())
+    file_regression.check("\n".join(pvalues), extension="_pvalues.csv")
+    fdr_filename = "%s/%s/%s.csv" % (output_dir, constants.INTERACTIONS_FDR_DIR, constants.HIERARCHICAL_FDR_OUTPUTS)
+    with open(fdr_filename, "r") as fdr_file:
+        fdr = sorted(fdr_file.readlines())
+    file_regression.check("\n".join(fdr), extension="_fdr.json")
+
+
+def test_screen_interactions():
+    """Test ranking of candidate pairs by interaction screening statistic, and model call budget arithmetic"""
+    nodes = [anytree.Node("f%d" % idx) for idx in range(4)]
+    effects = [np.ones(10), 2 * np.ones(10), np.concatenate((0.5 * np.ones(5), np.zeros(5))), np.zeros(10)]
+    cached_predictions = {node.name: effect for node, effect in zip(nodes, effects)}
+    cached_predictions[constants.BASELINE] = np.zeros(10)
+    # Scores: (f0, f1): 2, (f1, f2): 0.5, (f0, f2): 0.25, others 0 (ties broken by order of pairs)
+
+    def screen(perturbation=constants.ZEROING, num_pairs=0, budget=0, shuffling_trials_tolerance=0.):
+        """Names of pairs selected by screening"""
+        args = argparse.Namespace(interaction_screening_num_pairs=num_pairs, interaction_model_call_budget=budget,
+                                  interaction_screening_sample_size=1000, perturbation=perturbation, num_shuffling_trials=2,
+                                  shuffling_trials_tolerance=shuffling_trials_tolerance, min_shuffling_trials=2)
+        return [(left.name, right.name) for left, right in interactions.screen_interactions(args, MagicMock(), nodes, cached_predictions)]
+
+    assert screen(num_pairs=1) == [("f0", "f1")]
+    assert screen(num_pairs=2) == [("f0", "f1"), ("f1", "f2")]
+    assert screen(num_pairs=4) == [("f0", "f1"), ("f0", "f2"), ("f0", "f3"), ("f1", "f2")]
+    assert screen(budget=25) == [("f0", "f1"), ("f1", "f2")]  # 10 model calls per pair
+    assert screen(perturbation=constants.SHUFFLING, budget=85) == [("f0", "f1"), ("f1", "f2")]  # 40 model calls per pair
+    # Adaptive shuffling trials: budget assumes -num_shuffling_trials trials per pair
+    assert screen(perturbation=constants.SHUFFLING, budget=85, shuffling_trials_tolerance=0.1) == [("f0", "f1"), ("f1", "f2")]
+    assert screen(num_pairs=1, budget=85) == [("f0", "f1")]
+    assert not screen(budget=9)
+
+
+def test_simulation_higher_order_interactions(file_regression, tmpdir):
+    """Test simulation with three-way interaction, searched for level by level"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -analyze_interactions -analyze_all_pairwise_interactions -hierarchy_type random -perturbation zeroing"
+           " -noise_type none -num_interactions 1 -interaction_order 3 -output_dir %s" % output_dir)
+    pass_args = cmd.split()[2:]
+    with patch.object(sys, 'argv', pass_args):
+        simulation.main()
+    pvalues_filename = "%s/%s" % (output_dir, "interaction_pvalues_order_3.csv")
+    with open(pvalues_filename, "r") as pvalues_file:
+        pvalues = sorted(pvalues_file.readlines())
+    file_regression.check("\n".join(pvalues), extension="_pvalues.csv")
+    interactions_filename = "%s/%s" % (output_dir, constants.HIGHER_ORDER_INTERACTIONS_FILENAME)
+    with open(interactions_filename, "r") as interactions_file:
+        interactions = sorted(interactions_file.readlines())
+    file_regression.check("\n".join(interactions), extension="_interactions.csv")
+
+
+def test_simulation_sequential_testing(file_regression, tmpdir):
+    """Test simulation with sequential testing, stopping perturbation of features once decided"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 2 -num_instances 500 -num_features 20 -fraction_relevant_features 0.3"
+           " -hierarchy_type random -perturbation zeroing -output_dir %s -sequential_testing" % output_dir)
+    pass_args = cmd.split()[2:]
+    with patch.object(sys, 'argv', pass_args):
+        simulation.main()
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as pvalues_file:
+        pvalues = sorted(pvalues_file.readlines())
+    file_regression.check("\n".join(pvalues), extension="_pvalues.csv")
+    fdr_filename = "%s/%s/%s.csv" % (output_dir, constants.HIERARCHICAL_FDR_DIR, constants.HIERARCHICAL_FDR_OUTPUTS)
+    with open(fdr_filename, "r") as fdr_file:
+        fdr = sorted(fdr_file.readlines())
+    file_regression.check("\n".join(fdr), extension="_fdr.json")
+
+
+def test_sequential_p_value():
+    """Test Bonferroni-adjusted p-value of group-sequential test, for features stopped at a checkpoint or never stopped"""
+    baseline = np.zeros(250)
+    perturbed = np.concatenate((np.ones(100), np.full(150, np.nan)))  # Stopped at the first checkpoint
+    assert compute_p_values.sequential_p_value(baseline, perturbed, 100) == 3 * compute_p_values.sign_test(baseline[:100], perturbed[:100])
+    perturbed = np.linspace(-1, 1, 250)  # Never stopped
+    pvalues = [compute_p_values.sign_test(baseline[:end], perturbed[:end]) for end in (100, 200)]
+    pvalues.append(compute_p_values.compute_p_value(baseline, perturbed))
+    assert compute_p_values.sequential_p_value(baseline, perturbed, 100) == min(1., 3 * min(pvalues))
+
+
+def test_simulation_adaptive_shuffling_trials(file_regression, tmpdir):
+    """Test simulation with shuffling trials drawn adaptively until the mean loss converges"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 2 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -perturbation shuffling -num_shuffling_trials 100 -output_dir %s"
+           " -shuffling_trials_tolerance 0.01" % output_dir)
+    pass_args = cmd.split()[2:]
+    with patch.object(sys, 'argv', pass_args):
+        simulation.main()
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as pvalues_file:
+        pvalues = sorted(pvalues_file.readlines())
+    file_regression.check("\n".join(pvalues), extension="_pvalues.csv")
+    fdr_filename = "%s/%s/%s.csv" % (output_dir, constants.HIERARCHICAL_FDR_DIR, constants.HIERARCHICAL_FDR_OUTPUTS)
+    with open(fdr_filename, "r") as fdr_file:
+        fdr = sorted(fdr_file.readlines())
+    file_regression.check("\n".join(fdr), extension="_fdr.json")
+
+
+def test_record_sample(file_regression, tmpdir):
+    """Test stratified record sample, and its reuse by a full run against a direct full run"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -perturbation zeroing -output_dir %s" % output_dir)
+    pass_args = cmd.split()[2:]
+    with patch.object(sys, 'argv', pass_args):
+        simulation.main()
+    inputs = ("-data_filename {0}/data.hdf5 -hierarchy_filename {0}/hierarchy.csv -model_generator_filename {0}/gen_model.py"
+              .format(output_dir))
+    sample_dir = "%s/sample" % output_dir
+    reuse_dir = "%s/reuse" % output_dir
+    for cmd in ["python -m mihifepe.master %s -output_dir %s -record_sample 0.3 -stratify_record_sample" % (inputs, sample_dir),
+                "python -m mihifepe.master %s -output_dir %s -reuse_record_sample %s/%s"
+                % (inputs, reuse_dir, sample_dir, constants.RECORD_SAMPLE_FILENAME)]:
+        pass_args = cmd.split()[2:]
+        with patch.object(sys, 'argv', pass_args):
+            master.main()
+    with open("%s/%s" % (sample_dir, constants.PVALUES_FILENAME), "r") as pvalues_file:
+        pvalues = sorted(pvalues_file.readlines())
+    file_regression.check("\n".join(pvalues), extension="_pvalues.csv")
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as full_file, \
+            open("%s/%s" % (reuse_dir, constants.PVALUES_FILENAME), "r") as reuse_file:
+        assert full_file.read() == reuse_file.read()
+
+
+def test_record_sample_shuffling(tmpdir):
+    """Test that reusing a record sample under shuffling perturbations gives results identical to a direct full run"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -perturbation shuffling -num_shuffling_trials 10 -output_dir %s" % output_dir)
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        simulation.main()
+    inputs = ("-data_filename {0}/data.hdf5 -hierarchy_filename {0}/hierarchy.csv -model_generator_filename {0}/gen_model.py"
+              " -perturbation shuffling -num_shuffling_trials 10".format(output_dir))
+    sample_dir = "%s/sample" % output_dir
+    reuse_dir = "%s/reuse" % output_dir
+    for cmd in ["python -m mihifepe.master %s -output_dir %s -record_sample 0.3" % (inputs, sample_dir),
+                "python -m mihifepe.master %s -output_dir %s -reuse_record_sample %s/%s"
+                % (inputs, reuse_dir, sample_dir, constants.RECORD_SAMPLE_FILENAME)]:
+        with patch.object(sys, 'argv', cmd.split()[2:]):
+            master.main()
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as full_file, \
+            open("%s/%s" % (reuse_dir, constants.PVALUES_FILENAME), "r") as reuse_file:
+        assert full_file.read() == reuse_file.read()
+
+
+def test_screening(file_regression, tmpdir):
+    """Test coarse-to-fine screening pass pruning subtrees before perturbing remaining records"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 200 -num_features 20 -fraction_relevant_features 0.3"
+           " -hierarchy_type random -perturbation zeroing -screening_sample 0.3 -output_dir %s" % output_dir)
+    pass_args = cmd.split()[2:]
+    with patch.object(sys, 'argv', pass_args):
+        simulation.main()
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as pvalues_file:
+        pvalues = sorted(pvalues_file.readlines())
+    file_regression.check("\n".join(pvalues), extension="_pvalues.csv")
+
+
+def test_progressive(file_regression, tmpdir):
+    """Test anytime mode perturbing features level by level against regular mode"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -perturbation shuffling -num_shuffling_trials 10 -output_dir %s" % output_dir)
+    for run_dir, flags in [(output_dir, ""), ("%s/progressive" % output_dir, " -progressive")]:
+        pass_args = ("%s -output_dir %s%s" % (cmd, run_dir, flags)).split()[2:]
+        with patch.object(sys, 'argv', pass_args), \
+                patch.object(master, "hierarchical_fdr", wraps=master.hierarchical_fdr) as fdr, \
+                patch.object(hierarchical_fdr_control, "render_picture") as render_picture:
+            simulation.main()
+    with open("%s/progressive/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as pvalues_file:
+        pvalues = pvalues_file.readlines()
+    file_regression.check("\n".join(sorted(pvalues)), extension="_pvalues.csv")
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as regular_file:
+        assert regular_file.readlines() == pvalues
+    # FDR control is run after each level, but only the final tree is rendered
+    progressive_fdr_dir = "%s/progressive/%s" % (output_dir, constants.HIERARCHICAL_FDR_DIR)
+    assert fdr.call_count > 1
+    assert [call[0][1] for call in render_picture.call_args_list if call[0][1].startswith(progressive_fdr_dir)] == \
+        ["%s/%s.dot" % (progressive_fdr_dir, constants.TREE)]
+    with open("%s/%s/%s.dot" % (output_dir, constants.HIERARCHICAL_FDR_DIR, constants.TREE), "r") as regular_file, \
+            open("%s/%s.dot" % (progressive_fdr_dir, constants.TREE), "r") as progressive_file:
+        assert regular_file.read() == progressive_file.read()
+
+
+def test_records_per_worker(tmpdir):
+    """Test partitioning records across workers against perturbing all records in one worker"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -analyze_interactions -hierarchy_type random -perturbation shuffling -num_shuffling_trials 10")
+    tiled_dir = "%s/tiled" % output_dir
+    for run_dir, flags in [(output_dir, ""), (tiled_dir, " -records_per_worker 7")]:
+        pass_args = ("%s -output_dir %s%s" % (cmd, run_dir, flags)).split()[2:]
+        with patch.object(sys, 'argv', pass_args):
+            simulation.main()
+    for filename in [constants.PVALUES_FILENAME, constants.INTERACTIONS_PVALUES_FILENAME]:
+        with open("%s/%s" % (output_dir, filename), "r") as output_file, open("%s/%s" % (tiled_dir, filename), "r") as tiled_file:
+            assert output_file.read() == tiled_file.read()
+
+
+def test_local_workers(tmpdir):
+    """Test running tasks on persistent local worker daemons against running them serially"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -analyze_interactions -hierarchy_type random -perturbation shuffling -num_shuffling_trials 10")
+    local_dir = "%s/local" % output_dir
+    for run_dir, flags in [(output_dir, ""), (local_dir, " -local_workers 2 -features_per_worker 3")]:
+        pass_args = ("%s -output_dir %s%s" % (cmd, run_dir, flags)).split()[2:]
+        with patch.object(sys, 'argv', pass_args):
+            simulation.main()
+    for filename in [constants.PVALUES_FILENAME, constants.INTERACTIONS_PVALUES_FILENAME]:
+        with open("%s/%s" % (output_dir, filename), "r") as output_file, open("%s/%s" % (local_dir, filename), "r") as local_file:
+            assert output_file.read() == local_file.read()
+
+
+def test_auto_tune(tmpdir):
+    """Test that auto-tuning task granularity and memory requirement leaves results unchanged"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -local_workers 2")
+    tuned_dir = "%s/tuned" % output_dir
+    for run_dir, flags in [(output_dir, ""), (tuned_dir, " -auto_tune -target_task_duration 0.05")]:
+        pass_args = ("%s -output_dir %s%s" % (cmd, run_dir, flags)).split()[2:]
+        with patch.object(sys, 'argv', pass_args):
+            simulation.main()
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as output_file, \
+            open("%s/%s" % (tuned_dir, constants.PVALUES_FILENAME), "r") as tuned_file:
+        assert output_file.read() == tuned_file.read()
+    # Granularity and memory requirement derived from (mocked) probe timings
+    feature_nodes = master.flatten_hierarchy(argparse.Namespace(rng=np.random.RandomState(constants.SEED)),
+                                             master.load_hierarchy("%s/hierarchy.csv" % output_dir))
+    seconds_per_evaluation = 2 ** -10  # 100 records: 0.098 seconds per feature
+    for target_task_duration, model_bytes, features_per_worker, records_per_worker, memory_requirement in \
+            [(0.5, 0, 5, 0, 1), (2 ** -7, 0, 1, 8, 1), (10 ** 3, 3 * 2 ** 30, len(feature_nodes), 0, 6)]:
+        args = master.get_parser().parse_args(["-model_generator_filename", "%s/gen_model.py" % output_dir,
+                                               "-hierarchy_filename", "%s/hierarchy.csv" % output_dir,
+                                               "-data_filename", "%s/data.hdf5" % output_dir, "-output_dir", tuned_dir,
+                                               "-auto_tune", "-target_task_duration", str(target_task_duration)])
+        with patch.object(tuning, "probe", return_value=(seconds_per_evaluation, model_bytes)):
+            tuning.auto_tune(args, MagicMock(), feature_nodes)
+        assert (args.features_per_worker, args.records_per_worker, args.memory_requirement) == \
+            (features_per_worker, records_per_worker, memory_requirement)
+
+
+def test_cache(tmpdir):
+    """Test that results cached by a previous run are reused, leaving results unchanged"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cache_dir = "%s/cache" % output_dir
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -perturbation shuffling -num_shuffling_trials 10 -cache_dir %s -output_dir %s"
+           % (cache_dir, output_dir))
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        simulation.main()
+    rerun_dir = "%s/rerun" % output_dir
+    cmd = ("python -m mihifepe.master -data_filename {0}/data.hdf5 -hierarchy_filename {0}/hierarchy.csv"
+           " -model_generator_filename {0}/gen_model.py -perturbation shuffling -num_shuffling_trials 10"
+           " -cache_dir {1} -output_dir {2}".format(output_dir, cache_dir, rerun_dir))
+    with patch.object(sys, 'argv', cmd.split()[2:]), patch.object(master.SerialPipeline, "run") as run:
+        master.main()
+        assert not run.called
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as output_file, \
+            open("%s/%s" % (rerun_dir, constants.PVALUES_FILENAME), "r") as rerun_file:
+        assert output_file.read() == rerun_file.read()
+    # Lookups mark entries as recently used, and pruning evicts least recently used entries first
+    args = master.get_parser().parse_args(cmd.split()[3:])
+    args.rng = np.random.RandomState(constants.SEED)
+    run_cache = cache.Cache(args, MagicMock())
+    nodes = master.flatten_hierarchy(args, master.load_hierarchy(args.hierarchy_filename))
+    filenames = [run_cache.get_filename(node) for node in nodes]
+    for idx, filename in enumerate(filenames):
+        os.utime(filename, (10 ** 6 + idx, 10 ** 6 + idx))
+    remaining, _ = run_cache.lookup(nodes[:1])
+    assert not remaining
+    size_limit = sum(os.path.getsize(filename) for filename in filenames[3:]) + os.path.getsize(filenames[0])
+    with patch.object(sys, 'argv', ["cache.py", "-cache_dir", cache_dir, "-prune_to", str(size_limit / 2 ** 30)]):
+        cache.main()
+    assert [os.path.exists(filename) for filename in filenames] == [True, False, False] + [True] * (len(filenames) - 3)
+
+
+def test_incremental(tmpdir):
+    """Test that incremental re-analysis identifies nodes by index sets, reusing results of renamed nodes"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -perturbation zeroing -incremental -output_dir %s" % output_dir)
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        simulation.main()
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as output_file:
+        expected = output_file.read()
+    # Rename all nodes, leaving index sets unchanged
+    with open("%s/hierarchy.csv" % output_dir, "r") as hierarchy_file:
+        rows = list(csv.DictReader(hierarchy_file))
+    renamed_filename = "%s/renamed_hierarchy.csv" % output_dir
+    with open(renamed_filename, "w", newline="") as renamed_file:
+        writer = csv.DictWriter(renamed_file, fieldnames=rows[0].keys())
+        writer.writeheader()
+        for row in rows:
+            row[constants.NODE_NAME] = "renamed_%s" % row[constants.NODE_NAME]
+            if row[constants.PARENT_NAME]:
+                row[constants.PARENT_NAME] = "renamed_%s" % row[constants.PARENT_NAME]
+            writer.writerow(row)
+    cmd = ("python -m mihifepe.master -data_filename {0}/data.hdf5 -hierarchy_filename {1} -model_generator_filename"
+           " {0}/gen_model.py -perturbation zeroing -incremental -output_dir {0}"
+           .format(output_dir, renamed_filename))
+    with patch.object(sys, 'argv', cmd.split()[2:]), patch.object(master.SerialPipeline, "run") as run:
+        master.main()
+        assert not run.called
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as output_file:
+        assert output_file.read().replace("renamed_", "") == expected
+
+
+def test_incremental_shuffling(tmpdir):
+    """Test that incremental re-analysis under shuffling perturbations gives results identical to a run from scratch"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -perturbation shuffling -num_shuffling_trials 10 -incremental -output_dir %s" % output_dir)
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        simulation.main()
+    # Rename every other node, whose shuffling draws then change
+    with open("%s/hierarchy.csv" % output_dir, "r") as hierarchy_file:
+        rows = list(csv.DictReader(hierarchy_file))
+    renamed = {row[constants.NODE_NAME]: "renamed_%s" % row[constants.NODE_NAME] for row in rows[1::2]}
+    renamed_filename = "%s/renamed_hierarchy.csv" % output_dir
+    with open(renamed_filename, "w", newline="") as renamed_file:
+        writer = csv.DictWriter(renamed_file, fieldnames=rows[0].keys())
+        writer.writeheader()
+        for row in rows:
+            row[constants.NODE_NAME] = renamed.get(row[constants.NODE_NAME], row[constants.NODE_NAME])
+            row[constants.PARENT_NAME] = renamed.get(row[constants.PARENT_NAME], row[constants.PARENT_NAME])
+            writer.writerow(row)
+    scratch_dir = "%s/scratch" % output_dir
+    for run_dir in [output_dir, scratch_dir]:
+        cmd = ("python -m mihifepe.master -data_filename {0}/data.hdf5 -hierarchy_filename {1} -model_generator_filename"
+               " {0}/gen_model.py -perturbation shuffling -num_shuffling_trials 10 -incremental -output_dir {2}"
+               .format(output_dir, renamed_filename, run_dir))
+        with patch.object(sys, 'argv', cmd.split()[2:]):
+            master.main()
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as output_file, \
+            open("%s/%s" % (scratch_dir, constants.PVALUES_FILENAME), "r") as scratch_file:
+        assert output_file.read() == scratch_file.read()
+
+
+def test_empty_features(tmpdir):
+    """Test that pipelines over no features compile the targets, with no losses or predictions"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -perturbation zeroing -output_dir %s" % output_dir)
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        simulation.main()
+    cmd = ("python -m mihifepe.master -data_filename {0}/data.hdf5 -hierarchy_filename {0}/hierarchy.csv"
+           " -model_generator_filename {0}/gen_model.py -perturbation zeroing -output_dir {0}/empty".format(output_dir))
+    with patch.object(sys, 'argv', cmd.split()[2:]), patch.object(master, "pipeline") as pipeline:
+        master.main()
+    args, logger = pipeline.call_args[0]
+    with h5py.File("%s/data.hdf5" % output_dir, "r") as data_root:
+        expected_targets = data_root[constants.TARGETS][...]
+    for records_per_worker in [None, 30]:
+        args.records_per_worker = records_per_worker
+        results = master.SerialPipeline(args, logger, []).run()
+        assert np.array_equal(results.targets, expected_targets)
+        assert not results.losses and not results.predictions
+
+
+def test_losses(tmpdir):
+    """Test computing losses from stored predictions, against losses returned by the model (absolute error)"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -perturbation zeroing -local_workers 2")
+    losses_dir = "%s/losses" % output_dir
+    for run_dir, flags in [(output_dir, ""), (losses_dir, " -losses absolute_error squared_error")]:
+        pass_args = ("%s -output_dir %s%s" % (cmd, run_dir, flags)).split()[2:]
+        with patch.object(sys, 'argv', pass_args):
+            simulation.main()
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as output_file, \
+            open("%s/%s" % (losses_dir, constants.PVALUES_FILENAME), "r") as losses_file:
+        assert output_file.read() == losses_file.read()
+    assert os.path.exists("%s/%s/%s" % (losses_dir, constants.SQUARED_ERROR, constants.PVALUES_FILENAME))
+
+
+def test_loss_functions():
+    """Test losses computed from predictions of single-output models"""
+    targets = np.array([1., 0.])
+    predictions = {"a": np.array([0.5, 0.25]), "b": np.array([1., 0.])}
+    expected = {constants.SQUARED_ERROR: {"a": [0.25, 0.0625], "b": [0., 0.]},
+                constants.ABSOLUTE_ERROR: {"a": [0.5, 0.25], "b": [0., 0.]},
+                constants.LOG_LOSS: {"a": [np.log(2), np.log(4 / 3)], "b": [0., 0.]}}  # Probabilities clipped, so finite
+    for loss, expected_losses in expected.items():
+        computed_losses = losses.compute_losses(loss, targets, predictions, constants.BINARY_CLASSIFIER)
+        assert computed_losses.keys() == expected_losses.keys()
+        for name, expected_loss in expected_losses.items():
+            assert np.allclose(computed_losses[name], expected_loss, rtol=0, atol=1e-12)
+    assert losses.compute_losses(constants.SQUARED_ERROR, targets, {}) == {}
+
+
+MULTI_OUTPUT_MODEL = """
+import importlib.util
+
+import numpy as np
+
+spec = importlib.util.spec_from_file_location("single_output_model", "{0}/gen_model.py")
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+
+
+class Model():
+    # Duplicates outputs of single-output model, weighting losses of each output
+    def predict_batch(self, target, static_data, temporal_data):
+        losses, predictions = module.model.predict_batch(target, static_data, temporal_data)
+        return np.stack((losses, losses), axis=1) * np.array({1}), np.stack((predictions, predictions), axis=1)
+
+
+model = Model()
+"""
+
+
+def test_multi_output(tmpdir):
+    """Test multi-output model, whose identical outputs yield the same aggregated and per-output p-values as a single output"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -perturbation zeroing -output_dir %s" % output_dir)
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        simulation.main()
+    gen_model_filename = "%s/gen_multi_output_model.py" % output_dir
+    with open(gen_model_filename, "w") as gen_model_file:
+        gen_model_file.write(MULTI_OUTPUT_MODEL.format(output_dir, [1, 1]))
+    multi_output_dir = "%s/multi_output" % output_dir
+    cmd = ("python -m mihifepe.master -data_filename {0}/data.hdf5 -hierarchy_filename {0}/hierarchy.csv"
+           " -model_generator_filename {1} -perturbation zeroing -num_outputs 2 -per_output_pvalues"
+           " -records_per_worker 30 -output_dir {2}".format(output_dir, gen_model_filename, multi_output_dir))
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        master.main()
+    with open("%s/%s" % (output_dir, constants.PVALUES_FILENAME), "r") as output_file:
+        expected = output_file.read()
+    for pvalues_dir in [multi_output_dir] + ["%s/%s" % (multi_output_dir, constants.OUTPUT_DIR_FORMAT % idx) for idx in range(2)]:
+        with open("%s/%s" % (pvalues_dir, constants.PVALUES_FILENAME), "r") as pvalues_file:
+            assert pvalues_file.read() == expected
+    # Model whose first output is uninformative (zero losses): the second output's p-values are those of the single output,
+    # and aggregated losses are averaged over outputs
+    with open(gen_model_filename, "w") as gen_model_file:
+        gen_model_file.write(MULTI_OUTPUT_MODEL.format(output_dir, [0, 1]))
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        master.main()
+
+    def read_pvalues(pvalues_dir):
+        """Read rows of p-values file"""
+        with open("%s/%s" % (pvalues_dir, constants.PVALUES_FILENAME), "r") as pvalues_file:
+            return list(csv.DictReader(pvalues_file))
+
+    single_rows = read_pvalues(output_dir)
+    with open("%s/%s/%s" % (multi_output_dir, constants.OUTPUT_DIR_FORMAT % 1, constants.PVALUES_FILENAME), "r") as pvalues_file:
+        assert pvalues_file.read() == expected
+    for row in read_pvalues("%s/%s" % (multi_output_dir, constants.OUTPUT_DIR_FORMAT % 0)):
+        assert float(row[constants.EFFECT_SIZE]) == 0 and float(row[constants.MEAN_LOSS]) == 0
+    for single_row, row in zip(single_rows, read_pvalues(multi_output_dir)):
+        assert abs(float(row[constants.EFFECT_SIZE]) - float(single_row[constants.EFFECT_SIZE]) / 2) <= 1e-4
+
+
+def test_multi_output_losses():
+    """Test losses of multi-output models computed from predictions, expanding vectors of targets over outputs"""
+    # Class labels are one-hot encoded for classifiers, and cross-entropy averaged over outputs is scaled by 1 / num_outputs
+    predictions = {"a": np.array([[0.5, 0.25, 0.25], [0.2, 0.2, 0.6]])}
+    cross_entropy = losses.compute_losses(constants.CROSS_ENTROPY, np.array([0, 2]), predictions, constants.CLASSIFIER)
+    assert np.allclose(cross_entropy["a"], [[np.log(2), 0, 0], [0, 0, -np.log(0.6)]])
+    assert np.allclose(losses.aggregate_losses(cross_entropy)["a"], [np.log(2) / 3, -np.log(0.6) / 3])
+    assert np.allclose(losses.select_output(cross_entropy, 2)["a"], [0, -np.log(0.6)])
+    # Targets are otherwise shared by all outputs
+    squared_error = losses.compute_losses(constants.SQUARED_ERROR, np.array([1., 2.]), {"a": np.array([[1., 3.], [0., 2.]])})
+    assert np.allclose(squared_error["a"], [[0, 4], [4, 0]])
+
+
+def test_metrics(tmpdir):
+    """Test per-phase metrics written by master, workers and pipeline"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -features_per_worker 5 -output_dir %s" % output_dir)
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        simulation.main()
+    with open("%s/%s" % (output_dir, constants.METRICS_FILENAME), "r") as metrics_file:
+        metrics = [json.loads(line) for line in metrics_file]
+    phases = {(entry["source"].split("_")[0], entry["phase"]) for entry in metrics}
+    assert phases == {("master", "load_hierarchy"), ("master", "perturb_features"), ("master", "compute_p_values"),
+                      ("master", "hierarchical_fdr"), ("SerialPipeline", "run_tasks"), ("SerialPipeline", "compile_results"),
+                      ("worker", "load_data"), ("worker", "load_model"), ("worker", "perturb_features"), ("worker", "write_outputs")}
+    for entry in metrics:
+        assert entry["wall_seconds"] >= 0 and entry["cpu_seconds"] >= 0
+        if entry["phase"] == "perturb_features" and entry["source"] != "master":
+            assert entry["num_records"] == 100 and entry["model_calls"] > 0
+
+
+def test_progress(tmpdir):
+    """Test progress reporting aggregating worker heartbeats"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -local_workers 2 -features_per_worker 5 -records_per_worker 30 -output_dir %s" % output_dir)
+    with patch.object(sys, 'argv', cmd.split()[2:]), patch.object(constants, "PROGRESS_INTERVAL", 0):
+        simulation.main()
+    with open("%s/%s" % (output_dir, constants.STATUS_FILENAME), "r") as status_file:
+        status = json.load(status_file)
+    assert status["percent_complete"] == 100. and status["tasks_done"] == status["num_tasks"] > 1
+
+
+def test_trace(tmpdir):
+    """Test timeline of run in Chrome trace-event format"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -local_workers 2 -features_per_worker 5 -output_dir %s" % output_dir)
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        simulation.main()
+    with open("%s/%s" % (output_dir, constants.TRACE_FILENAME), "r") as trace_file:
+        events = json.load(trace_file)["traceEvents"]
+    track_names = {event["args"]["name"] for event in events if event["name"] == "thread_name"}
+    assert {"master", "LocalPipeline", "task 0"}.issubset(track_names)
+    task_events = {(event["tid"], event["name"]) for event in events if event["ph"] == "X" and event["pid"] == trace.TASKS_PID}
+    assert {(0, "perturb_features"), (0, "compile_results")}.issubset(task_events)
+
+
+def test_profile(tmpdir):
+    """Test profiling master and worker tasks"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = ("python -m mihifepe.simulation -seed 1 -num_instances 100 -num_features 10 -fraction_relevant_features 0.5"
+           " -hierarchy_type random -local_workers 2 -features_per_worker 5 -profile -output_dir %s" % output_dir)
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        simulation.main()
+    for filename in ["profile_master.prof", "profile_worker_0.prof", constants.PROFILE_WORKERS_FILENAME]:
+        assert os.path.exists("%s/%s" % (output_dir, filename))
+    with open("%s/%s" % (output_dir, constants.PROFILE_REPORT_FILENAME), "r") as report_file:
+        assert "predict_batch" in report_file.read()
+    # Profiles of failed tasks are missing, and skipped with a warning
+    args = argparse.Namespace(profile=True, compile_results_only=False, output_dir=output_dir)
+    logger = MagicMock()
+    task_count = len(glob.glob("%s/profile_worker_*.prof" % output_dir))
+    profiling.merge_worker_profiles(args, logger, task_count + 1)
+    assert logger.warning.call_count == 1 and "profile_worker_%d.prof" % task_count in logger.warning.call_args[0][0]
+    # No profiles at all
+    args.output_dir = "%s/empty" % output_dir
+    os.makedirs(args.output_dir)
+    logger = MagicMock()
+    profiling.merge_worker_profiles(args, logger, 1)
+    assert logger.warning.call_count == 2
+    assert not os.path.exists("%s/%s" % (args.output_dir, constants.PROFILE_WORKERS_FILENAME))
+
+
+def test_import_time():
+    """Test that worker and master don't import heavy dependencies meant to be imported lazily"""
+    for module in import_time.BUDGETS:
+        _, _, lazy_modules = import_time.measure(module, 1)
+        assert not lazy_modules, "%s imports %s" % (module, lazy_modules)
+
+
+def test_benchmarks(tmpdir):
+    """Test benchmark suite over small inputs"""
+    func_name = sys._getframe().f_code.co_name
+    output_dir = "%s/output_dir_%s" % (tmpdir, func_name)
+    cmd = "python -m mihifepe.benchmarks.run_benchmarks -output_dir %s -num_records 100 -num_features 10 -repeats 1" % output_dir
+    with patch.object(sys, 'argv', cmd.split()[2:]):
+        run_benchmarks.main()
+    with open("%s/%s" % (output_dir, constants.BENCHMARKS_FILENAME), "r") as benchmarks_file:
+        benchmarks = json.load(benchmarks_file)["benchmarks"]
+    assert sorted(benchmark["benchmark"] for benchmark in benchmarks) == \
+        sorted(["load_hierarchy", "perturber", "perturber", "compute_p_values", "hierarchical_fdr_control",
+                "hierarchical_fdr_control", "compile_results"])